@@ -0,0 +1,345 @@
+"""
+Microbenchmarks of the hot paths of the parser, run on the CPU over a synthetic treebank (see
+`benchmarks/synthetic_conllu.py`) with randomly initialised heads on top of a tiny randomly
+initialised transformer encoder:
+
+  * the dataset reader, `UniversalDependenciesEnhancedDatasetReader._read`
+  * `RootedAdjacencyField.as_tensor`
+  * the encoder, then the `forward` and `make_output_human_readable` of each head
+  * `MultiTaskParserHead._run_mst_decoding`
+  * `EnhancedPredictor.dump_line`, with and without graph repair
+  * `connect_sentence` of `scripts/connect_graph.py`
+  * `load_conllu_file` and `evaluate` of `scripts/iwpt21_xud_eval.py`
+
+The results are written as JSON, together with the commit and the configuration, so that they
+can be compared between commits with `--baseline`:
+
+  python benchmarks/run_benchmarks.py --sentences 500 --output-file before.json
+  python benchmarks/run_benchmarks.py --sentences 500 --baseline before.json --max-slowdown 0.1
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+from allennlp.common.util import sanitize
+from allennlp.data import Batch, Vocabulary
+from allennlp.modules.seq2seq_encoders import PytorchTransformer
+from allennlp.modules.text_field_embedders import BasicTextFieldEmbedder
+from allennlp.modules.token_embedders import Embedding
+from allennlp.nn.util import get_text_field_mask
+
+from multitask_parser.dataset_readers.universal_dependencies_enhanced import UniversalDependenciesEnhancedDatasetReader
+from multitask_parser.graph_repair import REPAIR_MODES
+from multitask_parser.models.heads.multitask.enhanced_dm_parser_head import EnhancedDMParser
+from multitask_parser.models.heads.multitask.enhanced_kg_parser_head import EnhancedKGParser
+from multitask_parser.models.heads.multitask.parser_head import MultiTaskParserHead
+from multitask_parser.models.heads.multitask.tagger_head import MultiTaskTaggerHead
+from multitask_parser.predictors.enhanced_predictor import EnhancedPredictor
+
+import connect_graph
+import iwpt21_xud_eval
+from synthetic_conllu import add_generator_arguments, generator_options, write_treebank
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description="Runs the microbenchmarks on a synthetic treebank.")
+parser.add_argument("--sentences", "-n", type=int, default=500, help="The number of sentences of the treebank.")
+parser.add_argument("--noise", type=float, default=0.1,
+                    help="The noise of the system output used by connect_graph and the evaluator.")
+parser.add_argument("--batch-size", type=int, default=32, help="The number of sentences per batch.")
+parser.add_argument("--repeat", type=int, default=5,
+                    help="The number of timed runs of each benchmark, after one warm-up run.")
+parser.add_argument("--threads", type=int, default=1, help="The number of threads used by torch.")
+parser.add_argument("--hidden-dim", type=int, default=64,
+                    help="The dimension of the encoder and of the representations of the heads.")
+parser.add_argument("--layers", type=int, default=2, help="The number of layers of the encoder.")
+parser.add_argument("--attention-heads", type=int, default=4, help="The number of attention heads of the encoder.")
+parser.add_argument("--repair-mode", type=str, default="best_guess", choices=REPAIR_MODES,
+                    help="The graph repair mode of connect_graph and of the predictor.")
+parser.add_argument("--only", type=str, nargs="+", default=None,
+                    help="Only run the benchmarks whose name contains one of these strings.")
+parser.add_argument("--data-dir", type=str, default=None,
+                    help="Keep the synthetic treebank in this directory instead of a temporary one.")
+parser.add_argument("--output-file", "-o", type=str, default=None,
+                    help="Write the results to this JSON file instead of the standard output.")
+parser.add_argument("--baseline", type=str, default=None,
+                    help="Compare the results with those of a previous run, e.g. on another commit.")
+parser.add_argument("--max-slowdown", type=float, default=None,
+                    help="With --baseline, exit with an error if a benchmark is slower by more than this "
+                         "fraction, e.g. 0.1 for 10%%.")
+add_generator_arguments(parser)
+
+HEAD_NAMES = ["enhanced_kg_parser", "enhanced_kg_parser[decode_connected]", "enhanced_dm_parser",
+              "multitask_parser", "multitask_tagger"]
+
+
+def time_function(function, repeat, prepare=None):
+    """
+    Runs `function` once to warm up, then `repeat` times, and returns the durations of the timed
+    runs in seconds. If given, `prepare` is called before each run (outside of the timing) and
+    returns the arguments of `function`, e.g. fresh copies of inputs which `function` modifies.
+    """
+    durations = []
+    for run in range(repeat + 1):
+        arguments = prepare() if prepare is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        if run > 0:
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarise(name, durations, items, unit):
+    best = min(durations)
+    return {
+        "name": name,
+        "items": items,
+        "unit": unit,
+        "repeat": len(durations),
+        "min_s": best,
+        "median_s": statistics.median(durations),
+        "mean_s": statistics.mean(durations),
+        "items_per_s": items / best if best > 0 else None,
+    }
+
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def make_heads(vocab, dim):
+    return {
+        "enhanced_kg_parser": EnhancedKGParser(vocab, encoder_dim=dim, tag_representation_dim=dim,
+                                               arc_representation_dim=dim),
+        "enhanced_kg_parser[decode_connected]": EnhancedKGParser(vocab, encoder_dim=dim, tag_representation_dim=dim,
+                                                                 arc_representation_dim=dim, decode_connected=True),
+        "enhanced_dm_parser": EnhancedDMParser(vocab, encoder_dim=dim, tag_representation_dim=dim,
+                                               arc_representation_dim=dim),
+        "multitask_parser": MultiTaskParserHead(vocab, encoder_dim=dim, tag_representation_dim=dim,
+                                                arc_representation_dim=dim),
+        "multitask_tagger": MultiTaskTaggerHead(vocab, encoder_dim=dim, task="upos"),
+    }
+
+
+def split_outputs(output_dict, keys):
+    """The outputs of each sentence of a batch, as the predictor gets them."""
+    batch_size = len(output_dict["words"])
+    return [sanitize({key: output_dict[key][i] for key in keys}) for i in range(batch_size)]
+
+
+def run_benchmarks(args, gold_file, system_file):
+    """Yields the summary of each benchmark selected by `args.only`."""
+    def selected(name):
+        return args.only is None or any(pattern in name for pattern in args.only)
+
+    def benchmark(name, function, items, unit="sentences", prepare=None):
+        if not selected(name):
+            return None
+        result = summarise(name, time_function(function, args.repeat, prepare), items, unit)
+        logger.info("%-48s %10.2f ms  %12.1f %s/s", name, 1000 * result["min_s"], result["items_per_s"], unit)
+        return result
+
+    reader = UniversalDependenciesEnhancedDatasetReader()
+
+    def read():
+        for _ in reader._read(gold_file):
+            pass
+    yield benchmark("reader._read", read, args.sentences)
+
+    instances = list(reader._read(gold_file))
+    vocab = Vocabulary.from_instances(instances)
+    for instance in instances:
+        instance.index_fields(vocab)
+    batches = [instances[start:start + args.batch_size] for start in range(0, len(instances), args.batch_size)]
+
+    field_batches = [[instance["enhanced_tags"] for instance in batch] for batch in batches]
+    def as_tensors():
+        for fields in field_batches:
+            padding_lengths = {"num_tokens": max(field.get_padding_lengths()["num_tokens"] for field in fields)}
+            for field in fields:
+                field.as_tensor(padding_lengths)
+    yield benchmark("RootedAdjacencyField.as_tensor", as_tensors, len(instances))
+
+    torch.manual_seed(args.seed)
+    embedder = BasicTextFieldEmbedder({"tokens": Embedding(embedding_dim=args.hidden_dim,
+                                                           num_embeddings=vocab.get_vocab_size("tokens"))})
+    encoder = PytorchTransformer(input_dim=args.hidden_dim, num_layers=args.layers,
+                                 feedforward_hidden_dim=4 * args.hidden_dim,
+                                 num_attention_heads=args.attention_heads, positional_encoding="sinusoidal")
+    embedder.eval()
+    encoder.eval()
+    tensor_batches = [Batch(batch).as_tensor_dict() for batch in batches]
+
+    def encode():
+        encoded_batches = []
+        with torch.no_grad():
+            for tensors in tensor_batches:
+                mask = get_text_field_mask(tensors["words"])
+                encoded_batches.append((encoder(embedder(tensors["words"]), mask), mask))
+        return encoded_batches
+    yield benchmark("encoder.forward", encode, len(instances))
+    encoded_batches = encode()
+
+    heads = make_heads(vocab, args.hidden_dim)
+    head_outputs = {}
+    for head_name in HEAD_NAMES:
+        head = heads[head_name]
+        head.eval()
+        head_inputs = []
+        for tensors, (encoded_text, mask) in zip(tensor_batches, encoded_batches):
+            inputs = {"encoded_text": encoded_text, "mask": mask, "metadata": tensors["metadata"]}
+            if head_name != "multitask_tagger":
+                inputs["upos"] = tensors["upos"]
+            head_inputs.append(inputs)
+
+        def forward(head=head, head_inputs=head_inputs):
+            with torch.no_grad():
+                return [head(**inputs) for inputs in head_inputs]
+        yield benchmark(f"{head_name}.forward", forward, len(instances))
+        head_outputs[head_name] = forward()
+
+        # the tagger's make_output_human_readable looks up the tags of whole sentences in the
+        # vocabulary, so it can't be run on batches
+        if head_name == "multitask_tagger":
+            continue
+
+        def make_output_human_readable(output_dicts, head=head):
+            return [head.make_output_human_readable(output_dict) for output_dict in output_dicts]
+        # the heads pop some of the outputs
+        def copy_outputs(head_name=head_name):
+            return ([dict(output_dict) for output_dict in head_outputs[head_name]],)
+        yield benchmark(f"{head_name}.make_output_human_readable", make_output_human_readable, len(instances),
+                        prepare=copy_outputs)
+
+    num_head_tags = vocab.get_vocab_size("head_tags")
+    energy_batches = []
+    for encoded_text, mask in encoded_batches:
+        batch_size, sequence_length = mask.size()
+        # one energy per (head, dependent) pair, repeated over the tags
+        energy = torch.rand(batch_size, 1, sequence_length + 1, sequence_length + 1)
+        energy = energy.expand(batch_size, num_head_tags, sequence_length + 1, sequence_length + 1)
+        energy_batches.append((energy, (mask.sum(dim=1) + 1).numpy()))
+    def run_mst_decoding():
+        for energy, lengths in energy_batches:
+            MultiTaskParserHead._run_mst_decoding(energy, lengths)
+    yield benchmark("MultiTaskParserHead._run_mst_decoding", run_mst_decoding, len(instances))
+
+    kg_head = heads["enhanced_kg_parser"]
+    output_keys = ["conllu_metadata", "ids", "words", "lemmas", "upos", "xpos", "feats", "head_tags",
+                   "head_indices", "original_to_new_indices", "misc", "multiword_ids", "multiword_forms",
+                   "arc_indices", "arc_tags"]
+    sentence_outputs = []
+    for output_dict in head_outputs["enhanced_kg_parser"]:
+        sentence_outputs.extend(split_outputs(kg_head.make_output_human_readable(dict(output_dict)), output_keys))
+    for graph_repair in [None, args.repair_mode]:
+        predictor = EnhancedPredictor(kg_head, reader, graph_repair=graph_repair)
+        def dump_lines(outputs, predictor=predictor):
+            for sentence_output in outputs:
+                predictor.dump_line(sentence_output)
+        name = "EnhancedPredictor.dump_line" + (f"[{graph_repair}]" if graph_repair else "")
+        yield benchmark(name, dump_lines, len(sentence_outputs),
+                        prepare=lambda: ([dict(sentence_output) for sentence_output in sentence_outputs],))
+
+    with open(system_file, encoding="utf-8") as conllu_file:
+        system_sentences = list(connect_graph.stream_parse(conllu_file))
+    def connect_sentences(sentences):
+        for annotated_sentence in sentences:
+            connect_graph.connect_sentence(annotated_sentence, args.repair_mode)
+    yield benchmark(f"connect_graph.connect_sentence[{args.repair_mode}]", connect_sentences, len(system_sentences),
+                    prepare=lambda: (copy.deepcopy(system_sentences),))
+
+    treebank_type = iwpt21_xud_eval.get_treebank_type("0")
+    def load_system():
+        return iwpt21_xud_eval.load_conllu_file(system_file, treebank_type, collapse=True)
+    yield benchmark("iwpt21_xud_eval.load_conllu_file", load_system, args.sentences)
+    gold_ud = iwpt21_xud_eval.load_conllu_file(gold_file, treebank_type, collapse=True)
+    system_ud = load_system()
+    yield benchmark("iwpt21_xud_eval.evaluate", lambda: iwpt21_xud_eval.evaluate(gold_ud, system_ud),
+                    args.sentences)
+
+
+def compare_with_baseline(results, baseline_file, max_slowdown=None):
+    """Logs the change of each benchmark against the baseline; returns the names of the regressions."""
+    with open(baseline_file) as baseline:
+        baseline = json.load(baseline)
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    logger.info("Compared with %s (commit %s)", baseline_file, baseline.get("commit"))
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result["name"])
+        if previous is None:
+            continue
+        change = result["min_s"] / previous["min_s"] - 1
+        logger.info("%-48s %10.2f ms  %10.2f ms  %+7.1f%%", result["name"], 1000 * result["min_s"],
+                    1000 * previous["min_s"], 100 * change)
+        if max_slowdown is not None and change > max_slowdown:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="benchmarks-")
+    os.makedirs(data_dir, exist_ok=True)
+    gold_file = os.path.join(data_dir, "gold.conllu")
+    system_file = os.path.join(data_dir, "system.conllu")
+    write_treebank(gold_file, args.sentences, system_file, args.noise, **generator_options(args))
+
+    try:
+        results = [result for result in run_benchmarks(args, gold_file, system_file) if result is not None]
+    finally:
+        if args.data_dir is None:
+            for path in (gold_file, system_file):
+                os.remove(path)
+            os.rmdir(data_dir)
+
+    report = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output_file", "baseline", "max_slowdown", "data_dir")},
+        "results": results,
+    }
+    if args.output_file is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output_file, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+            output_file.write("\n")
+
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, args.baseline, args.max_slowdown)
+        if regressions:
+            logger.error("Slower than the baseline by more than %.0f%%: %s", 100 * args.max_slowdown,
+                         ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,279 @@
+"""
+Generates synthetic enhanced UD treebanks in the CoNLL-U format, for the benchmarks in
+`benchmarks/run_benchmarks.py`. The sentence lengths follow a log-normal distribution, the word
+forms and labels a Zipfian one; the enhanced graphs contain the basic tree plus extra heads, and
+optionally empty (elided) nodes and multi-word tokens. With `--system-output`, a noisy copy of the
+treebank is written as well, with the same tokens but perturbed trees and graphs, to be used as
+system output (e.g. by `scripts/iwpt21_xud_eval.py` and `scripts/connect_graph.py`).
+
+  python benchmarks/synthetic_conllu.py --sentences 2000 --output gold.conllu \
+      --system-output system.conllu --noise 0.1
+"""
+
+import argparse
+import math
+import random
+
+ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
+
+UPOS_TAGS = ["NOUN", "PUNCT", "VERB", "ADP", "DET", "PROPN", "ADJ", "PRON", "ADV", "AUX",
+             "CCONJ", "NUM", "SCONJ", "PART", "X", "SYM", "INTJ"]
+FEATS_VALUES = ["_", "Number=Sing", "Number=Plur", "Gender=Fem|Number=Sing", "Mood=Ind|Tense=Pres|VerbForm=Fin",
+                "Definite=Def|PronType=Art", "Case=Nom|Number=Sing|Person=3|PronType=Prs"]
+DEPRELS = ["punct", "case", "nmod", "det", "obl", "nsubj", "amod", "advmod", "conj", "obj", "cc", "mark",
+           "aux", "compound", "acl", "advcl", "cop", "xcomp", "flat", "nummod", "appos", "ccomp", "fixed",
+           "iobj", "parataxis", "expl", "csubj", "dep", "discourse", "orphan", "list", "vocative",
+           "goeswith", "reparandum", "dislocated", "clf"]
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "bu", "da", "fe", "gi", "ho", "ju", "pe"]
+
+
+def add_generator_arguments(parser):
+    """Adds the options of `generate_sentences` to an argument parser."""
+    parser.add_argument("--seed", type=int, default=1, help="The random seed.")
+    parser.add_argument("--mean-length", type=float, default=20.0, help="The mean number of words of a sentence.")
+    parser.add_argument("--length-sigma", type=float, default=0.6,
+                        help="The shape of the log-normal sentence length distribution.")
+    parser.add_argument("--max-length", type=int, default=120, help="The maximum number of words of a sentence.")
+    parser.add_argument("--vocab-size", type=int, default=5000, help="The number of distinct word forms.")
+    parser.add_argument("--num-labels", type=int, default=40,
+                        help="The number of dependency labels; subtypes are added beyond the universal ones.")
+    parser.add_argument("--multi-head-rate", type=float, default=0.15,
+                        help="The probability of a word having an extra head in the enhanced graph.")
+    parser.add_argument("--elided-rate", type=float, default=0.05,
+                        help="The probability of a sentence containing an empty (elided) node.")
+    parser.add_argument("--mwt-rate", type=float, default=0.02,
+                        help="The probability of a word starting a multi-word token.")
+
+
+def generator_options(args):
+    """The keyword arguments of `generate_sentences` from parsed `add_generator_arguments` options."""
+    return {
+        "seed": args.seed,
+        "mean_length": args.mean_length,
+        "length_sigma": args.length_sigma,
+        "max_length": args.max_length,
+        "vocab_size": args.vocab_size,
+        "num_labels": args.num_labels,
+        "multi_head_rate": args.multi_head_rate,
+        "elided_rate": args.elided_rate,
+        "mwt_rate": args.mwt_rate,
+    }
+
+
+def make_labels(num_labels):
+    """`num_labels` dependency labels: the universal relations, then subtypes of them."""
+    labels = DEPRELS[:num_labels]
+    subtype = 0
+    while len(labels) < num_labels:
+        labels.append(f"{DEPRELS[subtype % len(DEPRELS)]}:x{subtype // len(DEPRELS)}")
+        subtype += 1
+    return labels
+
+
+def make_forms(vocab_size, rng):
+    forms = set()
+    while len(forms) < vocab_size:
+        forms.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(forms)
+
+
+def zipf_weights(size):
+    """Cumulative weights of a Zipfian distribution over `size` items, for `random.choices`."""
+    weights = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1.0 / rank
+        weights.append(total)
+    return weights
+
+
+def _sentence_length(rng, mean_length, length_sigma, max_length):
+    mu = math.log(mean_length) - length_sigma ** 2 / 2
+    return max(1, min(max_length, int(round(rng.lognormvariate(mu, length_sigma)))))
+
+
+def _random_tree(rng, length):
+    """The heads of a random projective-ish tree over words 1..length, preferring short arcs."""
+    root = rng.randint(1, length)
+    heads = {root: 0}
+    attached = [root]
+    others = [word for word in range(1, length + 1) if word != root]
+    rng.shuffle(others)
+    for word in others:
+        weights = [1.0 / abs(word - head) for head in attached]
+        heads[word] = rng.choices(attached, weights)[0]
+        attached.append(word)
+    return heads
+
+
+def _format_deps(deps):
+    return "|".join(f"{head}:{label}" for head, label in sorted(deps, key=lambda edge: (float(edge[0]), edge[1])))
+
+
+def generate_sentence(rng, sentence_id, forms, form_weights, labels, label_weights, mean_length=20.0,
+                      length_sigma=0.6, max_length=120, multi_head_rate=0.15, elided_rate=0.05, mwt_rate=0.02):
+    """
+    One random sentence, as its comment lines and its CoNLL-U rows (lists of 10 columns) in
+    file order, including the multi-word token and empty node rows.
+    """
+    length = _sentence_length(rng, mean_length, length_sigma, max_length)
+    heads = _random_tree(rng, length)
+    words = rng.choices(forms, cum_weights=form_weights, k=length)
+
+    rows = {}
+    deps = {}
+    for word in range(1, length + 1):
+        head = heads[word]
+        deprel = "root" if head == 0 else rng.choices(labels, cum_weights=label_weights)[0]
+        upos = rng.choice(UPOS_TAGS)
+        rows[word] = [str(word), words[word - 1], words[word - 1].lower(), upos, upos,
+                      rng.choice(FEATS_VALUES), str(head), deprel, None, "_"]
+        deps[word] = [(str(head), deprel)]
+        if length > 2 and rng.random() < multi_head_rate:
+            extra_head = rng.randint(0, length)
+            if extra_head != word and extra_head != head:
+                deps[word].append((str(extra_head), rng.choices(labels, cum_weights=label_weights)[0]))
+
+    # an empty node after word `elided_after`, attached to a word and heading another word
+    elided_after = None
+    empty_row = None
+    if length > 2 and rng.random() < elided_rate:
+        elided_after = rng.randint(1, length - 1)
+        empty_id = f"{elided_after}.1"
+        empty_head = rng.randint(1, length)
+        empty_row = [empty_id, rng.choice(forms), "_", "VERB", "VERB", "_", "_", "_",
+                     _format_deps([(str(empty_head), "conj")]), "_"]
+        dependent = rng.choice([word for word in range(1, length + 1) if word != empty_head])
+        deps[dependent].append((empty_id, rng.choices(labels, cum_weights=label_weights)[0]))
+    for word in range(1, length + 1):
+        rows[word][DEPS] = _format_deps(deps[word])
+
+    output_rows = []
+    word = 1
+    while word <= length:
+        # multi-word tokens of two words, which don't span the empty node
+        if word < length and word != elided_after and rng.random() < mwt_rate:
+            output_rows.append([f"{word}-{word + 1}", rows[word][FORM] + rows[word + 1][FORM]] + ["_"] * 8)
+            output_rows.append(rows[word])
+            output_rows.append(rows[word + 1])
+            word += 2
+        else:
+            output_rows.append(rows[word])
+            word += 1
+        if empty_row is not None and word > elided_after:
+            output_rows.append(empty_row)
+            empty_row = None
+
+    comments = [f"# sent_id = synthetic-{sentence_id}", f"# text = {' '.join(_token_forms(output_rows))}"]
+    return comments, output_rows
+
+
+def _token_forms(rows):
+    """The forms of the tokens of a sentence, i.e. the multi-word tokens instead of their words."""
+    forms = []
+    covered_until = 0
+    for row in rows:
+        if "." in row[ID]:
+            continue
+        if "-" in row[ID]:
+            covered_until = int(row[ID].split("-")[1])
+            forms.append(row[FORM])
+        elif int(row[ID]) > covered_until:
+            forms.append(row[FORM])
+    return forms
+
+
+def generate_sentences(num_sentences, seed=1, mean_length=20.0, length_sigma=0.6, max_length=120,
+                       vocab_size=5000, num_labels=40, multi_head_rate=0.15, elided_rate=0.05, mwt_rate=0.02):
+    """Yields `num_sentences` random sentences, see `generate_sentence`."""
+    rng = random.Random(seed)
+    forms = make_forms(vocab_size, rng)
+    rng.shuffle(forms)
+    form_weights = zipf_weights(len(forms))
+    labels = make_labels(num_labels)
+    label_weights = zipf_weights(len(labels))
+    for sentence_id in range(1, num_sentences + 1):
+        yield generate_sentence(rng, sentence_id, forms, form_weights, labels, label_weights, mean_length,
+                                length_sigma, max_length, multi_head_rate, elided_rate, mwt_rate)
+
+
+def perturb_sentence(rows, rng, noise, labels):
+    """
+    A noisy copy of the rows of a sentence, as a parser could predict them: each word is
+    re-attached in the basic tree (outside of its own subtree, so it stays a tree) and each
+    enhanced edge gets a random head and label with probability `noise`.
+    """
+    rows = [list(row) for row in rows]
+    words = [row for row in rows if row[ID].isdigit()]
+    nodes = [row[ID] for row in rows if "-" not in row[ID]]
+    heads = {int(row[ID]): int(row[HEAD]) for row in words}
+    for row in words:
+        word = int(row[ID])
+        if heads[word] != 0 and rng.random() < noise:
+            subtree = {word}
+            changed = True
+            while changed:
+                changed = False
+                for dependent, head in heads.items():
+                    if head in subtree and dependent not in subtree:
+                        subtree.add(dependent)
+                        changed = True
+            candidates = [head for head in heads if head not in subtree]
+            if candidates:
+                heads[word] = rng.choice(candidates)
+                row[HEAD] = str(heads[word])
+                row[DEPREL] = rng.choice(labels)
+    for row in rows:
+        if "-" in row[ID] or row[DEPS] == "_":
+            continue
+        deps = []
+        for edge in row[DEPS].split("|"):
+            head, label = edge.split(":", 1)
+            if rng.random() < noise:
+                head = rng.choice(["0"] + [node for node in nodes if node != row[ID]])
+                label = rng.choice(labels)
+            if (head, label) not in deps:
+                deps.append((head, label))
+        row[DEPS] = _format_deps(deps)
+    return rows
+
+
+def write_sentence(conllu_file, comments, rows):
+    for comment in comments:
+        conllu_file.write(comment + "\n")
+    for row in rows:
+        conllu_file.write("\t".join(row) + "\n")
+    conllu_file.write("\n")
+
+
+def write_treebank(output, num_sentences, system_output=None, noise=0.1, **options):
+    """
+    Writes `num_sentences` random sentences to the file `output`, and a noisy copy of them to
+    `system_output` if given. `options` are passed to `generate_sentences`.
+    """
+    rng = random.Random(options.get("seed", 1) + 1)
+    labels = make_labels(options.get("num_labels", 40))
+    with open(output, "w", encoding="utf-8") as gold_file:
+        system_file = open(system_output, "w", encoding="utf-8") if system_output else None
+        try:
+            for comments, rows in generate_sentences(num_sentences, **options):
+                write_sentence(gold_file, comments, rows)
+                if system_file is not None:
+                    write_sentence(system_file, comments, perturb_sentence(rows, rng, noise, labels))
+        finally:
+            if system_file is not None:
+                system_file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates a synthetic enhanced UD treebank.")
+    parser.add_argument("--output", "-o", type=str, required=True, help="The CoNLL-U file to write.")
+    parser.add_argument("--sentences", "-n", type=int, default=1000, help="The number of sentences.")
+    parser.add_argument("--system-output", type=str, default=None,
+                        help="Also write a noisy copy of the treebank to this file, as system output.")
+    parser.add_argument("--noise", type=float, default=0.1,
+                        help="The probability of perturbing each basic head and enhanced edge of the system output.")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    write_treebank(args.output, args.sentences, args.system_output, args.noise, **generator_options(args))
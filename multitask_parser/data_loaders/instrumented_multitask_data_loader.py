@@ -0,0 +1,29 @@
+from typing import Iterator
+
+from overrides import overrides
+
+from allennlp.data.batch import Batch
+from allennlp.data.data_loaders.data_loader import DataLoader, TensorDict
+from allennlp.data.data_loaders.multitask_data_loader import MultiTaskDataLoader
+import allennlp.nn.util as nn_util
+
+from multitask_parser.training.stage_timer import get_active_stage_timer
+
+
+@DataLoader.register("instrumented_multitask")
+class InstrumentedMultiTaskDataLoader(MultiTaskDataLoader):
+    """
+    A `MultiTaskDataLoader` that times the collation of each batch (and its move to the GPU) as the
+    `collation` stage of the active `StageTimer`, i.e. the one of a `multitask_v2` model built with
+    `instrument_stages`. It takes the same parameters as the `multitask` data loader.
+    Registered as a `DataLoader` with name "instrumented_multitask".
+    """
+
+    @overrides
+    def __iter__(self) -> Iterator[TensorDict]:
+        epoch_instances = self._get_instances_for_epoch()
+        cuda_device = -1 if self.cuda_device is None else self.cuda_device
+        for instances in self.scheduler.batch_instances(epoch_instances):
+            with get_active_stage_timer().stage("collation"):
+                batch = nn_util.move_to_device(Batch(instances).as_tensor_dict(), cuda_device)
+            yield batch
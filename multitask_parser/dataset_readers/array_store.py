@@ -0,0 +1,116 @@
+"""
+A simple on-disk store for one numpy array per sentence.
+The arrays are flattened and appended to a single binary file which is memory-mapped
+when reading, while a small JSON index keeps track of the offset and shape of each array.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import logging
+import os
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def get_store_prefix(store_dir: str, data_file: str, name: str) -> str:
+    """
+    The path prefix (without extension) of the store called `name` for the sentences in `data_file`.
+    """
+    return os.path.join(store_dir, f"{os.path.basename(data_file)}.{name}")
+
+
+def _source_information(data_file: str) -> Dict[str, Any]:
+    stat = os.stat(data_file)
+    return {"source": os.path.abspath(data_file), "source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+class ArrayStoreWriter:
+    """
+    Appends one array per sentence to the store at `prefix`. The arrays are converted to `dtype`
+    before writing. Call `close` (or use as a context manager) to write the index.
+    The number of words of each sentence can be recorded alongside arrays whose first
+    dimension isn't the number of words, so readers can still check the alignment.
+    """
+
+    def __init__(self, prefix: str, dtype: str = "float16", data_file: str = None) -> None:
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._prefix = prefix
+        self._dtype = numpy.dtype(dtype)
+        self._data_file = data_file
+        self._binary_file = open(prefix + ".bin", "wb")
+        self._offsets: List[int] = []
+        self._shapes: List[Tuple[int, ...]] = []
+        self._num_words: List[int] = []
+        self._num_elements = 0
+
+    def append(self, array: numpy.ndarray, num_words: int = None) -> None:
+        array = numpy.ascontiguousarray(array, dtype=self._dtype)
+        if num_words is not None:
+            if len(self._num_words) != len(self._offsets):
+                raise ValueError("num_words must be given for either all or none of the arrays.")
+            self._num_words.append(num_words)
+        self._offsets.append(self._num_elements)
+        self._shapes.append(tuple(array.shape))
+        self._binary_file.write(array.tobytes())
+        self._num_elements += array.size
+
+    def close(self) -> None:
+        self._binary_file.close()
+        index = {"dtype": self._dtype.name, "offsets": self._offsets, "shapes": self._shapes}
+        if self._num_words:
+            index["num_words"] = self._num_words
+        if self._data_file is not None:
+            index.update(_source_information(self._data_file))
+        with open(self._prefix + ".json", "w") as index_file:
+            json.dump(index, index_file)
+        logger.info("Wrote %d arrays to %s", len(self._offsets), self._prefix)
+
+    def __enter__(self) -> "ArrayStoreWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ArrayStore:
+    """
+    Read-only, memory-mapped access to the arrays written by an `ArrayStoreWriter`.
+    Indexing returns the array of the i-th sentence with its original shape.
+    """
+
+    def __init__(self, prefix: str, data_file: str = None) -> None:
+        with open(prefix + ".json") as index_file:
+            index = json.load(index_file)
+        self._offsets = index["offsets"]
+        self._shapes = [tuple(shape) for shape in index["shapes"]]
+        self._num_words = index.get("num_words")
+        dtype = numpy.dtype(index["dtype"])
+        if os.path.getsize(prefix + ".bin") > 0:
+            self._data = numpy.memmap(prefix + ".bin", dtype=dtype, mode="r")
+        else:
+            self._data = numpy.zeros(0, dtype=dtype)
+
+        if data_file is not None and "source_size" in index:
+            current = _source_information(data_file)
+            if (current["source_size"], current["source_mtime"]) != (index["source_size"], index["source_mtime"]):
+                logger.warning(
+                    "%s has changed since the store at %s was written; the stored arrays may be out of date.",
+                    data_file, prefix,
+                )
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get_num_words(self, i: int) -> Optional[int]:
+        """
+        The number of words recorded for the i-th sentence, or `None` if the store doesn't record them.
+        """
+        return self._num_words[i] if self._num_words is not None else None
+
+    def __getitem__(self, i: int) -> numpy.ndarray:
+        shape = self._shapes[i]
+        start = self._offsets[i]
+        return self._data[start:start + int(numpy.prod(shape))].reshape(shape)
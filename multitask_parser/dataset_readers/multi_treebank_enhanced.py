@@ -0,0 +1,246 @@
+"""
+Reads several treebanks for one model by streaming from their own files, instead of training on
+a copy concatenated by `scripts/concat_treebanks.py`.
+"""
+from typing import Dict, Iterator, List, Optional, Tuple
+from collections import Counter
+import glob
+import logging
+import os
+import random
+
+from conllu import parse
+from overrides import overrides
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.file_utils import cached_path
+from allennlp.data.dataset_readers.dataset_reader import DatasetReader
+from allennlp.data.fields import LabelField, MetadataField
+from allennlp.data.instance import Instance
+
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.dataset_readers.universal_dependencies_enhanced import UniversalDependenciesEnhancedDatasetReader
+from multitask_parser.file_utils import strip_compression_extension
+
+logger = logging.getLogger(__name__)
+
+
+def get_treebank_id(file_path: str) -> str:
+    """
+    The treebank id of a UD file, e.g. "fr_sequoia" for ".../fr_sequoia-ud-train.conllu".
+    """
+    return os.path.basename(strip_compression_extension(file_path)).split("-")[0]
+
+
+def temperature_sampling_counts(
+    sizes: Dict[str, int], temperature: float, budget: int, cap: int = None
+) -> Dict[str, int]:
+    """
+    The number of sentences to sample from each treebank for an epoch of `budget` sentences, with
+    probabilities proportional to `size ** (1 / temperature)`: 1 samples in proportion to the sizes,
+    higher temperatures flatten the distribution towards uniform, so small treebanks are seen more
+    often. Treebanks larger than `cap` count as `cap` sentences, and no treebank gets more than
+    `cap` sentences, so the epoch can be shorter than `budget`.
+    """
+    capped = {tbid: min(size, cap) if cap is not None else size for tbid, size in sizes.items()}
+    weights = {tbid: size ** (1.0 / temperature) if size > 0 else 0.0 for tbid, size in capped.items()}
+    total_weight = sum(weights.values())
+    if total_weight == 0:
+        return {tbid: 0 for tbid in sizes}
+    # largest remainder rounding, so that the counts add up to the budget
+    exact = {tbid: budget * weight / total_weight for tbid, weight in weights.items()}
+    counts = {tbid: int(value) for tbid, value in exact.items()}
+    remainders = sorted(exact, key=lambda tbid: exact[tbid] - counts[tbid], reverse=True)
+    for tbid in remainders[:budget - sum(counts.values())]:
+        counts[tbid] += 1
+    if cap is not None:
+        counts = {tbid: min(count, cap) for tbid, count in counts.items()}
+    return counts
+
+
+@DatasetReader.register("multi_treebank_enhanced")
+class MultiTreebankEnhancedDatasetReader(UniversalDependenciesEnhancedDatasetReader):
+    """
+    Reads the sentences of several treebanks from their original files, which are given as a
+    comma-separated list of paths or glob patterns, e.g.
+    `"data/train-dev/UD_English-EWT/en_ewt-ud-train.conllu,data/train-dev/UD_English-GUM/en_gum-ud-train.conllu"`.
+    The treebank id of each file is the part of its name before the first "-" (`get_treebank_id`).
+
+    With `sampling`, each epoch samples `instances_per_epoch` sentences from the treebanks with the
+    temperature and the caps of `temperature_sampling_counts`. The sentences of a treebank are
+    drawn in a random order without replacement until all of them have been seen, over as many
+    epochs as it takes, and small treebanks are repeated when they are sampled more often than
+    their size. The treebanks are interleaved at random, and the sentences of each treebank are
+    yielded in their sampled order. Each file is still read forwards with its `SentenceIndex`, which
+    is fast even when it is compressed: the distinct sampled sentences are read in the order of the
+    file and their text is kept in memory until they have been yielded, so a sentence sampled
+    several times is only read once.
+    Without `sampling` (e.g. for the `validation_dataset_reader`), every sentence of every treebank
+    is read once, treebank by treebank.
+
+    The epoch is set with `set_epoch` by the `treebank_sampling` trainer callback, so that it is the
+    same in every data loader worker. Until it is set, e.g. when the vocabulary is built, every
+    sentence of every treebank is read, so the vocabulary covers the whole treebanks even with caps.
+    Instances are only resampled when they are read again, so set `max_instances_in_memory` on the
+    data loader for a new sample every epoch.
+
+    Each instance's metadata records its treebank id as `treebank`.
+    # Parameters
+    sampling : ``bool``, optional (default = True)
+    temperature : ``float``, optional (default = 1.0)
+        The sampling temperature: 1 for proportional sampling, e.g. 5 to favour small treebanks.
+    max_instances_per_treebank : ``int``, optional (default = None)
+        The maximum number of sentences sampled from a treebank per epoch.
+    instances_per_epoch : ``int``, optional (default = None)
+        The number of sentences sampled per epoch, by default the total size of the treebanks
+        (each capped at `max_instances_per_treebank`).
+    treebank_field_name : ``str``, optional (default = None)
+        If given, the treebank id is also added to the instances as a `LabelField` of this name (in
+        the "treebank_ids" namespace), e.g. for treebank embeddings. The model must accept it.
+    route_by_treebank : ``bool``, optional (default = False)
+        If True, the treebank id is added as the "task" field, so that `multitask_v2` passes each
+        sentence to the head named after its treebank. The `multitask` dataset reader overwrites this
+        field, so this is for models trained with this reader directly.
+    seed : ``int``, optional (default = 13370)
+        The seed of the sampling, which must be the same in all workers and distributed processes.
+    Other parameters are those of `universal_dependencies_enhanced`; the sentence index is always used.
+    """
+    def __init__(
+        self,
+        sampling: bool = True,
+        temperature: float = 1.0,
+        max_instances_per_treebank: int = None,
+        instances_per_epoch: int = None,
+        treebank_field_name: str = None,
+        route_by_treebank: bool = False,
+        seed: int = 13370,
+        **kwargs,
+    ) -> None:
+        if temperature <= 0:
+            raise ConfigurationError(f"temperature must be positive, not {temperature}")
+        kwargs["use_sentence_index"] = True
+        super().__init__(**kwargs)
+        self._sampling = sampling
+        self._temperature = temperature
+        self._max_instances_per_treebank = max_instances_per_treebank
+        self._instances_per_epoch = instances_per_epoch
+        self._treebank_field_name = treebank_field_name
+        self._route_by_treebank = route_by_treebank
+        self._seed = seed
+        self._epoch: Optional[int] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch to sample. It must be set in the main process before the data loader starts
+        its workers, see `TreebankSamplingCallback`.
+        """
+        self._epoch = epoch
+
+    def _treebank_files(self, file_path: str) -> Dict[str, str]:
+        treebank_files: Dict[str, str] = {}
+        for pattern in file_path.split(","):
+            pattern = pattern.strip()
+            if not pattern:
+                continue
+            # a pattern without matches may be a URL
+            for path in sorted(glob.glob(pattern)) or [cached_path(pattern)]:
+                tbid = get_treebank_id(path)
+                if tbid in treebank_files:
+                    raise ConfigurationError(
+                        f"{path} and {treebank_files[tbid]} have the same treebank id {tbid}"
+                    )
+                treebank_files[tbid] = path
+        if not treebank_files:
+            raise ConfigurationError(f"No treebank files in {file_path}")
+        return treebank_files
+
+    def _sampled_sentence_ids(self, tbid: str, size: int, start: int, count: int) -> List[int]:
+        # the positions start ... start + count - 1 of an endless sequence of shuffled passes over
+        # the treebank, so each epoch continues where the previous one stopped
+        sentence_ids = []
+        permutation_number = None
+        for position in range(start, start + count):
+            if position // size != permutation_number:
+                permutation_number = position // size
+                permutation = list(range(size))
+                random.Random(f"{self._seed}-{tbid}-{permutation_number}").shuffle(permutation)
+            sentence_ids.append(permutation[position % size])
+        return sentence_ids
+
+    def _plan_epoch(self, indices: Dict[str, SentenceIndex], epoch: Optional[int]) -> List[Tuple[str, int]]:
+        """
+        The (treebank id, sentence number) pairs of the sentences to read in this epoch, in order.
+        """
+        if self._sampling and epoch is None:
+            logger.warning(
+                "No sampling epoch is set, so every sentence of the treebanks is read. This is expected "
+                "when building the vocabulary; to sample the training epochs, add the "
+                "treebank_sampling callback to the trainer."
+            )
+        if not self._sampling or epoch is None:
+            return [(tbid, sentence_id) for tbid, index in indices.items() for sentence_id in range(len(index))]
+
+        sizes = {tbid: len(index) for tbid, index in indices.items()}
+        cap = self._max_instances_per_treebank
+        budget = self._instances_per_epoch
+        if budget is None:
+            budget = sum(min(size, cap) if cap is not None else size for size in sizes.values())
+        counts = temperature_sampling_counts(sizes, self._temperature, budget, cap)
+        if epoch == 0:
+            logger.info("Sampling %s sentences per epoch from the treebanks", counts)
+
+        order = [tbid for tbid, count in counts.items() for _ in range(count)]
+        random.Random(f"{self._seed}-{epoch}").shuffle(order)
+        sentence_ids = {
+            tbid: iter(self._sampled_sentence_ids(tbid, sizes[tbid], epoch * count, count))
+            for tbid, count in counts.items() if count > 0
+        }
+        return [(tbid, next(sentence_ids[tbid])) for tbid in order]
+
+    @overrides
+    def _read(self, file_path: str):
+        treebank_files = self._treebank_files(file_path)
+        indices = {
+            tbid: SentenceIndex.load_or_build(path, index_dir=self._sentence_index_dir)
+            for tbid, path in treebank_files.items()
+        }
+        plan = list(self.shard_iterable(self._plan_epoch(indices, self._epoch)))
+
+        # one forward stream over the distinct sentences of this shard per treebank. The stream is
+        # read ahead until it reaches the next planned sentence, and the text of the sentences read
+        # on the way is kept until all of their (repeated) uses have been yielded
+        remaining_uses: Dict[str, Counter] = {tbid: Counter() for tbid in indices}
+        for tbid, sentence_id in plan:
+            remaining_uses[tbid][sentence_id] += 1
+        sentence_ids = {tbid: sorted(uses) for tbid, uses in remaining_uses.items() if uses}
+        streams: Dict[str, Iterator[str]] = {
+            tbid: indices[tbid].read_sentences(ids) for tbid, ids in sentence_ids.items()
+        }
+        next_positions = {tbid: 0 for tbid in sentence_ids}
+        read_sentences: Dict[str, Dict[int, str]] = {tbid: {} for tbid in indices}
+        try:
+            for tbid, sentence_id in plan:
+                sentences = read_sentences[tbid]
+                while sentence_id not in sentences:
+                    sentences[sentence_ids[tbid][next_positions[tbid]]] = next(streams[tbid])
+                    next_positions[tbid] += 1
+                remaining_uses[tbid][sentence_id] -= 1
+                if remaining_uses[tbid][sentence_id] == 0:
+                    sentence = sentences.pop(sentence_id)
+                else:
+                    sentence = sentences[sentence_id]
+                for annotation in parse(sentence):
+                    instance = self._annotation_to_instance(annotation)
+                    if instance is not None:
+                        yield self._tag_instance(instance, tbid)
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+    def _tag_instance(self, instance: Instance, tbid: str) -> Instance:
+        instance["metadata"].metadata.treebank = tbid
+        if self._treebank_field_name is not None:
+            instance.add_field(self._treebank_field_name, LabelField(tbid, label_namespace="treebank_ids"))
+        if self._route_by_treebank:
+            instance.add_field("task", MetadataField(tbid))
+        return instance
@@ -0,0 +1,275 @@
+"""
+A sidecar index of the sentences of a CoNLL-U file: the byte offset, the number of words and
+(optionally) the number of wordpieces of each sentence. It lets readers seek directly to the
+sentences of their shard, and gives the length distribution of a treebank without parsing it.
+The index is stored next to the data file (or in `index_dir`) as `<data file>.sentence_index.json`
+and is rebuilt when the data file changes.
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import hashlib
+import json
+import logging
+import os
+
+from conllu import parse
+from conllu.models import TokenList
+import numpy
+
+from multitask_parser.file_utils import open_binary
+
+logger = logging.getLogger(__name__)
+
+# Version of the index format; increase it when the format or the counts change.
+SENTENCE_INDEX_VERSION = 1
+
+
+def get_sentence_index_path(data_file: str, index_dir: str = None) -> str:
+    """
+    The path of the sentence index of `data_file`, in `index_dir` or next to the data file.
+    """
+    directory = index_dir if index_dir is not None else os.path.dirname(data_file)
+    return os.path.join(directory, f"{os.path.basename(data_file)}.sentence_index.json")
+
+
+def _file_sha1(data_file: str) -> str:
+    digest = hashlib.sha1()
+    with open_binary(data_file) as binary_file:
+        for chunk in iter(lambda: binary_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_word_line(line: bytes) -> bool:
+    # multiword token ranges (1-2) are not words; empty nodes (8.1) are, as in the readers
+    return not line.startswith(b"#") and b"-" not in line.split(b"\t", 1)[0]
+
+
+class SentenceIndex:
+    """
+    The byte offset (in the decompressed file), the number of words and optionally the number of
+    wordpieces of each sentence of a CoNLL-U file. Use `SentenceIndex.load_or_build` to reuse the
+    sidecar index of a file when it is up to date.
+    # Parameters
+    data_file : `str`
+        The indexed CoNLL-U file, which may be compressed (see `multitask_parser.file_utils`).
+    offsets : `numpy.ndarray`
+        The byte offset of the first line (comment or word) of each sentence.
+    num_words : `numpy.ndarray`
+        The number of words of each sentence, excluding multiword tokens.
+    num_wordpieces : `numpy.ndarray`, optional (default = `None`)
+        The number of wordpieces of each sentence with the tokenizer of `transformer_model_name`,
+        including the special tokens, i.e. the length of the input of the transformer.
+    transformer_model_name : `str`, optional (default = `None`)
+    source : `Dict[str, Any]`, optional (default = `None`)
+        The size, modification time and SHA-1 of the data file when it was indexed.
+    """
+
+    def __init__(
+        self,
+        data_file: str,
+        offsets: numpy.ndarray,
+        num_words: numpy.ndarray,
+        num_wordpieces: numpy.ndarray = None,
+        transformer_model_name: str = None,
+        source: Dict[str, Any] = None,
+    ) -> None:
+        self.data_file = data_file
+        self.offsets = offsets
+        self.num_words = num_words
+        self.num_wordpieces = num_wordpieces
+        self.transformer_model_name = transformer_model_name
+        self.source = source or {}
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @classmethod
+    def build(cls, data_file: str, transformer_model_name: str = None) -> "SentenceIndex":
+        """
+        Indexes `data_file` in one pass over its lines, counting the wordpieces of the words with
+        the tokenizer of `transformer_model_name` if it is given.
+        """
+        tokenizer = None
+        if transformer_model_name is not None:
+            from allennlp.common import cached_transformers
+
+            tokenizer = cached_transformers.get_tokenizer(transformer_model_name)
+            num_special_tokens = tokenizer.num_special_tokens_to_add()
+
+        offsets: List[int] = []
+        num_words: List[int] = []
+        num_wordpieces: List[int] = []
+        digest = hashlib.sha1()
+        stat = os.stat(data_file)
+
+        offset = 0
+        sentence_start = None
+        words = 0
+        wordpieces = 0
+        with open_binary(data_file) as binary_file:
+            for line in binary_file:
+                digest.update(line)
+                if line.isspace():
+                    if sentence_start is not None:
+                        offsets.append(sentence_start)
+                        num_words.append(words)
+                        num_wordpieces.append(wordpieces + num_special_tokens if tokenizer else 0)
+                        sentence_start = None
+                else:
+                    if sentence_start is None:
+                        sentence_start = offset
+                        words = 0
+                        wordpieces = 0
+                    if _is_word_line(line):
+                        words += 1
+                        if tokenizer is not None:
+                            form = line.split(b"\t", 2)[1].decode("utf-8")
+                            # a word is at least one wordpiece, as with the mismatched token indexer
+                            wordpieces += max(1, len(tokenizer.tokenize(form)))
+                offset += len(line)
+        # the last sentence may not be followed by an empty line
+        if sentence_start is not None:
+            offsets.append(sentence_start)
+            num_words.append(words)
+            num_wordpieces.append(wordpieces + num_special_tokens if tokenizer else 0)
+
+        logger.info("Indexed %d sentences of %s", len(offsets), data_file)
+        return cls(
+            data_file,
+            numpy.array(offsets, dtype=numpy.int64),
+            numpy.array(num_words, dtype=numpy.int32),
+            numpy.array(num_wordpieces, dtype=numpy.int32) if tokenizer is not None else None,
+            transformer_model_name,
+            {"source_size": stat.st_size, "source_mtime": stat.st_mtime, "source_sha1": digest.hexdigest()},
+        )
+
+    def save(self, index_path: str) -> None:
+        index = {
+            "version": SENTENCE_INDEX_VERSION,
+            **self.source,
+            "transformer_model_name": self.transformer_model_name,
+            "offsets": self.offsets.tolist(),
+            "num_words": self.num_words.tolist(),
+        }
+        if self.num_wordpieces is not None:
+            index["num_wordpieces"] = self.num_wordpieces.tolist()
+        # written to a temporary file first, so that readers never see half an index
+        temporary_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temporary_path, index_path)
+
+    @classmethod
+    def load(cls, data_file: str, index_path: str) -> "SentenceIndex":
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index.get("version") != SENTENCE_INDEX_VERSION:
+            raise ValueError(f"{index_path} has version {index.get('version')}, not {SENTENCE_INDEX_VERSION}")
+        num_wordpieces = index.get("num_wordpieces")
+        return cls(
+            data_file,
+            numpy.array(index["offsets"], dtype=numpy.int64),
+            numpy.array(index["num_words"], dtype=numpy.int32),
+            numpy.array(num_wordpieces, dtype=numpy.int32) if num_wordpieces is not None else None,
+            index["transformer_model_name"],
+            {key: index[key] for key in ("source_size", "source_mtime", "source_sha1")},
+        )
+
+    def is_up_to_date(self) -> bool:
+        """
+        Whether the data file is unchanged since it was indexed. The modification time is checked
+        first, and the contents only when it differs (e.g. for a copied file).
+        """
+        stat = os.stat(self.data_file)
+        if stat.st_size != self.source.get("source_size"):
+            return False
+        if stat.st_mtime == self.source.get("source_mtime"):
+            return True
+        if _file_sha1(self.data_file) != self.source.get("source_sha1"):
+            return False
+        self.source["source_mtime"] = stat.st_mtime
+        return True
+
+    @classmethod
+    def load_or_build(
+        cls, data_file: str, transformer_model_name: str = None, index_dir: str = None
+    ) -> "SentenceIndex":
+        """
+        Loads the sidecar index of `data_file` if it is up to date and has the wordpiece counts of
+        `transformer_model_name` (if given), and otherwise builds and saves it. If the index cannot
+        be saved, e.g. in a read-only data directory, it is only kept in memory.
+        """
+        index_path = get_sentence_index_path(data_file, index_dir)
+        index = None
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(data_file, index_path)
+            except (ValueError, KeyError) as error:
+                logger.warning("Ignoring the sentence index at %s: %s", index_path, error)
+        if index is not None:
+            mtime = index.source.get("source_mtime")
+            if transformer_model_name is not None and index.transformer_model_name != transformer_model_name:
+                index = None
+            elif not index.is_up_to_date():
+                logger.info("%s has changed since it was indexed", data_file)
+                index = None
+            elif index.source["source_mtime"] != mtime:
+                # the contents are unchanged, so the modification time is updated to skip the hash next time
+                cls._try_save(index, index_path)
+        if index is None:
+            index = cls.build(data_file, transformer_model_name)
+            cls._try_save(index, index_path)
+        return index
+
+    @staticmethod
+    def _try_save(index: "SentenceIndex", index_path: str) -> None:
+        try:
+            index.save(index_path)
+        except OSError as error:
+            logger.warning("Could not save the sentence index to %s: %s", index_path, error)
+
+    def read_sentences(self, sentence_ids: Iterable[int]) -> Iterator[str]:
+        """
+        Yields the CoNLL-U text of the sentences with the given (0-based) numbers, seeking directly
+        to each of them. Ascending numbers are the fastest, especially in compressed files.
+        """
+        with open_binary(self.data_file) as binary_file:
+            position = 0
+            for sentence_id in sentence_ids:
+                offset = int(self.offsets[sentence_id])
+                if offset != position:
+                    binary_file.seek(offset)
+                lines = []
+                for line in binary_file:
+                    if line.isspace():
+                        break
+                    lines.append(line)
+                position = binary_file.tell()
+                yield b"".join(lines).decode("utf-8") + "\n"
+
+    def parse_sentences(self, sentence_ids: Iterable[int]) -> Iterator[TokenList]:
+        """
+        Like `read_sentences`, but yields the sentences parsed by `conllu`, as `parse_incr` does.
+        """
+        for sentence in self.read_sentences(sentence_ids):
+            yield from parse(sentence)
+
+    def lengths(self, wordpieces: bool = False) -> numpy.ndarray:
+        if not wordpieces:
+            return self.num_words
+        if self.num_wordpieces is None:
+            raise ValueError(f"The sentence index of {self.data_file} has no wordpiece counts")
+        return self.num_wordpieces
+
+    def length_histogram(self, bin_width: int = 10, wordpieces: bool = False) -> Dict[int, int]:
+        """
+        The number of sentences in each length bin, keyed by the lower bound of the bin,
+        in words or, with `wordpieces`, in wordpieces.
+        """
+        lengths = self.lengths(wordpieces)
+        bins, counts = numpy.unique(lengths // bin_width * bin_width, return_counts=True)
+        return {int(lower): int(count) for lower, count in zip(bins, counts)}
+
+    def percentile(self, q: float, wordpieces: bool = False) -> Optional[float]:
+        lengths = self.lengths(wordpieces)
+        return float(numpy.percentile(lengths, q)) if len(lengths) else None
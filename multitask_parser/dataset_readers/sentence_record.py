@@ -0,0 +1,72 @@
+"""
+A compact record of the columns of a sentence which are not converted to tensors, kept in the
+`metadata` field of the instances of `universal_dependencies_enhanced`.
+"""
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Sequence
+
+# the columns that the predictors need to write a sentence back to CoNLL-U
+PREDICTION_FIELDS = (
+    "conllu_metadata", "ids", "words", "lemmas", "upos", "xpos", "feats", "head_tags",
+    "head_indices", "original_to_new_indices", "misc", "multiword_ids", "multiword_forms",
+)
+
+
+class SentenceRecord(Mapping):
+    """
+    The metadata of a sentence, which can be read like the dictionary it replaces
+    (e.g. `record["words"]`) but takes less memory for a whole treebank:
+    it has no per-instance dictionary (`__slots__`), its lists are shared by reference with the
+    label fields of the instance, and `labeled_arcs` is derived from `arc_indices` and `arc_tags`
+    when it is read instead of being stored. With the `lean_metadata` option of the reader, only
+    `arc_indices` and `arc_tags` are set and the other columns are `None`.
+    """
+
+    __slots__ = (
+        "words", "lemmas", "upos", "xpos", "feats", "ids", "misc", "original_to_new_indices",
+        "head_tags", "head_indices", "predicted_head_tags", "predicted_head_indices",
+        "arc_indices", "arc_tags", "multiword_ids", "multiword_forms", "conllu_metadata", "treebank",
+    )
+
+    _keys = __slots__ + ("labeled_arcs",)
+
+    def __init__(self, **columns: Any) -> None:
+        unknown = set(columns) - set(self.__slots__)
+        if unknown:
+            raise TypeError(f"Unknown sentence columns: {sorted(unknown)}")
+        for name in self.__slots__:
+            setattr(self, name, columns.get(name))
+
+    @property
+    def labeled_arcs(self) -> List[Any]:
+        if self.arc_indices is None:
+            return None
+        return list(zip(self.arc_indices, self.arc_tags))
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self) -> str:
+        return f"SentenceRecord(words={self.words!r})"
+
+
+def prediction_outputs(metadata: Sequence[Mapping]) -> Dict[str, List[Any]]:
+    """
+    The columns of a batch of sentences that the predictors need, one list per column.
+    """
+    return {name: [meta[name] for meta in metadata if name in meta] for name in PREDICTION_FIELDS}
@@ -2,11 +2,12 @@
 # https://github.com/Hyperparticle/udify/blob/master/udify/dataset_readers/universal_dependencies.py
 # under MIT License.
 
-from typing import Dict, Tuple, List, Any, Callable
+from typing import Dict, Tuple, List, Any, Callable, Iterator, Optional
 import logging
 
 from overrides import overrides
 from conllu import parse_incr
+from conllu.models import TokenList
 
 from allennlp.common.file_utils import cached_path
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
@@ -15,6 +16,9 @@ from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Token, Tokenizer
 
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.file_utils import open_conllu
+
 logger = logging.getLogger(__name__)
 
 
@@ -59,15 +63,27 @@ class UniversalDependenciesAllFeaturesDatasetReader(DatasetReader):
     tokenizer : `Tokenizer`, optional (default = `None`)
         A tokenizer to use to split the text. This is useful when the tokens that you pass
         into the model need to have some particular attribute. Typically it is not necessary.
+    use_sentence_index : `bool`, optional (default = `False`)
+        If True, each data loader worker and distributed process seeks directly to the sentences of
+        its shard with the sidecar `SentenceIndex` of the file.
+    sentence_index_dir : `str`, optional (default = `None`)
+        The directory of the sentence indices, if not next to the data files.
     """
 
     def __init__(
         self,
         token_indexers: Dict[str, TokenIndexer] = None,
         tokenizer: Tokenizer = None,
+        use_sentence_index: bool = False,
+        sentence_index_dir: str = None,
         **kwargs,
     ) -> None:
+        if use_sentence_index:
+            kwargs["manual_distributed_sharding"] = True
+            kwargs["manual_multiprocess_sharding"] = True
         super().__init__(**kwargs)
+        self._use_sentence_index = use_sentence_index
+        self._sentence_index_dir = sentence_index_dir
         self._token_indexers = token_indexers or {"tokens": SingleIdTokenIndexer()}
 
         self.tokenizer = tokenizer
@@ -77,49 +93,61 @@ class UniversalDependenciesAllFeaturesDatasetReader(DatasetReader):
         # if `file_path` is a URL, redirect to the cache
         file_path = cached_path(file_path)
 
-        with open(file_path, "r") as conllu_file:
-            logger.info("Reading UD instances from conllu dataset at: %s", file_path)
-
-            for annotation in parse_incr(conllu_file):
-                annotation = process_multiword_and_elided_tokens(annotation)
-                multiword_tokens = [x for x in annotation if x["multi_id"] is not None]
-                # considers all tokens except MWTs and elided tokens for prediction
-                annotation = [x for x in annotation if x["id"] is not None]
-
-                if len(annotation) == 0:
-                    continue
-
-                def get_field(
-                            tag: str,
-                            map_fn: Callable[[Any], Any] = None,
-                            ) -> List[Any]:
-                    map_fn = map_fn if map_fn is not None else lambda x: x
-                    return [map_fn(x[tag]) if x[tag] is not None else "_" for x in annotation if tag in x]
-
-                # Extract multiword token rows (not used for prediction, purely for evaluation)
-                ids = [x["id"] for x in annotation]
-                multiword_ids = [x["multi_id"] for x in multiword_tokens]
-                multiword_forms = [x["form"] for x in multiword_tokens]
-                
-                words = get_field("form")
-                lemmas = get_field("lemma")
-                upos_tags = get_field("upos")
-                xpos_tags = get_field("xpos")
-                
-                feats = get_field("feats", lambda x: "|".join(k + "=" + v for k, v in x.items())
-                                     if hasattr(x, "items") else "_")
-                
-                heads = get_field("head")
-                dep_rels = get_field("deprel")
-                deps = get_field("deps")
-                dependencies = list(zip(dep_rels, heads))
-
-                misc = get_field("misc", lambda x: "|".join(k + "=" + v if v is not None else k + "=" + "" for k, v in x.items())
-                                    if hasattr(x, "items") else "_")
-
-                yield self.text_to_instance(words, lemmas, upos_tags, xpos_tags,
-                                            feats, dependencies, ids,
-                                            multiword_ids, multiword_forms)
+        logger.info("Reading UD instances from conllu dataset at: %s", file_path)
+        for annotation in self._read_annotations(file_path):
+            instance = self._annotation_to_instance(annotation)
+            if instance is not None:
+                yield instance
+
+    def _read_annotations(self, file_path: str) -> Iterator[TokenList]:
+        if self._use_sentence_index:
+            # each worker seeks to the sentences of its shard instead of parsing the whole file
+            index = SentenceIndex.load_or_build(file_path, index_dir=self._sentence_index_dir)
+            yield from index.parse_sentences(self.shard_iterable(range(len(index))))
+        else:
+            with open_conllu(file_path) as conllu_file:
+                yield from parse_incr(conllu_file)
+
+    def _annotation_to_instance(self, annotation: TokenList) -> Optional[Instance]:
+        annotation = process_multiword_and_elided_tokens(annotation)
+        multiword_tokens = [x for x in annotation if x["multi_id"] is not None]
+        # considers all tokens except MWTs and elided tokens for prediction
+        annotation = [x for x in annotation if x["id"] is not None]
+
+        if len(annotation) == 0:
+            return None
+
+        def get_field(
+                    tag: str,
+                    map_fn: Callable[[Any], Any] = None,
+                    ) -> List[Any]:
+            map_fn = map_fn if map_fn is not None else lambda x: x
+            return [map_fn(x[tag]) if x[tag] is not None else "_" for x in annotation if tag in x]
+
+        # Extract multiword token rows (not used for prediction, purely for evaluation)
+        ids = [x["id"] for x in annotation]
+        multiword_ids = [x["multi_id"] for x in multiword_tokens]
+        multiword_forms = [x["form"] for x in multiword_tokens]
+
+        words = get_field("form")
+        lemmas = get_field("lemma")
+        upos_tags = get_field("upos")
+        xpos_tags = get_field("xpos")
+
+        feats = get_field("feats", lambda x: "|".join(k + "=" + v for k, v in x.items())
+                             if hasattr(x, "items") else "_")
+
+        heads = get_field("head")
+        dep_rels = get_field("deprel")
+        deps = get_field("deps")
+        dependencies = list(zip(dep_rels, heads))
+
+        misc = get_field("misc", lambda x: "|".join(k + "=" + v if v is not None else k + "=" + "" for k, v in x.items())
+                            if hasattr(x, "items") else "_")
+
+        return self.text_to_instance(words, lemmas, upos_tags, xpos_tags,
+                                     feats, dependencies, ids,
+                                     multiword_ids, multiword_forms)
 
     @overrides
     def text_to_instance(
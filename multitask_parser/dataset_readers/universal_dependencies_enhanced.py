@@ -14,16 +14,21 @@
 based on the `universal_dependencies` dataset reader in: https://github.com/allenai/allennlp-models/blob/master/allennlp_models/structured_prediction/dataset_readers/universal_dependencies.py
 and the implementation in: https://github.com/Hyperparticle/udify/blob/master/udify/dataset_readers/universal_dependencies.py
 """
-from typing import Dict, Tuple, List, Any, Callable
+from typing import Dict, Tuple, List, Any, Callable, Iterator, Optional
 import logging
+import sys
 
 from overrides import overrides
 from conllu import parse_incr
+from conllu.models import TokenList
 
 from allennlp.common.file_utils import cached_path
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.fields import Field, LabelField, ListField, TextField, SequenceLabelField, MetadataField
 from multitask_parser.fields.rooted_adjacency_field import RootedAdjacencyField
+from multitask_parser.dataset_readers.sentence_record import SentenceRecord
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.file_utils import open_conllu
 from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Token, Tokenizer
@@ -69,18 +74,39 @@ class UniversalDependenciesEnhancedDatasetReader(DatasetReader):
     tokenizer : ``Tokenizer``, optional, default = None
         A tokenizer to use to split the text. This is useful when the tokens that you pass
         into the model need to have some particular attribute. Typically it is not necessary.
+    use_sentence_index : ``bool``, optional (default = False)
+        If True, the sentences are read through the sidecar `SentenceIndex` of the file (which is
+        built on the first read), and each data loader worker and distributed process seeks directly
+        to the sentences of its shard instead of parsing the whole file.
+    sentence_index_dir : ``str``, optional (default = None)
+        The directory of the sentence indices, if not next to the data files.
+    lean_metadata : ``bool``, optional (default = False)
+        If True, the `SentenceRecord` of each instance only keeps the gold enhanced arcs
+        (`arc_indices` and `arc_tags`), which is all that the training and validation metrics read,
+        and the other columns are `None`. This is meant for the training `dataset_reader`: the
+        predictors turn it off on their dataset reader, so that the sentences they read have the
+        full record needed to write them back to CoNLL-U.
     """
     def __init__(
         self,
         token_indexers: Dict[str, TokenIndexer] = None,
         tokenizer: Tokenizer = None,
         read_predicted_from_misc: bool = False,
+        use_sentence_index: bool = False,
+        sentence_index_dir: str = None,
+        lean_metadata: bool = False,
         **kwargs,
     ) -> None:
+        if use_sentence_index:
+            kwargs["manual_distributed_sharding"] = True
+            kwargs["manual_multiprocess_sharding"] = True
         super().__init__(**kwargs)
+        self._use_sentence_index = use_sentence_index
+        self._sentence_index_dir = sentence_index_dir
         self._token_indexers = token_indexers or {"tokens": SingleIdTokenIndexer()}
         self.tokenizer = tokenizer
         self.read_predicted_from_misc = read_predicted_from_misc
+        self.lean_metadata = lean_metadata
 
     def _convert_deps_to_nested_sequences(self, deps):
         """
@@ -190,59 +216,75 @@ class UniversalDependenciesEnhancedDatasetReader(DatasetReader):
         # if `file_path` is a URL, redirect to the cache
         file_path = cached_path(file_path)
 
-        with open(file_path, "r") as conllu_file:
-            logger.info("Reading UD instances from conllu dataset at: %s", file_path)
-
-            for annotation in parse_incr(conllu_file):
-                conllu_metadata = []
-                metadata = annotation.metadata
-                for k, v in metadata.items():
-                    metadata_line = (f"# {k} = {v}")
-                    conllu_metadata.append(metadata_line)
-
-                self.contains_elided_token = False
-                annotation = process_multiword_and_elided_tokens(annotation)
-                multiword_tokens = [x for x in annotation if x["multi_id"] is not None]
-                elided_tokens = [x for x in annotation if x["elided_id"] is not None]
-                if len(elided_tokens) >= 1:
-                    self.contains_elided_token = True
-
-                # considers all tokens except MWTs for prediction
-                annotation = [x for x in annotation if x["id"] is not None]
-
-                if len(annotation) == 0:
-                    continue
-
-                def get_field(
-                            tag: str,
-                            map_fn: Callable[[Any], Any] = None,
-                            ) -> List[Any]:
-                    map_fn = map_fn if map_fn is not None else lambda x: x
-                    return [map_fn(x[tag]) if x[tag] is not None else "_" for x in annotation if tag in x]
-
-                # Extract multiword token rows (not used for prediction, purely for evaluation)
-                ids = [x["id"] for x in annotation]
-                multiword_ids = [x["multi_id"] for x in multiword_tokens]
-                multiword_forms = [x["form"] for x in multiword_tokens]
-
-                words = get_field("form")
-                lemmas = get_field("lemma")
-                upos_tags = get_field("upos")
-                xpos_tags = get_field("xpos")
-                feats = get_field("feats", lambda x: "|".join(k + "=" + v for k, v in x.items())
-                                     if hasattr(x, "items") else "_")
-
-                misc = get_field("misc", lambda x: "|".join(k + "=" + v if v is not None else k + "=" + "" for k, v in x.items())
-                                    if hasattr(x, "items") else "_")
-
-                heads = get_field("head")
-                dep_rels = get_field("deprel")
-                dependencies = list(zip(dep_rels, heads))
-                deps = get_field("deps")
-
-                yield self.text_to_instance(words, lemmas, upos_tags, xpos_tags,
-                                            feats, dependencies, deps, ids, misc,
-                                            multiword_ids, multiword_forms, conllu_metadata)
+        logger.info("Reading UD instances from conllu dataset at: %s", file_path)
+        for annotation in self._read_annotations(file_path):
+            instance = self._annotation_to_instance(annotation)
+            if instance is not None:
+                yield instance
+
+    def _read_annotations(self, file_path: str) -> Iterator[TokenList]:
+        if self._use_sentence_index:
+            # each worker seeks to the sentences of its shard instead of parsing the whole file
+            index = SentenceIndex.load_or_build(file_path, index_dir=self._sentence_index_dir)
+            yield from index.parse_sentences(self.shard_iterable(range(len(index))))
+        else:
+            with open_conllu(file_path) as conllu_file:
+                yield from parse_incr(conllu_file)
+
+    def _annotation_to_instance(self, annotation: TokenList) -> Optional[Instance]:
+        conllu_metadata = []
+        metadata = annotation.metadata
+        for k, v in metadata.items():
+            metadata_line = (f"# {k} = {v}")
+            conllu_metadata.append(metadata_line)
+
+        self.contains_elided_token = False
+        annotation = process_multiword_and_elided_tokens(annotation)
+        multiword_tokens = [x for x in annotation if x["multi_id"] is not None]
+        elided_tokens = [x for x in annotation if x["elided_id"] is not None]
+        if len(elided_tokens) >= 1:
+            self.contains_elided_token = True
+
+        # considers all tokens except MWTs for prediction
+        annotation = [x for x in annotation if x["id"] is not None]
+
+        if len(annotation) == 0:
+            return None
+
+        def get_field(
+                    tag: str,
+                    map_fn: Callable[[Any], Any] = None,
+                    ) -> List[Any]:
+            map_fn = map_fn if map_fn is not None else lambda x: x
+            return [map_fn(x[tag]) if x[tag] is not None else "_" for x in annotation if tag in x]
+
+        def get_string_field(tag: str, map_fn: Callable[[Any], str] = None) -> List[str]:
+            # the same form or label is then stored once rather than once per token
+            return [sys.intern(value) for value in get_field(tag, map_fn)]
+
+        # Extract multiword token rows (not used for prediction, purely for evaluation)
+        ids = [x["id"] for x in annotation]
+        multiword_ids = [x["multi_id"] for x in multiword_tokens]
+        multiword_forms = [x["form"] for x in multiword_tokens]
+
+        words = get_string_field("form")
+        lemmas = get_string_field("lemma")
+        upos_tags = get_string_field("upos")
+        xpos_tags = get_string_field("xpos")
+        feats = get_string_field("feats", lambda x: "|".join(k + "=" + v for k, v in x.items())
+                             if hasattr(x, "items") else "_")
+
+        misc = get_string_field("misc", lambda x: "|".join(k + "=" + v if v is not None else k + "=" + "" for k, v in x.items())
+                            if hasattr(x, "items") else "_")
+
+        heads = get_field("head")
+        dep_rels = get_string_field("deprel")
+        dependencies = list(zip(dep_rels, heads))
+        deps = get_field("deps")
+
+        return self.text_to_instance(words, lemmas, upos_tags, xpos_tags,
+                                     feats, dependencies, deps, ids, misc,
+                                     multiword_ids, multiword_forms, conllu_metadata)
 
     @overrides
     def text_to_instance(
@@ -321,7 +363,7 @@ class UniversalDependenciesEnhancedDatasetReader(DatasetReader):
 
             for relation_list in enhanced_arc_tags:
                 for relation in relation_list:
-                    arc_tags.append(relation)
+                    arc_tags.append(sys.intern(relation))
 
             assert len(arc_indices) == len(arc_tags), "each arc should have a label"
 
@@ -375,25 +417,29 @@ class UniversalDependenciesEnhancedDatasetReader(DatasetReader):
             predicted_head_indices = None
 
 
-        fields["metadata"] = MetadataField({
-            "words": words,
-            "upos": upos_tags,
-            "xpos": xpos_tags,
-            "feats": feats,
-            "lemmas": lemmas,
-            "ids": ids,
-            "misc": misc,
-            "original_to_new_indices": original_to_new_indices,
-            "head_tags": head_tags,
-            "head_indices": head_indices,
-            "predicted_head_tags": predicted_head_tags,
-            "predicted_head_indices": predicted_head_indices,
-            "arc_indices": arc_indices,
-            "arc_tags": arc_tags,
-            "labeled_arcs": arc_indices_and_tags,
-            "multiword_ids": multiword_ids,
-            "multiword_forms": multiword_forms,
-            "conllu_metadata": conllu_metadata
-        })
+        # `labeled_arcs` is derived from `arc_indices` and `arc_tags` when it is read
+        if self.lean_metadata:
+            fields["metadata"] = MetadataField(SentenceRecord(arc_indices=arc_indices, arc_tags=arc_tags))
+            return Instance(fields)
+
+        fields["metadata"] = MetadataField(SentenceRecord(
+            words=words,
+            upos=upos_tags,
+            xpos=xpos_tags,
+            feats=feats,
+            lemmas=lemmas,
+            ids=ids,
+            misc=misc,
+            original_to_new_indices=original_to_new_indices,
+            head_tags=head_tags,
+            head_indices=head_indices,
+            predicted_head_tags=predicted_head_tags,
+            predicted_head_indices=predicted_head_indices,
+            arc_indices=arc_indices,
+            arc_tags=arc_tags,
+            multiword_ids=multiword_ids,
+            multiword_forms=multiword_forms,
+            conllu_metadata=conllu_metadata,
+        ))
 
         return Instance(fields)
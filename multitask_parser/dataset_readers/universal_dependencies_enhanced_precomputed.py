@@ -0,0 +1,85 @@
+from typing import Dict
+import logging
+
+from overrides import overrides
+import numpy
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.file_utils import cached_path
+from allennlp.data.dataset_readers.dataset_reader import DatasetReader
+from allennlp.data.fields import ArrayField
+
+from multitask_parser.dataset_readers.array_store import ArrayStore, get_store_prefix
+from multitask_parser.dataset_readers.universal_dependencies_enhanced import UniversalDependenciesEnhancedDatasetReader
+
+logger = logging.getLogger(__name__)
+
+
+@DatasetReader.register("universal_dependencies_enhanced_precomputed")
+class UniversalDependenciesEnhancedPrecomputedDatasetReader(UniversalDependenciesEnhancedDatasetReader):
+    """
+    Reads a file in the conllu Universal Dependencies format and attaches arrays which were
+    precomputed for each sentence of the file, e.g. the `encoded_text` of a frozen backbone
+    written by `scripts/precompute_backbone_features.py`.
+    # Parameters
+    feature_store_dir : `str`
+        The directory containing the array stores. The store for a data file `x.conllu` and
+        the array name `name` is expected at `<feature_store_dir>/x.conllu.<name>.{bin,json}`.
+    array_fields : `Dict[str, str]`, optional (default = `{"encoded_text": "precomputed_encoded_text"}`)
+        A mapping from the name of each array store to the name of the `ArrayField` which is added
+        to the instances.
+    array_padding_values : `Dict[str, float]`, optional (default = `None`)
+        The padding value of each array field, keyed by field name. Defaults to 0.
+    Stores which record the number of words of each sentence (e.g. the teacher outputs written by
+    `scripts/cache_teacher_outputs.py`) are checked against that number; otherwise the first
+    dimension of each array must be the number of words.
+    """
+    def __init__(
+        self,
+        feature_store_dir: str,
+        array_fields: Dict[str, str] = None,
+        array_padding_values: Dict[str, float] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        if self._use_sentence_index:
+            # the arrays are matched to the instances by their position in the whole file
+            raise ConfigurationError(
+                "universal_dependencies_enhanced_precomputed does not support use_sentence_index"
+            )
+        self._feature_store_dir = feature_store_dir
+        self._array_fields = array_fields or {"encoded_text": "precomputed_encoded_text"}
+        self._array_padding_values = array_padding_values or {}
+
+    @overrides
+    def _read(self, file_path: str):
+        file_path = cached_path(file_path)
+
+        stores = {
+            field_name: ArrayStore(get_store_prefix(self._feature_store_dir, file_path, name), file_path)
+            for name, field_name in self._array_fields.items()
+        }
+
+        for sentence_index, instance in enumerate(super()._read(file_path)):
+            num_words = len(instance["words"])
+            for field_name, store in stores.items():
+                if sentence_index >= len(store):
+                    raise ConfigurationError(
+                        f"The array store for {field_name} only has {len(store)} sentences "
+                        f"but {file_path} has more."
+                    )
+                array = numpy.asarray(store[sentence_index], dtype=numpy.float32)
+                stored_num_words = store.get_num_words(sentence_index)
+                if stored_num_words is not None and stored_num_words != num_words:
+                    raise ConfigurationError(
+                        f"Sentence {sentence_index} of {file_path} has {num_words} words but the "
+                        f"stored {field_name} array was computed for {stored_num_words} words."
+                    )
+                if stored_num_words is None and array.shape[0] != num_words:
+                    raise ConfigurationError(
+                        f"Sentence {sentence_index} of {file_path} has {num_words} words but the "
+                        f"stored {field_name} array has shape {array.shape}."
+                    )
+                padding_value = self._array_padding_values.get(field_name, 0)
+                instance.add_field(field_name, ArrayField(array, padding_value=padding_value))
+            yield instance
@@ -0,0 +1,194 @@
+"""
+Reading and writing of (compressed) CoNLL-U files. The compression is detected from the extension:
+.gz (gzip), .xz (lzma), .bz2 (bzip2) and .zst (zstandard, which needs `pip install zstandard`).
+Everything else is read as plain text. The files are read and written through large buffers,
+which matters on network file systems.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+from typing import IO, Tuple
+
+COMPRESSION_EXTENSIONS = (".gz", ".xz", ".bz2", ".zst")
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+def strip_compression_extension(path: str) -> str:
+    """
+    Returns `path` without its compression extension, e.g. "en_ewt-ud-train.conllu" for
+    "en_ewt-ud-train.conllu.xz", so that compressed files can be matched by their name.
+    """
+    root, extension = os.path.splitext(path)
+    return root if extension in COMPRESSION_EXTENSIONS else path
+
+
+class _CompressedTextFile(io.TextIOWrapper):
+    """
+    A text file over a compressed stream, which also closes the underlying file when it is closed.
+    """
+
+    def __init__(self, stream: IO[bytes], raw: IO[bytes], **kwargs) -> None:
+        super().__init__(stream, **kwargs)
+        self._raw = raw
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+class _CompressedBinaryFile(io.BufferedReader):
+    """
+    A buffered binary file over a decompressed stream, which also closes the underlying file when
+    it is closed.
+    """
+
+    def __init__(self, stream: IO[bytes], raw: IO[bytes], buffer_size: int) -> None:
+        super().__init__(stream, buffer_size)
+        self._raw = raw
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+class _SeekableZstdReader(io.RawIOBase):
+    """
+    A raw reader of the decompressed bytes of a .zst file which emulates seeking, as gzip, lzma and
+    bz2 do: forwards by decompressing and discarding the bytes up to the offset, and backwards by
+    reopening the file. The zstandard stream reader itself is not seekable.
+    """
+
+    def __init__(self, path: str, buffer_size: int) -> None:
+        super().__init__()
+        self._path = path
+        self._buffer_size = buffer_size
+        self._raw = None
+        self._stream = None
+        self._open()
+
+    def _open(self) -> None:
+        import zstandard
+
+        self._raw = open(self._path, "rb", buffering=self._buffer_size)
+        try:
+            self._stream = zstandard.ZstdDecompressor().stream_reader(self._raw)
+        except BaseException:
+            self._raw.close()
+            raise
+        self._position = 0
+
+    def _close_stream(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._raw.close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self._stream.readinto(buffer)
+        self._position += size
+        return size
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Seeking from the end of a .zst file is not supported")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        if offset < self._position:
+            self._close_stream()
+            self._open()
+        while self._position < offset:
+            skipped = len(self._stream.read(min(offset - self._position, self._buffer_size)))
+            if not skipped:
+                break
+            self._position += skipped
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._close_stream()
+            finally:
+                super().close()
+
+
+def _import_zstandard() -> None:
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        raise ImportError("Reading or writing .zst files requires the zstandard package: pip install zstandard")
+
+
+def _compressed_stream(raw: IO[bytes], extension: str, writing: bool) -> IO[bytes]:
+    if extension == ".gz":
+        return gzip.GzipFile(fileobj=raw, mode="wb" if writing else "rb")
+    if extension == ".xz":
+        return lzma.LZMAFile(raw, mode="wb" if writing else "rb")
+    if extension == ".bz2":
+        return bz2.BZ2File(raw, mode="wb" if writing else "rb")
+    _import_zstandard()
+    import zstandard
+
+    if writing:
+        return zstandard.ZstdCompressor().stream_writer(raw)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw), DEFAULT_BUFFER_SIZE)
+
+
+def _open_compressed(path: str, extension: str, writing: bool, buffer_size: int) -> Tuple[IO[bytes], IO[bytes]]:
+    raw = open(path, "wb" if writing else "rb", buffering=buffer_size)
+    try:
+        return _compressed_stream(raw, extension, writing), raw
+    except BaseException:
+        raw.close()
+        raise
+
+
+def open_binary(path: str, buffer_size: int = DEFAULT_BUFFER_SIZE) -> IO[bytes]:
+    """
+    Opens a (compressed) file for reading its decompressed bytes, e.g. to seek to the byte offsets
+    of a `SentenceIndex`. Seeking in a compressed file is emulated by decompressing it up to the
+    offset (and from the start when seeking backwards), in every format, so it is only fast when
+    reading forwards.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension not in COMPRESSION_EXTENSIONS:
+        return open(path, "rb", buffering=buffer_size)
+    if extension == ".zst":
+        _import_zstandard()
+        return io.BufferedReader(_SeekableZstdReader(path, buffer_size), buffer_size)
+    stream, raw = _open_compressed(path, extension, False, buffer_size)
+    return _CompressedBinaryFile(stream, raw, buffer_size)
+
+
+def open_conllu(
+    path: str, mode: str = "r", encoding: str = "utf-8", buffer_size: int = DEFAULT_BUFFER_SIZE
+) -> IO[str]:
+    """
+    Opens a (compressed) text file for reading (`mode` "r") or writing ("w"), decompressing or
+    compressing it on the fly according to its extension.
+    """
+    if mode not in ("r", "w"):
+        raise ValueError(f"Unsupported mode {mode!r}: use 'r' or 'w'")
+    extension = os.path.splitext(path)[1]
+    if extension not in COMPRESSION_EXTENSIONS:
+        return open(path, mode, buffering=buffer_size, encoding=encoding)
+
+    stream, raw = _open_compressed(path, extension, mode == "w", buffer_size)
+    return _CompressedTextFile(stream, raw, encoding=encoding)
@@ -0,0 +1,222 @@
+"""
+Makes predicted enhanced UD graphs rooted and connected by adding an edge to a root of each
+fragment that can't be reached from the ROOT node. Used by `scripts/connect_graph.py` on CoNLL-U
+files and by the `enhanced-predictor` (see its `graph_repair` argument) on the decoded arcs in memory.
+
+The connection strategies (`mode`) are:
+    root_edge : attach each fragment to the ROOT with a `root` edge.
+    best_guess, try_use_basic : use the edge of the basic tree if it connects a fragment root to the
+        reachable graph, and fall back to a `root` edge otherwise.
+"""
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, Set, Tuple
+
+REPAIR_MODES = ("root_edge", "best_guess", "try_use_basic")
+
+
+def get_reachable(head_to_children, start_id, visited = None, restricted_to = None) -> Set[Hashable]:
+    if visited is None:
+        visited = set()
+    # iterative depth-first search, so long chains don't hit the recursion limit
+    to_visit = [start_id]
+    while to_visit:
+        node = to_visit.pop()
+        if node in visited:
+            continue
+        visited.add(node)
+        for child in head_to_children.get(node, ()):
+            if restricted_to and not child in restricted_to:
+                # do no visit this child
+                continue
+            to_visit.append(child)
+    return visited
+
+
+def strongly_connected_components(nodes, successors) -> List[List[Hashable]]:
+    """
+    Tarjan's algorithm, without recursion. `successors` maps each node to the list of its
+    successors among `nodes`. The components are returned in reverse topological order,
+    i.e. each component comes after all the components reachable from it.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for start in nodes:
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(successors[start]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors[child])))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def get_reach_bitsets(nodes, head_to_children, bits) -> Dict[Hashable, int]:
+    """
+    For each of `nodes`, the bitset (an int with the `bits` of the nodes) of the nodes reachable
+    from it in the subgraph restricted to `nodes`, computed once per strongly connected component.
+    """
+    successors = {
+        node: [child for child in head_to_children.get(node, ()) if child in bits]
+        for node in nodes
+    }
+    reach = {}
+    for component in strongly_connected_components(nodes, successors):
+        component_reach = 0
+        for node in component:
+            component_reach |= bits[node]
+            for child in successors[node]:
+                # successors outside the component were completed before it
+                component_reach |= reach.get(child, 0)
+        for node in component:
+            reach[node] = component_reach
+    return reach
+
+
+def repair_graph(
+    node_ids: List[Hashable],
+    incoming_edges: Dict[Hashable, List[Tuple[Hashable, str]]],
+    mode: str = "root_edge",
+    basic_edges: Dict[Hashable, Tuple[Hashable, str]] = None,
+    root: Hashable = 0,
+    sort_key: Callable[[Hashable], float] = None,
+    event_counter: Counter = None,
+) -> Dict[Hashable, List[Tuple[Hashable, str]]]:
+    """
+    Returns the incoming `(head, label)` edges of each node after making the graph rooted and connected.
+    # Parameters
+    node_ids : `List[Hashable]`
+        The nodes of the sentence in order, without the ROOT.
+    incoming_edges : `Dict[Hashable, List[Tuple[Hashable, str]]]`
+        The predicted `(head, label)` edges of each node.
+    mode : `str`, optional (default = `"root_edge"`)
+        One of `REPAIR_MODES`.
+    basic_edges : `Dict[Hashable, Tuple[Hashable, str]]`, optional (default = `None`)
+        The `(head, label)` edge of each node in the basic tree, if known.
+    root : `Hashable`, optional (default = `0`)
+        The id of the ROOT node.
+    sort_key : `Callable`, optional (default = `None`)
+        Orders the nodes by their position in the sentence, to prefer the earliest fragment root
+        all else being equal. Defaults to the node ids themselves.
+    event_counter : `Counter`, optional (default = `None`)
+        If given, counts the repairs which were made.
+    """
+    if mode not in REPAIR_MODES:
+        raise ValueError(f"Unknown graph repair mode {mode}, expected one of {REPAIR_MODES}.")
+    if event_counter is None:
+        event_counter = Counter()
+    if sort_key is None:
+        sort_key = lambda node: node
+    basic_edges = basic_edges or {}
+    edges = {node: list(incoming_edges.get(node, ())) for node in node_ids}
+
+    # fix; sometimes the parser may not predict a root edge
+    if any(head == root for node in node_ids for head, _ in edges[node]):
+        event_counter['has at least one root'] += 1
+    else:
+        event_counter['has no root'] += 1
+        # if the enhanced parser didn't predict a root edge, take the root edge
+        # from basic and re-try
+        for node in node_ids:
+            if node in basic_edges and basic_edges[node][0] == root:
+                edges[node] = [(root, "root")]   # TODO: not always right to throw away the other edges
+                event_counter['copied 0:root from basic tree'] += 1
+                break
+
+    # find the nodes reachable from the root
+    head_to_children = {}
+    for node in node_ids:
+        for head in {head for head, _ in edges[node]}:
+            head_to_children.setdefault(head, []).append(node)
+    nodes_reachable_from_root = get_reachable(head_to_children, root)
+    unreachable_nodes = [node for node in node_ids if node not in nodes_reachable_from_root]
+
+    # for the unreachable nodes we build fragments; the nodes reachable from each unreachable
+    # node are computed once on the condensation of the unreachable subgraph and kept as bitsets
+    bits = {node: 1 << position for position, node in enumerate(unreachable_nodes)}
+    reach = get_reach_bitsets(unreachable_nodes, head_to_children, bits)
+    remaining = (1 << len(unreachable_nodes)) - 1
+
+    count_unreachable_fragments = 0
+    while remaining:
+        count_unreachable_fragments += 1
+        # find an unreachable node that maximises the number of
+        # nodes that can be reached from it but not from root;
+        # this ensures that we do no add a root edge to a node
+        # that has a parent that cannot be reached from the
+        # candidate node and therefore would be a better
+        # candidate, reducing the number of root edges needed.
+        # As the fragments removed so far are closed under reachability,
+        # the remaining reach of a node is its initial reach minus those fragments.
+        candidates = []
+        best_fragment_size = 0
+        for unreachable_node in unreachable_nodes:
+            if not remaining & bits[unreachable_node]:
+                continue
+            fragment = reach[unreachable_node] & remaining
+            fragment_size = bin(fragment).count("1")
+            if fragment_size < best_fragment_size:
+                # no good candidate: try next
+                continue
+            elif best_fragment_size < fragment_size:
+                # found better candidate that all before
+                candidates = []
+                best_fragment_size = fragment_size
+            candidates.append((sort_key(unreachable_node), unreachable_node, fragment))
+        # prefer the earliest token all else being equal
+        candidates.sort()
+
+        # connect a fragment root to the root-reachable graph
+        selected_fragment_root = None
+        if mode in ('best_guess', 'try_use_basic'):
+            # check wether any of the edges in the basic
+            # tree connects one of the candidate fragments
+            # to the root-reachable fragment
+            for _, fragment_root, fragment in candidates:
+                if fragment_root not in basic_edges:
+                    continue
+                head, label = basic_edges[fragment_root]
+                if not remaining & bits.get(head, 0):
+                    # found a suitable edge
+                    selected_fragment_root = fragment_root
+                    selected_fragment = fragment
+                    selected_edge = (head, label)
+                    event_counter['connecting with edge from basic tree'] += 1
+                    event_counter['adding edge from basic tree with label ' + label] += 1
+                    break
+        if selected_fragment_root is None:
+            selected_fragment_root = candidates[0][1]
+            selected_fragment      = candidates[0][2]
+            selected_edge          = (root, "root")    # naive solution
+        edges[selected_fragment_root].append(selected_edge)
+        remaining &= ~selected_fragment
+
+    event_counter['connected %3d unreachable fragments' %count_unreachable_fragments] += 1
+    return edges
@@ -32,6 +32,7 @@ from allennlp.modules.token_embedders.pretrained_transformer_embedder import (
 from allennlp.nn import util
 
 from multitask_parser.training.enhanced_attachment_scores import EnhancedAttachmentScores
+from multitask_parser.dataset_readers.sentence_record import prediction_outputs
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -218,20 +219,9 @@ class EnhancedKGParser(Model):
 
         output_dict = {"arc_probs": arc_probs, "arc_tag_probs": arc_tag_probs, "mask": mask}
 
-        if metadata:
-            output_dict["conllu_metadata"] = [meta["conllu_metadata"] for meta in metadata]
-            output_dict["ids"] = [meta["ids"] for meta in metadata]
-            output_dict["words"] = [meta["words"] for meta in metadata]
-            output_dict["lemmas"] = [meta["lemmas"] for meta in metadata]
-            output_dict["upos"] = [meta["upos"] for meta in metadata]
-            output_dict["xpos"] = [meta["xpos"] for meta in metadata]
-            output_dict["feats"] = [meta["feats"] for meta in metadata]
-            output_dict["head_tags"] = [meta["head_tags"] for meta in metadata]
-            output_dict["head_indices"] = [meta["head_indices"] for meta in metadata]
-            output_dict["original_to_new_indices"] = [meta["original_to_new_indices"] for meta in metadata]
-            output_dict["misc"] = [meta["misc"] for meta in metadata]
-            output_dict["multiword_ids"] = [x["multiword_ids"] for x in metadata if "multiword_ids" in x]
-            output_dict["multiword_forms"] = [x["multiword_forms"] for x in metadata if "multiword_forms" in x]
+        if metadata and not self.training:
+            # only the predictors need the other columns of the sentences; the metrics read the gold arcs
+            output_dict.update(prediction_outputs(metadata))
 
         if enhanced_tags is not None:
             arc_nll, tag_nll = self._construct_loss(
@@ -0,0 +1,63 @@
+"""
+Decoding of enhanced UD graphs which guarantees that every word is reachable from the ROOT:
+a maximum spanning tree over the arc probabilities is used as a backbone, and every other arc
+whose probability is above the threshold is added to it.
+"""
+from typing import List, Tuple
+
+import numpy
+
+from allennlp.nn.chu_liu_edmonds import decode_mst
+
+
+def decode_connected_graphs(
+    arc_probs: numpy.ndarray,
+    arc_tag_probs: numpy.ndarray,
+    lengths: List[int],
+    edge_prediction_threshold: float,
+) -> Tuple[List[List[Tuple[int, int]]], List[List[int]]]:
+    """
+    # Parameters
+    arc_probs : `numpy.ndarray`, required.
+        An array of shape (batch_size, sequence_length, sequence_length), where `arc_probs[b, i, j]`
+        is the probability of an arc from head `i` to dependent `j`, with the ROOT at position 0.
+    arc_tag_probs : `numpy.ndarray`, required.
+        An array of shape (batch_size, sequence_length, sequence_length, num_tags).
+    lengths : `List[int]`, required.
+        The length of each sentence, including the ROOT.
+    edge_prediction_threshold : `float`, required.
+        The probability above which an arc is added to the spanning tree.
+    # Returns
+    The (head, dependent) arcs of each sentence, sorted, and the tag index of each arc.
+    """
+    batch_size, sequence_length, _ = arc_probs.shape
+    lengths = numpy.asarray(lengths)
+    positions = numpy.arange(sequence_length)
+
+    # shape (batch_size, sequence_length): the words, excluding the ROOT and padding
+    word_mask = (positions[None, :] < lengths[:, None]) & (positions[None, :] > 0)
+    # shape (batch_size, sequence_length, sequence_length): the valid (head, dependent) pairs
+    arc_mask = (positions[None, :, None] < lengths[:, None, None]) & word_mask[:, None, :]
+    arc_mask &= positions[:, None] != positions[None, :]
+
+    selected = (arc_probs > edge_prediction_threshold) & arc_mask
+
+    # the spanning tree maximises the sum of the arc log probabilities
+    log_probs = numpy.log(numpy.clip(arc_probs, 1e-12, 1.0))
+    for batch_index, length in enumerate(lengths):
+        heads, _ = decode_mst(log_probs[batch_index, :length, :length], length, has_labels=False)
+        selected[batch_index, heads[1:length], numpy.arange(1, length)] = True
+
+    # shape (batch_size, sequence_length, sequence_length)
+    tags = arc_tag_probs.argmax(-1)
+    batch_indices, head_indices, dependent_indices = numpy.nonzero(selected)
+    arc_tags = tags[batch_indices, head_indices, dependent_indices]
+
+    arcs = [[] for _ in range(batch_size)]
+    arc_tag_indices = [[] for _ in range(batch_size)]
+    for batch_index, head, dependent, tag in zip(
+        batch_indices.tolist(), head_indices.tolist(), dependent_indices.tolist(), arc_tags.tolist()
+    ):
+        arcs[batch_index].append((head, dependent))
+        arc_tag_indices[batch_index].append(tag)
+    return arcs, arc_tag_indices
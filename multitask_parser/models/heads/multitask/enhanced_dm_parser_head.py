@@ -28,6 +28,12 @@ from allennlp.nn.util import min_value_of_dtype
 from allennlp.nn.util import get_text_field_mask
 from allennlp.nn.util import get_lengths_from_binary_sequence_mask
 from multitask_parser.training.enhanced_attachment_scores import EnhancedAttachmentScores
+from multitask_parser.dataset_readers.sentence_record import prediction_outputs
+from multitask_parser.training.distillation import soft_arc_loss, soft_edge_tag_loss
+from multitask_parser.modules.pairwise_checkpoint import checkpoint_pairwise
+from multitask_parser.training.stage_timer import DISABLED_STAGE_TIMER
+from multitask_parser.models.heads.multitask.connected_decoding import decode_connected_graphs
+from multitask_parser.models.heads.multitask.memory_estimation import estimate_pairwise_memory
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -38,6 +44,9 @@ class EnhancedDMParser(Head):
     Parsing head to predict enhanced UD graphs.
     """
 
+    # replaced by a timer of the multitask model when it is built with `instrument_stages`
+    stage_timer = DISABLED_STAGE_TIMER
+
     def __init__(
         self,
         vocab: Vocabulary,
@@ -49,6 +58,10 @@ class EnhancedDMParser(Head):
         dropout: float = 0.0,
         input_dropout: float = 0.0,
         edge_prediction_threshold: float = 0.5,
+        distillation_weight: float = 0.0,
+        checkpoint_pairwise: bool = False,
+        checkpoint_chunk_size: int = None,
+        decode_connected: bool = False,
         initializer: InitializerApplicator = InitializerApplicator(),
         **kwargs,
     ) -> None:
@@ -59,6 +72,18 @@ class EnhancedDMParser(Head):
             raise ConfigurationError(f"edge_prediction_threshold must be between "
                                      f"0 and 1 (exclusive) but found {edge_prediction_threshold}.")
 
+        if not 0 <= distillation_weight <= 1:
+            raise ConfigurationError(f"distillation_weight must be between "
+                                     f"0 and 1 but found {distillation_weight}.")
+        # weight of the soft teacher targets (see `scripts/cache_teacher_outputs.py`) in the loss
+        self.distillation_weight = distillation_weight
+
+        # recompute the bilinear scores in the backward pass, for `checkpoint_chunk_size` heads at a time
+        self.checkpoint_pairwise = checkpoint_pairwise
+        self.checkpoint_chunk_size = checkpoint_chunk_size
+        # decode the arcs on top of a maximum spanning tree, so every word is reachable from the ROOT
+        self.decode_connected = decode_connected
+
 
         self.head_arc_feedforward = arc_feedforward or FeedForward(
             encoder_dim, 1, arc_representation_dim, Activation.by_name("elu")()
@@ -116,6 +141,9 @@ class EnhancedDMParser(Head):
         xpos_encoded_representation: torch.FloatTensor = None,
         feats_encoded_representation: torch.FloatTensor = None,
         enhanced_tags: torch.LongTensor = None,
+        teacher_arc_probs: torch.FloatTensor = None,
+        teacher_edges: torch.FloatTensor = None,
+        teacher_edge_tag_probs: torch.FloatTensor = None,
     ) -> Dict[str, torch.Tensor]:
 
         """
@@ -131,6 +159,15 @@ class EnhancedDMParser(Head):
         enhanced_tags : torch.LongTensor, optional (default = None)
             A torch tensor representing the sequence of integer indices denoting the parent of every
             word in the dependency parse. Has shape ``(batch_size, sequence_length, sequence_length)``.
+        teacher_arc_probs : torch.FloatTensor, optional (default = None)
+            The arc probabilities of a teacher model, including the ROOT token.
+            Has shape ``(batch_size, sequence_length, sequence_length)``.
+        teacher_edges : torch.FloatTensor, optional (default = None)
+            The (head, dependent) pairs decoded by the teacher, padded with -1.
+            Has shape ``(batch_size, num_edges, 2)``.
+        teacher_edge_tag_probs : torch.FloatTensor, optional (default = None)
+            The teacher's tag distribution for each of the `teacher_edges`.
+            Has shape ``(batch_size, num_edges, num_tags)``.
         # Returns
         An output dictionary.
         """
@@ -163,37 +200,31 @@ class EnhancedDMParser(Head):
         head_tag_representation = self._dropout(self.head_tag_feedforward(encoded_text))
         child_tag_representation = self._dropout(self.child_tag_feedforward(encoded_text))
 
-        # shape (batch_size, sequence_length, sequence_length)
-        arc_scores = self.arc_attention(head_arc_representation, child_arc_representation)
-
-        # shape (batch_size, num_tags, sequence_length, sequence_length)
-        arc_tag_logits = self.tag_bilinear(head_tag_representation, child_tag_representation)
-
-        # Switch to (batch_size, sequence_length, sequence_length, num_tags)
-        arc_tag_logits = arc_tag_logits.permute(0, 2, 3, 1).contiguous()
+        if self.checkpoint_pairwise and self.training and torch.is_grad_enabled():
+            arc_scores, arc_tag_logits = checkpoint_pairwise(
+                self._pairwise_scores,
+                [head_arc_representation, head_tag_representation],
+                [child_arc_representation, child_tag_representation],
+                self.checkpoint_chunk_size,
+            )
+        else:
+            arc_scores, arc_tag_logits = self._pairwise_scores(
+                head_arc_representation, head_tag_representation,
+                child_arc_representation, child_tag_representation,
+            )
 
         # Since we'll be doing some additions, using the min value will cause underflow
         minus_mask = ~mask * min_value_of_dtype(arc_scores.dtype) / 10
         arc_scores = arc_scores + minus_mask.unsqueeze(2) + minus_mask.unsqueeze(1)
 
-        arc_probs, arc_tag_probs = self._greedy_decode(arc_scores, arc_tag_logits, mask)
+        with self.stage_timer.stage("decode"):
+            arc_probs, arc_tag_probs = self._greedy_decode(arc_scores, arc_tag_logits, mask)
 
         output_dict = {"arc_probs": arc_probs, "arc_tag_probs": arc_tag_probs, "mask": mask}
 
-        if metadata:
-            output_dict["conllu_metadata"] = [meta["conllu_metadata"] for meta in metadata]
-            output_dict["ids"] = [meta["ids"] for meta in metadata]
-            output_dict["words"] = [meta["words"] for meta in metadata]
-            output_dict["lemmas"] = [meta["lemmas"] for meta in metadata]
-            output_dict["upos"] = [meta["upos"] for meta in metadata]
-            output_dict["xpos"] = [meta["xpos"] for meta in metadata]
-            output_dict["feats"] = [meta["feats"] for meta in metadata]
-            output_dict["head_tags"] = [meta["head_tags"] for meta in metadata]
-            output_dict["head_indices"] = [meta["head_indices"] for meta in metadata]
-            output_dict["original_to_new_indices"] = [meta["original_to_new_indices"] for meta in metadata]
-            output_dict["misc"] = [meta["misc"] for meta in metadata]
-            output_dict["multiword_ids"] = [x["multiword_ids"] for x in metadata if "multiword_ids" in x]
-            output_dict["multiword_forms"] = [x["multiword_forms"] for x in metadata if "multiword_forms" in x]
+        if metadata and not self.training:
+            # only the predictors need the other columns of the sentences; the metrics read the gold arcs
+            output_dict.update(prediction_outputs(metadata))
 
         if enhanced_tags is not None:
             arc_nll, tag_nll = self._construct_loss(
@@ -205,7 +236,8 @@ class EnhancedDMParser(Head):
             output_dict["tag_loss"] = tag_nll
 
             # get human readable output to computed enhanced graph metrics
-            output_dict = self.make_output_human_readable(output_dict)
+            with self.stage_timer.stage("human_readable"):
+                output_dict = self.make_output_human_readable(output_dict)
 
             # predicted arcs, arc_tags
             predicted_arcs = output_dict["arcs"]
@@ -218,12 +250,61 @@ class EnhancedDMParser(Head):
             gold_labeled_arcs = [meta["labeled_arcs"] for meta in metadata]
 
             tag_mask = mask.unsqueeze(1) & mask.unsqueeze(2)
-            self._enhanced_attachment_scores(predicted_arcs, predicted_arc_tags, predicted_labeled_arcs, \
-                                             gold_arcs, gold_arc_tags, gold_labeled_arcs, tag_mask)
+            with self.stage_timer.stage("metrics"):
+                self._enhanced_attachment_scores(predicted_arcs, predicted_arc_tags, predicted_labeled_arcs, \
+                                                 gold_arcs, gold_arc_tags, gold_labeled_arcs, tag_mask)
+
+        if teacher_arc_probs is not None and self.distillation_weight > 0:
+            distillation_loss = soft_arc_loss(arc_scores, teacher_arc_probs, mask) + soft_edge_tag_loss(
+                arc_tag_logits, teacher_edges, teacher_edge_tag_probs
+            )
+            output_dict["distillation_loss"] = distillation_loss
+            if "loss" in output_dict:
+                output_dict["loss"] = (
+                    (1 - self.distillation_weight) * output_dict["loss"]
+                    + self.distillation_weight * distillation_loss
+                )
+            else:
+                output_dict["loss"] = distillation_loss
 
         return output_dict
 
 
+    def estimate_memory(self, lengths: List[int]) -> int:
+        """
+        Estimates the memory in bytes of the forward pass of this head on a batch of sentences
+        with these numbers of words. See `estimate_pairwise_memory`.
+        """
+        return estimate_pairwise_memory(
+            lengths,
+            encoder_dim=self._head_sentinel.size(-1),
+            arc_representation_dim=self.head_arc_feedforward.get_output_dim(),
+            tag_representation_dim=self.head_tag_feedforward.get_output_dim(),
+            num_tags=self.vocab.get_vocab_size("deps"),
+            bilinear=True,
+            bytes_per_element=self._head_sentinel.element_size(),
+        )
+
+    def _pairwise_scores(
+        self,
+        head_arc_representation: torch.Tensor,
+        head_tag_representation: torch.Tensor,
+        child_arc_representation: torch.Tensor,
+        child_tag_representation: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The arc scores and arc tag logits of the given heads (rows) with every dependent (columns).
+        """
+        # shape (batch_size, num_heads, sequence_length)
+        arc_scores = self.arc_attention(head_arc_representation, child_arc_representation)
+
+        # shape (batch_size, num_tags, num_heads, sequence_length)
+        arc_tag_logits = self.tag_bilinear(head_tag_representation, child_tag_representation)
+
+        # Switch to (batch_size, num_heads, sequence_length, num_tags)
+        arc_tag_logits = arc_tag_logits.permute(0, 2, 3, 1).contiguous()
+        return arc_scores, arc_tag_logits
+
     @overrides
     def make_output_human_readable(
         self, output_dict: Dict[str, torch.Tensor]
@@ -232,6 +313,8 @@ class EnhancedDMParser(Head):
         arc_probs = output_dict["arc_probs"].cpu().detach().numpy()
         mask = output_dict["mask"]
         lengths = get_lengths_from_binary_sequence_mask(mask)
+        if self.decode_connected:
+            return self._decode_connected_graphs(output_dict, arc_probs, arc_tag_probs, lengths)
         arcs = []
         arc_tags = []
         # append arc and label to calculate ELAS
@@ -301,6 +384,31 @@ class EnhancedDMParser(Head):
         output_dict["labeled_arcs"] = labeled_arcs
         return output_dict
 
+    def _decode_connected_graphs(
+        self,
+        output_dict: Dict[str, torch.Tensor],
+        arc_probs: numpy.ndarray,
+        arc_tag_probs: numpy.ndarray,
+        lengths: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Decodes the arcs above the threshold on top of a maximum spanning tree, so that every
+        word is reachable from the ROOT and the graphs don't need to be repaired afterwards.
+        """
+        connected_arcs, connected_tags = decode_connected_graphs(
+            arc_probs, arc_tag_probs, lengths.tolist(), self.edge_prediction_threshold
+        )
+        arc_tags = [
+            [self.vocab.get_token_from_index(tag, "deps") for tag in tag_indices]
+            for tag_indices in connected_tags
+        ]
+        output_dict["arcs"] = connected_arcs
+        output_dict["arc_tags"] = arc_tags
+        output_dict["labeled_arcs"] = [
+            list(zip(edges, edge_tags)) for edges, edge_tags in zip(connected_arcs, arc_tags)
+        ]
+        return output_dict
+
     def _construct_loss(
         self,
         arc_scores: torch.Tensor,
@@ -0,0 +1,65 @@
+"""
+Estimates of the peak memory of the graph parser heads, which is dominated by the
+(batch_size, sequence_length, sequence_length, dim) tensors of their pairwise scorers,
+so that batches can be split before they run out of memory (see `memory_safe_gradient_descent`).
+"""
+from typing import Sequence
+
+
+def estimate_pairwise_memory(
+    lengths: Sequence[int],
+    encoder_dim: int,
+    arc_representation_dim: int,
+    tag_representation_dim: int,
+    num_tags: int,
+    bilinear: bool = False,
+    chunk_size: int = None,
+    bytes_per_element: int = 4,
+) -> int:
+    """
+    Returns an estimate in bytes of the memory that the forward pass of a graph parser head
+    allocates on a batch of sentences, all of which are padded to the longest one plus the ROOT.
+    The estimate counts the tensors kept for the backward pass, so it is an upper bound at
+    prediction time.
+    # Parameters
+    lengths : `Sequence[int]`, required.
+        The number of words of each sentence of the batch, without the ROOT.
+    encoder_dim : `int`, required.
+        The dimension of the input of the head (the encoded text and any concatenated representations).
+    arc_representation_dim : `int`, required.
+    tag_representation_dim : `int`, required.
+    num_tags : `int`, required.
+        The size of the `deps` vocabulary.
+    bilinear : `bool`, optional (default = `False`)
+        True for the bilinear scorer of `EnhancedDMParser`, which only materialises the scores,
+        False for the scorer of `EnhancedKGParser`, which materialises the pairwise representations.
+    chunk_size : `int`, optional (default = `None`)
+        The number of dependents whose pairwise representations are alive at the same time, with
+        `checkpoint_pairwise`. All of them by default.
+    bytes_per_element : `int`, optional (default = `4`)
+    """
+    if not lengths:
+        return 0
+    batch_size = len(lengths)
+    sequence_length = max(lengths) + 1
+    tokens = batch_size * sequence_length
+    pairs = tokens * sequence_length
+
+    # the input with the ROOT sentinel (and after dropout), and the head and child representations
+    per_token = 2 * encoder_dim + 2 * arc_representation_dim + 2 * tag_representation_dim
+    if bilinear:
+        # the input of the label bilinear product: (batch_size, num_tags, sequence_length, tag_dim)
+        per_token += num_tags * tag_representation_dim + arc_representation_dim
+        # the scores, the scores plus the bias, and the permuted copy of the tag logits
+        per_pair = 2 + 3 * num_tags
+        materialised_pairs = 0
+    else:
+        # the repeated head and child representations, their sum and its activation
+        per_pair = 1 + num_tags
+        materialised_pairs = 4 * (arc_representation_dim + tag_representation_dim)
+        if chunk_size is not None and chunk_size < sequence_length:
+            materialised_pairs = materialised_pairs * chunk_size / sequence_length
+    # masking, greedy decoding and the loss each copy the scores and the tag logits
+    per_pair += 3 * (1 + num_tags)
+
+    return int(bytes_per_element * (per_token * tokens + (per_pair + materialised_pairs) * pairs))
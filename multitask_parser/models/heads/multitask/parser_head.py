@@ -20,10 +20,14 @@ from allennlp.nn.util import get_text_field_mask, get_range_vector
 from allennlp.nn.util import (
     get_device_of,
     masked_log_softmax,
+    masked_softmax,
     get_lengths_from_binary_sequence_mask,
 )
 from allennlp.nn.chu_liu_edmonds import decode_mst
 from allennlp.training.metrics import AttachmentScores
+from multitask_parser.training.distillation import soft_head_loss, soft_head_tag_loss
+from multitask_parser.modules.pairwise_checkpoint import checkpoint_pairwise
+from multitask_parser.training.stage_timer import DISABLED_STAGE_TIMER
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +38,9 @@ POS_TO_IGNORE = {"`", "''", ":", ",", ".", "PU", "PUNCT", "SYM"}
 class MultiTaskParserHead(Head):
     """ """
 
+    # replaced by a timer of the multitask model when it is built with `instrument_stages`
+    stage_timer = DISABLED_STAGE_TIMER
+
     def __init__(
         self,
         vocab: Vocabulary,
@@ -45,11 +52,25 @@ class MultiTaskParserHead(Head):
         pos_tag_embedding: Embedding = None,
         use_mst_decoding_for_validation: bool = True,
         dropout: float = 0.0,
+        distillation_weight: float = 0.0,
+        checkpoint_pairwise: bool = False,
+        checkpoint_chunk_size: int = None,
         initializer: InitializerApplicator = InitializerApplicator(),
         **kwargs,
     ) -> None:
         super().__init__(vocab, **kwargs)
 
+        if not 0 <= distillation_weight <= 1:
+            raise ConfigurationError(f"distillation_weight must be between "
+                                     f"0 and 1 but found {distillation_weight}.")
+        # weight of the soft teacher targets (see `scripts/cache_teacher_outputs.py`) in the loss
+        self.distillation_weight = distillation_weight
+        # set by `scripts/cache_teacher_outputs.py` to also output the head and tag distributions
+        self.output_distillation_targets = False
+        # recompute the arc scores in the backward pass, for `checkpoint_chunk_size` heads at a time
+        self.checkpoint_pairwise = checkpoint_pairwise
+        self.checkpoint_chunk_size = checkpoint_chunk_size
+
         self.head_arc_feedforward = arc_feedforward or FeedForward(
             encoder_dim, 1, arc_representation_dim, Activation.by_name("elu")()
         )
@@ -115,27 +136,38 @@ class MultiTaskParserHead(Head):
         feats_encoded_representation: torch.FloatTensor = None,
         head_tags: torch.LongTensor = None,
         head_indices: torch.LongTensor = None,
+        teacher_head_probs: torch.FloatTensor = None,
+        teacher_heads: torch.FloatTensor = None,
+        teacher_head_tag_probs: torch.FloatTensor = None,
     ) -> Dict[str, torch.Tensor]:
 
-        predicted_heads, predicted_head_tags, mask, arc_nll, tag_nll  = self._parse(
+        predicted_heads, predicted_head_tags, mask, arc_nll, tag_nll, distillation_outputs = self._parse(
             encoded_text, mask, upos_encoded_representation, xpos_encoded_representation,
-            feats_encoded_representation, head_tags, head_indices
+            feats_encoded_representation, head_tags, head_indices,
+            teacher_head_probs, teacher_heads, teacher_head_tag_probs,
         )
 
         loss = arc_nll + tag_nll
+        if "distillation_loss" in distillation_outputs:
+            distillation_loss = distillation_outputs["distillation_loss"]
+            if head_indices is not None and head_tags is not None:
+                loss = (1 - self.distillation_weight) * loss + self.distillation_weight * distillation_loss
+            else:
+                loss = distillation_loss
 
         if head_indices is not None and head_tags is not None:
-            evaluation_mask = self._get_mask_for_eval(mask[:, 1:], upos)
-            # We calculate attachment scores for the whole sentence
-            # but excluding the symbolic ROOT token at the start,
-            # which is why we start from the second element in the sequence.
-            self._attachment_scores(
-                predicted_heads[:, 1:],
-                predicted_head_tags[:, 1:],
-                head_indices,
-                head_tags,
-                evaluation_mask,
-            )
+            with self.stage_timer.stage("metrics"):
+                evaluation_mask = self._get_mask_for_eval(mask[:, 1:], upos)
+                # We calculate attachment scores for the whole sentence
+                # but excluding the symbolic ROOT token at the start,
+                # which is why we start from the second element in the sequence.
+                self._attachment_scores(
+                    predicted_heads[:, 1:],
+                    predicted_head_tags[:, 1:],
+                    head_indices,
+                    head_tags,
+                    evaluation_mask,
+                )
 
         # output_dict keys will be changed to `{head_name}_key` by the multitask model
         output_dict = {
@@ -145,9 +177,11 @@ class MultiTaskParserHead(Head):
             "tag_loss": tag_nll,
             "loss": loss,
             "mask": mask,
-            "words": [meta["words"] for meta in metadata],
-            "upos": [meta["upos"] for meta in metadata],
         }
+        if not self.training:
+            output_dict["words"] = [meta["words"] for meta in metadata]
+            output_dict["upos"] = [meta["upos"] for meta in metadata]
+        output_dict.update(distillation_outputs)
 
         return output_dict
 
@@ -184,7 +218,10 @@ class MultiTaskParserHead(Head):
         feats_encoded_representation: torch.FloatTensor = None,        
         head_tags: torch.LongTensor = None,
         head_indices: torch.LongTensor = None,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        teacher_head_probs: torch.FloatTensor = None,
+        teacher_heads: torch.FloatTensor = None,
+        teacher_head_tag_probs: torch.FloatTensor = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, Dict[str, torch.Tensor]]:
 
         concatenated_input = [encoded_text]
      
@@ -217,20 +254,26 @@ class MultiTaskParserHead(Head):
         head_tag_representation = self._dropout(self.head_tag_feedforward(encoded_text))
         child_tag_representation = self._dropout(self.child_tag_feedforward(encoded_text))
         # shape (batch_size, sequence_length, sequence_length)
-        attended_arcs = self.arc_attention(head_arc_representation, child_arc_representation)
+        if self.checkpoint_pairwise and self.training and torch.is_grad_enabled():
+            attended_arcs = checkpoint_pairwise(
+                self.arc_attention, [head_arc_representation], [child_arc_representation], self.checkpoint_chunk_size
+            )
+        else:
+            attended_arcs = self.arc_attention(head_arc_representation, child_arc_representation)
 
         minus_inf = -1e8
         minus_mask = ~mask * minus_inf
         attended_arcs = attended_arcs + minus_mask.unsqueeze(2) + minus_mask.unsqueeze(1)
 
-        if self.training or not self.use_mst_decoding_for_validation:
-            predicted_heads, predicted_head_tags = self._greedy_decode(
-                head_tag_representation, child_tag_representation, attended_arcs, mask
-            )
-        else:
-            predicted_heads, predicted_head_tags = self._mst_decode(
-                head_tag_representation, child_tag_representation, attended_arcs, mask
-            )
+        with self.stage_timer.stage("decode"):
+            if self.training or not self.use_mst_decoding_for_validation:
+                predicted_heads, predicted_head_tags = self._greedy_decode(
+                    head_tag_representation, child_tag_representation, attended_arcs, mask
+                )
+            else:
+                predicted_heads, predicted_head_tags = self._mst_decode(
+                    head_tag_representation, child_tag_representation, attended_arcs, mask
+                )
         if head_indices is not None and head_tags is not None:
 
             arc_nll, tag_nll = self._construct_loss(
@@ -251,7 +294,26 @@ class MultiTaskParserHead(Head):
                 mask=mask,
             )
 
-        return predicted_heads, predicted_head_tags, mask, arc_nll, tag_nll
+        distillation_outputs = {}
+        if teacher_head_probs is not None and self.distillation_weight > 0:
+            # the teacher arrays include the ROOT token and are padded with -1 heads
+            teacher_head_tag_logits = self._get_head_tags(
+                head_tag_representation, child_tag_representation, teacher_heads.long().clamp(min=0)
+            )
+            distillation_outputs["distillation_loss"] = (
+                soft_head_loss(attended_arcs, teacher_head_probs, mask)
+                + soft_head_tag_loss(teacher_head_tag_logits, teacher_head_tag_probs, mask)
+            )
+        if self.output_distillation_targets:
+            # the softmax over the candidate heads of each word (independently per word, not the tree
+            # marginals of the MST energies) and the tag distribution of the decoded heads
+            distillation_outputs["head_probs"] = masked_softmax(attended_arcs, mask)
+            distillation_outputs["head_tag_probs"] = F.softmax(
+                self._get_head_tags(head_tag_representation, child_tag_representation, predicted_heads.long()),
+                dim=-1,
+            )
+
+        return predicted_heads, predicted_head_tags, mask, arc_nll, tag_nll, distillation_outputs
 
     def _construct_loss(
         self,
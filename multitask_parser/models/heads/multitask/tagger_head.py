@@ -18,6 +18,8 @@ import allennlp.nn.util as util
 from allennlp.nn.util import sequence_cross_entropy_with_logits
 from allennlp.training.metrics import CategoricalAccuracy, SpanBasedF1Measure
 
+from multitask_parser.training.stage_timer import DISABLED_STAGE_TIMER
+
 
 @Head.register("multitask_tagger")
 class MultiTaskTaggerHead(Head):
@@ -25,6 +27,9 @@ class MultiTaskTaggerHead(Head):
     A Tagging component as part of a MultiTask model.
     """
 
+    # replaced by a timer of the multitask model when it is built with `instrument_stages`
+    stage_timer = DISABLED_STAGE_TIMER
+
     def __init__(
         self,
         vocab: Vocabulary,
@@ -118,8 +123,9 @@ class MultiTaskTaggerHead(Head):
 
         if tags is not None:
             loss = sequence_cross_entropy_with_logits(logits, tags, mask)
-            for metric in self.metrics.values():
-                metric(logits, tags, mask)
+            with self.stage_timer.stage("metrics"):
+                for metric in self.metrics.values():
+                    metric(logits, tags, mask)
             output_dict["loss"] = loss
 
         return output_dict
@@ -11,6 +11,8 @@ from allennlp.models.model import Model
 from allennlp.models.heads import Head
 from allennlp.nn import InitializerApplicator
 
+from multitask_parser.training.stage_timer import StageTimer, set_active_stage_timer
+
 
 def get_forward_arguments(module: torch.nn.Module) -> Set[str]:
     signature = inspect.signature(module.forward)
@@ -61,6 +63,13 @@ class MultiTaskModelV2(Model):
         we will use the `inspect` module to figure this out. The only time that this inference
         might fail is if you have optional arguments that you want to be ignored, or
         something. You very likely don't need to worry about this argument.
+    instrument_stages: `bool`, optional (default = `False`)
+        If True, the wall time and the peak allocated CUDA memory of the backbone, of the scoring,
+        decoding, human-readable conversion and metric updates of each head, and of the collation of
+        batches (with the `instrumented_multitask` data loader) are reported as `timing_<stage>_ms`
+        and `memory_<stage>_mb` metrics. See `multitask_parser.training.stage_timer.StageTimer`.
+    stage_trace_file: `str`, optional (default = `None`)
+        If given with `instrument_stages`, the stages are also written to this file as a Chrome trace.
     initializer: `InitializerApplicator`, optional (default=`InitializerApplicator()`)
         If provided, will be used to initialize the model parameters.
     """
@@ -78,6 +87,8 @@ class MultiTaskModelV2(Model):
         loss_weights: Dict[str, float] = None,
         arg_name_mapping: Dict[str, Dict[str, str]] = None,
         allowed_arguments: Dict[str, Set[str]] = None,
+        instrument_stages: bool = False,
+        stage_trace_file: str = None,
         initializer: InitializerApplicator = InitializerApplicator(),
         **kwargs,
     ):
@@ -100,6 +111,12 @@ class MultiTaskModelV2(Model):
             **{key: get_forward_arguments(heads[key]) for key in heads},
         }
         self._loss_weights = loss_weights or defaultdict(lambda: 1.0)
+
+        self._stage_timer = StageTimer(enabled=instrument_stages, trace_file=stage_trace_file)
+        if instrument_stages:
+            set_active_stage_timer(self._stage_timer)
+        for head_name, head in self._heads.items():
+            head.stage_timer = self._stage_timer.scoped(head_name)
         initializer(self)
 
     def forward(self, **kwargs) -> Dict[str, torch.Tensor]:  # type: ignore
@@ -128,7 +145,8 @@ class MultiTaskModelV2(Model):
                 return [whole_batch_input[i] for i in task_indices[task]]
 
         backbone_arguments = self._get_arguments(kwargs, "backbone")
-        backbone_outputs = self._backbone(**backbone_arguments)
+        with self._stage_timer.stage("backbone"):
+            backbone_outputs = self._backbone(**backbone_arguments)
 
         outputs = {**backbone_outputs}
 
@@ -151,7 +169,9 @@ class MultiTaskModelV2(Model):
                     key: make_inputs_for_task(head_name, value) for key, value in head_arguments.items()
                 }
 
-            head_outputs = self._heads[head_name](**head_arguments)
+            # the time of the stages the head times itself (decoding, metrics) is not included
+            with self._stage_timer.stage(f"{head_name}_scoring"):
+                head_outputs = self._heads[head_name](**head_arguments)
             for key in head_outputs:
                 outputs[f"{head_name}_{key}"] = head_outputs[key]
 
@@ -191,12 +211,25 @@ class MultiTaskModelV2(Model):
                 kept_arguments[new_key] = value
         return kept_arguments
 
+    def estimate_memory(self, lengths: List[int]) -> int:
+        """
+        Estimates the memory in bytes of the forward pass of the heads that can estimate theirs
+        (the graph parser heads) on a batch of sentences with these numbers of words.
+        """
+        return sum(
+            head.estimate_memory(lengths) for head in self._heads.values() if hasattr(head, "estimate_memory")
+        )
+
     @overrides
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         metrics = {}
+        if hasattr(self._backbone, "get_metrics"):
+            for key, value in self._backbone.get_metrics(reset).items():
+                metrics[f"backbone_{key}"] = value
         for head_name in self._heads_called:
             for key, value in self._heads[head_name].get_metrics(reset).items():
                 metrics[f"{head_name}_{key}"] = value
+        metrics.update(self._stage_timer.get_metrics(reset))
         if reset:
             self._heads_called.clear()
         return metrics
@@ -205,13 +238,15 @@ class MultiTaskModelV2(Model):
     def make_output_human_readable(
         self, output_dict: Dict[str, torch.Tensor]
     ) -> Dict[str, torch.Tensor]:
-        output_dict = self._backbone.make_output_human_readable(output_dict)
+        with self._stage_timer.stage("backbone_human_readable"):
+            output_dict = self._backbone.make_output_human_readable(output_dict)
         for head_name, head in self._heads.items():
             head_outputs = {}
             for key, value in output_dict.items():
                 if key.startswith(head_name):
                     head_outputs[key.replace(f"{head_name}_", "")] = value
-            readable_head_outputs = head.make_output_human_readable(head_outputs)
+            with self._stage_timer.stage(f"{head_name}_human_readable"):
+                readable_head_outputs = head.make_output_human_readable(head_outputs)
             for key, value in readable_head_outputs.items():
                 output_dict[f"{head_name}_{key}"] = value
         return output_dict
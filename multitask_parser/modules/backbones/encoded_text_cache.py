@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+import torch
+
+
+class EncodedTextCache:
+    """
+    A least-recently-used cache of per-sentence encoder outputs.
+    Entries are keyed by the model id and the token ids of a sentence, so exact-duplicate
+    sentences can skip the transformer entirely at inference time. The cache is bounded by the
+    memory taken up by the stored tensors; the oldest entries are evicted once the cap is exceeded.
+    # Parameters
+    max_memory_mb : `float`
+        The maximum amount of memory (in megabytes) the cached tensors may take up.
+    """
+
+    def __init__(self, max_memory_mb: float) -> None:
+        if max_memory_mb <= 0:
+            raise ValueError(f"max_memory_mb must be positive but found {max_memory_mb}.")
+        self._max_bytes = int(max_memory_mb * 1024 * 1024)
+        self._entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self._num_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        tensor = self._entries.get(key)
+        if tensor is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return tensor
+
+    def put(self, key: Hashable, tensor: torch.Tensor) -> None:
+        # clone so that we don't keep the storage of the whole batch alive
+        tensor = tensor.detach().clone()
+        num_bytes = tensor.numel() * tensor.element_size()
+        if num_bytes > self._max_bytes:
+            return
+        if key in self._entries:
+            old = self._entries.pop(key)
+            self._num_bytes -= old.numel() * old.element_size()
+        self._entries[key] = tensor
+        self._num_bytes += num_bytes
+        while self._num_bytes > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.numel() * evicted.element_size()
+            self._evictions += 1
+
+    def clear(self) -> None:
+        """Drops all entries, e.g. because the parameters of the encoder have changed."""
+        self._entries.clear()
+        self._num_bytes = 0
+
+    def get_metrics(self, reset: bool = False) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        metrics = {
+            "cache_hits": float(self._hits),
+            "cache_misses": float(self._misses),
+            "cache_hit_rate": self._hits / lookups if lookups else 0.0,
+            "cache_evictions": float(self._evictions),
+            "cache_entries": float(len(self._entries)),
+            "cache_memory_mb": self._num_bytes / (1024 * 1024),
+        }
+        if reset:
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+        return metrics
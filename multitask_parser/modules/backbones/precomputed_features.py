@@ -0,0 +1,42 @@
+from typing import Dict
+
+import torch
+
+from allennlp.data import TextFieldTensors, Vocabulary
+from allennlp.modules import InputVariationalDropout
+from allennlp.modules.backbones.backbone import Backbone
+from allennlp.nn import util
+
+
+@Backbone.register("precomputed_features")
+class PrecomputedFeaturesBackbone(Backbone):
+    """
+    Registered as a `Backbone` with name "precomputed_features".
+    Feeds word representations which were precomputed by a frozen backbone (see
+    `scripts/precompute_backbone_features.py` and the `universal_dependencies_enhanced_precomputed`
+    dataset reader) directly to the heads, so head-only experiments don't rerun the transformer.
+    # Parameters
+    vocab : `Vocabulary`
+    dropout : `float`, optional (default = `0.0`)
+        The variational dropout applied to the precomputed representations.
+    """
+
+    def __init__(self, vocab: Vocabulary, dropout: float = 0.0) -> None:
+        super().__init__()
+        self._vocab = vocab
+        self._dropout = InputVariationalDropout(dropout)
+
+    def forward(
+        self,
+        words: TextFieldTensors,
+        precomputed_encoded_text: torch.FloatTensor,
+    ) -> Dict[str, torch.Tensor]:  # type: ignore
+        """
+        words: tensor of words, only used to compute the mask.
+        precomputed_encoded_text: tensor of shape (batch_size, sequence_length, encoder_dim).
+        Returns:
+            encoded_text: The precomputed features.
+        """
+        mask = util.get_text_field_mask(words)
+        encoded_text = self._dropout(precomputed_encoded_text.float())
+        return {"encoded_text": encoded_text, "mask": mask}
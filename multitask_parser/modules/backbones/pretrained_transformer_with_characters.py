@@ -9,13 +9,39 @@ from allennlp.data import TextFieldTensors, Vocabulary
 from allennlp.modules.backbones.backbone import Backbone
 from allennlp.modules.seq2seq_encoders.seq2seq_encoder import Seq2SeqEncoder
 from allennlp.modules.seq2vec_encoders.seq2vec_encoder import Seq2VecEncoder
-from allennlp.modules import Seq2SeqEncoder, TextFieldEmbedder, Embedding, InputVariationalDropout
+from allennlp.modules import Seq2SeqEncoder, TextFieldEmbedder, Embedding, InputVariationalDropout, ScalarMix
+from allennlp.common.checks import ConfigurationError
 
 
 from allennlp.modules.token_embedders.pretrained_transformer_embedder import (
     PretrainedTransformerEmbedder,
 )
 from allennlp.nn import util
+from multitask_parser.modules.backbones.encoded_text_cache import EncodedTextCache
+
+
+class TruncatedModuleList(torch.nn.ModuleList):
+    """
+    A `ModuleList` which only iterates over its first `num_active` modules.
+    All modules stay registered, so the parameter names of the full transformer are unchanged
+    and archives trained with a different number of layers can still be loaded.
+    """
+
+    def __init__(self, modules: torch.nn.ModuleList, num_active: int = None) -> None:
+        super().__init__(modules)
+        self.num_active = num_active if num_active is not None else len(modules)
+
+    def __iter__(self):
+        return iter(list(self._modules.values())[:self.num_active])
+
+
+def _find_transformer_layers(transformer_model: torch.nn.Module):
+    """Returns the module holding the list of transformer layers, e.g. `BertEncoder`."""
+    for module in transformer_model.modules():
+        layers = getattr(module, "layer", None)
+        if isinstance(layers, torch.nn.ModuleList):
+            return module
+    raise ConfigurationError(f"Could not find the transformer layers of {type(transformer_model).__name__}.")
 
 
 @Backbone.register("pretrained_transformer_with_characters")
@@ -43,6 +69,18 @@ class PretrainedTransformerWithCharactersBackbone(Backbone):
         "token_ids"), and convert them to strings in `make_output_human_readable` (with key
         "tokens").  This is necessary for certain demo functionality, and it adds only a trivial
         amount of computation if you are not using a demo.
+    pretrained_model_name : `str`, optional (default = `None`)
+        The name of the pretrained transformer. Used to key the encoded text cache.
+    encoded_text_cache_mb : `float`, optional (default = `None`)
+        If given, the encoded word representations of each sentence are cached at inference time
+        in an LRU cache which takes up at most this many megabytes. Exact-duplicate sentences then
+        skip the word embedder and encoder. The cache is cleared whenever the model is put back
+        into training mode or new weights are loaded into it.
+    transformer_layers : `int`, optional (default = `None`)
+        If given, only the first `transformer_layers` layers of the pretrained transformer are run.
+        If the transformer embedder uses a scalar mix (`last_layer_only: false`), the scalar mix is
+        learned over these layers only. See also `set_transformer_layers` and
+        `scripts/calibrate_transformer_layers.py`.
     """
 
     def __init__(
@@ -60,6 +98,8 @@ class PretrainedTransformerWithCharactersBackbone(Backbone):
             input_dropout_word: float = 0.0,
             input_dropout_character: float = 0.0,
             pretrained_model_name: str = None,
+            encoded_text_cache_mb: float = None,
+            transformer_layers: int = None,
     ) -> None:
         super().__init__()
         self._vocab = vocab
@@ -87,6 +127,154 @@ class PretrainedTransformerWithCharactersBackbone(Backbone):
         self._input_dropout_word = Dropout(input_dropout_word)
         self._input_dropout_character = Dropout(input_dropout_character)
 
+        self._pretrained_model_name = pretrained_model_name or "word_embedder"
+        if encoded_text_cache_mb:
+            self._encoded_text_cache = EncodedTextCache(encoded_text_cache_mb)
+        else:
+            self._encoded_text_cache = None
+
+        if transformer_layers is not None:
+            self.set_transformer_layers(transformer_layers, resize_scalar_mix=True)
+
+    def _get_transformer_embedders(self):
+        if self._word_embedder is None:
+            return []
+        return [module for module in self._word_embedder.modules() if isinstance(module, PretrainedTransformerEmbedder)]
+
+    def set_transformer_layers(self, num_layers: int, resize_scalar_mix: bool = False) -> None:
+        """
+        Only runs the first `num_layers` layers of the pretrained transformer(s) in the word embedder.
+        This can be changed at any time, e.g. at inference time to trade accuracy for speed.
+        If a transformer embedder uses a scalar mix over its layers, the scalar mix has to be resized
+        to the new number of layers, which re-initialises it; this is only allowed if
+        `resize_scalar_mix` is set, i.e. before training.
+        """
+        embedders = self._get_transformer_embedders()
+        if not embedders:
+            raise ConfigurationError("set_transformer_layers requires a pretrained transformer word embedder.")
+
+        for embedder in embedders:
+            encoder = _find_transformer_layers(embedder.transformer_model)
+            if not isinstance(encoder.layer, TruncatedModuleList):
+                encoder.layer = TruncatedModuleList(encoder.layer)
+            total_layers = len(encoder.layer)
+            if not 0 < num_layers <= total_layers:
+                raise ConfigurationError(
+                    f"The transformer has {total_layers} layers, so can't run {num_layers} layers."
+                )
+
+            scalar_mix = embedder._scalar_mix
+            if scalar_mix is not None and scalar_mix.mixture_size != num_layers:
+                if not resize_scalar_mix:
+                    raise ConfigurationError(
+                        f"The transformer embedder mixes {scalar_mix.mixture_size} layers and can't be "
+                        f"truncated to {num_layers} layers after training."
+                    )
+                embedder._scalar_mix = ScalarMix(num_layers)
+            encoder.layer.num_active = num_layers
+
+        # the cached representations were computed with the previous number of layers
+        if self._encoded_text_cache is not None:
+            self._encoded_text_cache.clear()
+
+    def get_transformer_layers(self) -> int:
+        """The number of transformer layers which are run, see `set_transformer_layers`."""
+        embedder = self._get_transformer_embedders()[0]
+        encoder = _find_transformer_layers(embedder.transformer_model)
+        if isinstance(encoder.layer, TruncatedModuleList):
+            return encoder.layer.num_active
+        return len(encoder.layer)
+
+    @overrides
+    def train(self, mode: bool = True):
+        # cached representations are stale once the parameters can change
+        if mode and self._encoded_text_cache is not None:
+            self._encoded_text_cache.clear()
+        return super().train(mode)
+
+    @overrides
+    def _load_from_state_dict(self, *args, **kwargs):
+        # called for this module whenever weights are loaded into the model, e.g. when the trainer
+        # restores the best weights, which may happen in evaluation mode
+        if self._encoded_text_cache is not None:
+            self._encoded_text_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def _encode_words(self, words: TextFieldTensors, word_mask: torch.BoolTensor) -> torch.Tensor:
+        embedded_words = self._word_embedder(words)
+        embedded_words = self._input_dropout_word(embedded_words)
+        # encoder if using a seq2seq or seq2vec model
+        if self._word_encoder:
+            encoded_words = self._word_encoder(embedded_words, word_mask)
+            encoded_words = self._dropout(encoded_words)
+        else:
+            encoded_words = embedded_words
+        return encoded_words
+
+    def _get_cache_keys(self, words: TextFieldTensors, word_mask: torch.BoolTensor):
+        """
+        Builds a hashable key for each sentence in the batch from the model id and the
+        (unpadded) token ids and word offsets of the sentence.
+        """
+        # we only allow a single TokenIndexer, see `forward`
+        tensors = next(iter(words.values()))
+        # pretrained transformer indexers use "token_ids", single id indexers use "tokens"
+        token_ids = tensors["token_ids"] if "token_ids" in tensors else tensors["tokens"]
+        token_mask = tensors.get("wordpiece_mask", tensors.get("mask", word_mask))
+        offsets = tensors.get("offsets")
+
+        num_words = word_mask.sum(dim=1).tolist()
+        num_tokens = token_mask.sum(dim=1).tolist()
+        token_ids = token_ids.tolist()
+        offsets = offsets.tolist() if offsets is not None else None
+
+        keys = []
+        for i, (sentence_token_ids, sentence_num_tokens) in enumerate(zip(token_ids, num_tokens)):
+            key = (self._pretrained_model_name, tuple(sentence_token_ids[:sentence_num_tokens]))
+            if offsets is not None:
+                key += tuple(tuple(offset) for offset in offsets[i][:num_words[i]])
+            keys.append(key)
+        return keys, num_words
+
+    def _encode_words_with_cache(self, words: TextFieldTensors, word_mask: torch.BoolTensor) -> torch.Tensor:
+        """
+        Like `_encode_words`, but looks up each sentence in the encoded text cache first and
+        only runs the word embedder on the sentences which were not found.
+        """
+        keys, num_words = self._get_cache_keys(words, word_mask)
+        cached = [self._encoded_text_cache.get(key) for key in keys]
+        missing = [i for i, representation in enumerate(cached) if representation is None]
+
+        encoded_missing = None
+        if missing:
+            missing_indices = torch.tensor(missing, dtype=torch.long, device=word_mask.device)
+            missing_words = {
+                indexer_name: {
+                    name: tensor.index_select(0, missing_indices) for name, tensor in indexer_tensors.items()
+                }
+                for indexer_name, indexer_tensors in words.items()
+            }
+            encoded_missing = self._encode_words(missing_words, word_mask.index_select(0, missing_indices))
+
+        template = encoded_missing if encoded_missing is not None else cached[0]
+        batch_size, sequence_length = word_mask.size()
+        encoded_words = template.new_zeros(batch_size, sequence_length, template.size(-1))
+
+        for position, i in enumerate(missing):
+            representation = encoded_missing[position, :num_words[i]]
+            encoded_words[i, :num_words[i]] = representation
+            self._encoded_text_cache.put(keys[i], representation)
+        for i, representation in enumerate(cached):
+            if representation is not None:
+                encoded_words[i, :num_words[i]] = representation
+
+        return encoded_words
+
+    def get_metrics(self, reset: bool = False) -> Dict[str, float]:
+        if self._encoded_text_cache is None:
+            return {}
+        return self._encoded_text_cache.get_metrics(reset)
+
     def find_word_start_and_end_indices(self, character_tensor):
         """
         Iterate over the characters of each sentence to find
@@ -251,14 +439,10 @@ class PretrainedTransformerWithCharactersBackbone(Backbone):
         # Word view
         # pretrained transformer just requires an embedder
         if self._word_embedder:
-            embedded_words = self._word_embedder(words)
-            embedded_words = self._input_dropout_word(embedded_words)
-            # encoder if using a seq2seq or seq2vec model
-            if self._word_encoder:
-                encoded_words = self._word_encoder(embedded_words, word_mask)
-                encoded_words = self._dropout(encoded_words)
+            if self._encoded_text_cache is not None and not self.training:
+                encoded_words = self._encode_words_with_cache(words, word_mask)
             else:
-                encoded_words = embedded_words
+                encoded_words = self._encode_words(words, word_mask)
         else:
             encoded_words = None
 
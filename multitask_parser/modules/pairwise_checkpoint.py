@@ -0,0 +1,32 @@
+"""
+Activation checkpointing for the pairwise (sequence_length x sequence_length) scorers of the parsing heads.
+"""
+from typing import Callable, Sequence, Tuple, Union
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def checkpoint_pairwise(
+    function: Callable[..., Union[torch.Tensor, Tuple[torch.Tensor, ...]]],
+    row_inputs: Sequence[torch.Tensor],
+    column_inputs: Sequence[torch.Tensor],
+    chunk_size: int = None,
+) -> Union[torch.Tensor, Tuple[torch.Tensor, ...]]:
+    """
+    Computes `function(*row_inputs, *column_inputs)` in chunks of `chunk_size` rows, i.e. slices
+    of dimension 1 of the `row_inputs`, without keeping the intermediate activations of `function`
+    for the backward pass: they are recomputed one chunk at a time instead.
+    `function` must return one tensor, or a tuple of tensors, whose dimension 1 corresponds to the rows.
+    The outputs of the chunks are concatenated along that dimension.
+    """
+    num_rows = row_inputs[0].size(1)
+    chunk_size = chunk_size or num_rows
+    outputs = []
+    for start in range(0, num_rows, chunk_size):
+        chunks = [row_input[:, start:start + chunk_size] for row_input in row_inputs]
+        outputs.append(checkpoint(function, *chunks, *column_inputs))
+
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(chunk_outputs, dim=1) for chunk_outputs in zip(*outputs))
+    return torch.cat(outputs, dim=1)
@@ -23,6 +23,9 @@ class ConlluPredictor(Predictor):
                 dataset_reader: DatasetReader,
                 ) -> None:
         super().__init__(model, dataset_reader)
+        # the lines written back to CoNLL-U need the full metadata, see `lean_metadata`
+        if getattr(dataset_reader, "lean_metadata", False):
+            dataset_reader.lean_metadata = False
     
     def predict(self,
                 sentence: str,
@@ -9,11 +9,14 @@ based on the implementation in: https://github.com/Hyperparticle/udify/blob/mast
 from typing import Dict, Any, List, Tuple
 from overrides import overrides
 
+from allennlp.common.checks import ConfigurationError
 from allennlp.common.util import JsonDict, sanitize
 from allennlp.data import DatasetReader, Instance
 from allennlp.models import Model
 from allennlp.predictors.predictor import Predictor
 
+from multitask_parser.graph_repair import REPAIR_MODES, repair_graph
+
 @Predictor.register("enhanced-predictor")
 class EnhancedPredictor(Predictor):
     """
@@ -21,9 +24,18 @@ class EnhancedPredictor(Predictor):
     a set of heads and tags for it.
     Predictor for the :class:`~allennlp.models.BiaffineDependencyParser` model
     but extended to write conllu lines.
+    If `graph_repair` is one of the modes of `multitask_parser.graph_repair`, the predicted
+    enhanced graphs are made rooted and connected before they are written, e.g. with
+    `--predictor-args '{"graph_repair": "best_guess"}'`, instead of running `scripts/connect_graph.py`.
     """
-    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
+    def __init__(self, model: Model, dataset_reader: DatasetReader, graph_repair: str = None) -> None:
         super().__init__(model, dataset_reader)
+        # the lines written back to CoNLL-U need the full metadata, see `lean_metadata`
+        if getattr(dataset_reader, "lean_metadata", False):
+            dataset_reader.lean_metadata = False
+        if graph_repair is not None and graph_repair not in REPAIR_MODES:
+            raise ConfigurationError(f"graph_repair must be one of {REPAIR_MODES} but found {graph_repair}.")
+        self._graph_repair = graph_repair
     
     def predict(self, sentence: str) -> JsonDict: 
         return self.predict_json({"sentence": sentence})
@@ -64,6 +76,43 @@ class EnhancedPredictor(Predictor):
 
         replace_tokens(instance, "head_tags", "case")
 
+    def _repair_graph(self, outputs: JsonDict, predicted_arcs: List, predicted_arc_tags: List) -> Tuple[List, List]:
+        """
+        Makes the predicted graph rooted and connected, using the basic tree of the input
+        for the `best_guess` and `try_use_basic` modes. The nodes are the 1-indexed positions
+        of the words, as in the predicted arcs.
+        """
+        nodes = list(range(1, len(outputs["words"]) + 1))
+        incoming_edges = {node: [] for node in nodes}
+        for (head, dep), tag in zip(predicted_arcs, predicted_arc_tags):
+            if dep in incoming_edges:
+                incoming_edges[dep].append((head, tag))
+
+        original_to_new_indices = outputs["original_to_new_indices"]
+        basic_edges = {}
+        for node, conllu_id, head, tag in zip(nodes, outputs["ids"], outputs["head_indices"], outputs["head_tags"]):
+            # elided tokens don't have a head in the basic tree
+            if type(conllu_id) != int or type(head) != int:
+                continue
+            if type(original_to_new_indices) == dict:
+                head = original_to_new_indices.get(head)
+            if head is not None:
+                basic_edges[node] = (head, tag)
+
+        repaired_edges = repair_graph(nodes, incoming_edges, self._graph_repair, basic_edges, root=0)
+
+        arcs = []
+        arc_tags = []
+        for node in nodes:
+            edges = repaired_edges[node]
+            if edges != incoming_edges[node]:
+                # keep the heads of repaired words in order
+                edges = sorted(edges)
+            for head, tag in edges:
+                arcs.append((head, node))
+                arc_tags.append(tag)
+        return arcs, arc_tags
+
     @overrides
     def dump_line(self, outputs: JsonDict) -> str:
         conllu_metadata = outputs["conllu_metadata"]
@@ -82,6 +131,9 @@ class EnhancedPredictor(Predictor):
             else:
                 cleaned_heads.append(head)
         outputs["head_indices"] = cleaned_heads
+
+        if self._graph_repair is not None:
+            predicted_arcs, predicted_arc_tags = self._repair_graph(outputs, predicted_arcs, predicted_arc_tags)
                      
         # dictionary mapping original conllu IDs (which contain float-values) to 1-indexed IDs as they appear in the sentence
         # if there are no elided tokens this is None
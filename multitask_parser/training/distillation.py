@@ -0,0 +1,95 @@
+"""
+Soft-target losses used to distil a trained multitask parser (the teacher) into a smaller student.
+The teacher outputs are cached per sentence by `scripts/cache_teacher_outputs.py` and read back
+with the `universal_dependencies_enhanced_precomputed` dataset reader.
+"""
+import torch
+import torch.nn.functional as F
+
+from allennlp.nn.util import masked_log_softmax
+
+
+def soft_arc_loss(
+    arc_scores: torch.Tensor, teacher_arc_probs: torch.Tensor, mask: torch.BoolTensor
+) -> torch.Tensor:
+    """
+    Binary cross-entropy between the student arc scores and the teacher arc probabilities.
+    # Parameters
+    arc_scores : `torch.Tensor`, required.
+        A tensor of shape (batch_size, sequence_length, sequence_length) of arc logits.
+    teacher_arc_probs : `torch.Tensor`, required.
+        A tensor of shape (batch_size, sequence_length, sequence_length) of teacher arc probabilities.
+    mask : `torch.BoolTensor`, required.
+        A mask of shape (batch_size, sequence_length), including the ROOT token.
+    """
+    pair_mask = (mask.unsqueeze(1) & mask.unsqueeze(2)).float()
+    loss = F.binary_cross_entropy_with_logits(arc_scores, teacher_arc_probs, reduction="none")
+    return (loss * pair_mask).sum() / pair_mask.sum().clamp(min=1)
+
+
+def soft_edge_tag_loss(
+    arc_tag_logits: torch.Tensor, teacher_edges: torch.Tensor, teacher_edge_tag_probs: torch.Tensor
+) -> torch.Tensor:
+    """
+    Cross-entropy between the student tag distribution and the teacher tag distribution
+    on the edges the teacher predicted.
+    # Parameters
+    arc_tag_logits : `torch.Tensor`, required.
+        A tensor of shape (batch_size, sequence_length, sequence_length, num_tags).
+    teacher_edges : `torch.Tensor`, required.
+        A tensor of shape (batch_size, num_edges, 2) of (head, dependent) pairs, padded with -1.
+    teacher_edge_tag_probs : `torch.Tensor`, required.
+        A tensor of shape (batch_size, num_edges, num_tags) of teacher tag probabilities for each edge.
+    """
+    teacher_edges = teacher_edges.long()
+    valid = (teacher_edges[..., 0] >= 0).float()
+    teacher_edges = teacher_edges.clamp(min=0)
+    batch_index = torch.arange(teacher_edges.size(0), device=teacher_edges.device).unsqueeze(1)
+    # shape (batch_size, num_edges, num_tags)
+    edge_tag_logits = arc_tag_logits[batch_index, teacher_edges[..., 0], teacher_edges[..., 1]]
+    loss = -(teacher_edge_tag_probs * F.log_softmax(edge_tag_logits, dim=-1)).sum(-1)
+    return (loss * valid).sum() / valid.sum().clamp(min=1)
+
+
+def soft_head_loss(
+    attended_arcs: torch.Tensor, teacher_head_probs: torch.Tensor, mask: torch.BoolTensor
+) -> torch.Tensor:
+    """
+    Cross-entropy between the student and teacher distributions over the head of each word,
+    i.e. the softmax of the teacher's arc scores over the candidate heads of each word. This is a
+    separate distribution per word, not the tree marginals of the MST energies.
+    # Parameters
+    attended_arcs : `torch.Tensor`, required.
+        A tensor of shape (batch_size, sequence_length, sequence_length) of (child, head) scores.
+    teacher_head_probs : `torch.Tensor`, required.
+        A tensor of the same shape containing the teacher's head distribution for each child.
+    mask : `torch.BoolTensor`, required.
+        A mask of shape (batch_size, sequence_length), including the ROOT token.
+    """
+    child_mask = mask.clone()
+    child_mask[:, 0] = False
+    child_mask = child_mask.float()
+    log_probs = masked_log_softmax(attended_arcs, mask)
+    loss = -(teacher_head_probs * log_probs).sum(-1)
+    return (loss * child_mask).sum() / child_mask.sum().clamp(min=1)
+
+
+def soft_head_tag_loss(
+    head_tag_logits: torch.Tensor, teacher_head_tag_probs: torch.Tensor, mask: torch.BoolTensor
+) -> torch.Tensor:
+    """
+    Cross-entropy between the student and teacher tag distributions of each word,
+    where `head_tag_logits` were computed for the teacher's heads.
+    # Parameters
+    head_tag_logits : `torch.Tensor`, required.
+        A tensor of shape (batch_size, sequence_length, num_head_tags).
+    teacher_head_tag_probs : `torch.Tensor`, required.
+        A tensor of the same shape containing the teacher's tag distribution for each word.
+    mask : `torch.BoolTensor`, required.
+        A mask of shape (batch_size, sequence_length), including the ROOT token.
+    """
+    child_mask = mask.clone()
+    child_mask[:, 0] = False
+    child_mask = child_mask.float()
+    loss = -(teacher_head_tag_probs * F.log_softmax(head_tag_logits, dim=-1)).sum(-1)
+    return (loss * child_mask).sum() / child_mask.sum().clamp(min=1)
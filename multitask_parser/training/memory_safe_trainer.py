@@ -0,0 +1,301 @@
+import copy
+import logging
+import math
+from typing import Any, Dict, List, Optional, Union
+
+from overrides import overrides
+import torch
+
+from allennlp.common import Lazy
+from allennlp.common.checks import ConfigurationError
+from allennlp.data import DataLoader, TensorDict
+from allennlp.models.model import Model
+from allennlp.nn.util import get_text_field_mask
+from allennlp.training.callbacks import TrainerCallback
+from allennlp.training.checkpointer import Checkpointer
+from allennlp.training.learning_rate_schedulers import LearningRateScheduler
+from allennlp.training.metrics import Metric
+from allennlp.training.momentum_schedulers import MomentumScheduler
+from allennlp.training.moving_average import MovingAverage
+from allennlp.training.optimizers import Optimizer
+from allennlp.training.trainer import GradientDescentTrainer, Trainer
+
+logger = logging.getLogger(__name__)
+
+
+def _is_out_of_memory(error: RuntimeError) -> bool:
+    return "out of memory" in str(error)
+
+
+def _batch_size(batch: Any) -> Optional[int]:
+    if isinstance(batch, torch.Tensor):
+        return batch.size(0) if batch.dim() > 0 else None
+    if isinstance(batch, dict):
+        for value in batch.values():
+            size = _batch_size(value)
+            if size is not None:
+                return size
+    return None
+
+
+def _sentence_lengths(batch: TensorDict) -> Optional[List[int]]:
+    # the only dictionaries of a batch are the tensors of its text fields
+    for value in batch.values():
+        if isinstance(value, dict):
+            return get_text_field_mask(value).sum(-1).tolist()
+    return None
+
+
+def _model_metrics(model: torch.nn.Module) -> List[Metric]:
+    # the heads keep their metrics as attributes or in dictionaries of metrics
+    metrics = []
+    for module in model.modules():
+        for value in vars(module).values():
+            if isinstance(value, Metric):
+                metrics.append(value)
+            elif isinstance(value, dict):
+                metrics.extend(metric for metric in value.values() if isinstance(metric, Metric))
+    return metrics
+
+
+def _slice_batch(batch: Any, start: int, end: int, batch_size: int) -> Any:
+    """
+    The instances `start` to `end` of a batch, i.e. of every tensor and list with one element per
+    instance. The tensors are still padded to the longest sentence of the whole batch.
+    """
+    if isinstance(batch, dict):
+        return {key: _slice_batch(value, start, end, batch_size) for key, value in batch.items()}
+    if isinstance(batch, torch.Tensor) and batch.dim() > 0 and batch.size(0) == batch_size:
+        return batch[start:end]
+    if isinstance(batch, list) and len(batch) == batch_size:
+        return batch[start:end]
+    return batch
+
+
+class _AccumulatedLoss(torch.autograd.Function):
+    """
+    The summed loss of sub-batches which have already been backpropagated, with the accumulated
+    gradients of the sub-batches as its gradients with respect to the parameters.
+    """
+
+    @staticmethod
+    def forward(ctx, loss, grads, *parameters):  # type: ignore
+        ctx.grads = grads
+        return loss.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):  # type: ignore
+        return (None, None) + tuple(None if grad is None else grad * grad_output for grad in ctx.grads)
+
+
+@Trainer.register("memory_safe_gradient_descent", constructor="from_partial_objects")
+class MemorySafeGradientDescentTrainer(GradientDescentTrainer):
+    """
+    A `GradientDescentTrainer` that splits training batches into sub-batches whose losses are
+    accumulated, so a batch with a long outlier sentence does not run out of GPU memory.
+
+    Before the forward pass, the memory of the heads is estimated with the `estimate_memory` method
+    of the model (see `MultiTaskModelV2.estimate_memory`), and a batch whose estimate is above
+    `max_batch_memory_mb` is split into the fewest equal sub-batches whose estimates are not. If a
+    (sub-)batch still runs out of memory in the forward or the backward pass, it is retried in
+    sub-batches of half the size, down to single sentences. Every split is logged.
+
+    The sub-batches are run forward and backward one after the other, and their losses are weighted by
+    their share of the words of the batch (the sum of its text field mask), as the heads return losses
+    averaged over words. For those losses the gradient of a split batch is that of the whole batch;
+    the losses of the enhanced heads are averaged over word pairs, so theirs is close to it.
+    The trainer then backpropagates their summed loss, whose gradients are the accumulated gradients
+    of the sub-batches, so gradient accumulation, gradient scaling with `use_amp` and regularization
+    work as with the base trainer. The other outputs passed to the callbacks are those of the last
+    sub-batch. When a batch is retried, the metrics of the model are restored to their state before
+    the batch, so the sub-batches which ran before the failure are not counted twice.
+    Validation batches are not split.
+
+    Registered as a `Trainer` with name "memory_safe_gradient_descent". It takes the parameters of
+    the "gradient_descent" trainer and:
+
+    # Parameters
+    max_batch_memory_mb : `float`, optional (default = `None`)
+        The memory budget of the heads for a batch, in MB. A budget of a few GB below the memory of
+        the GPU leaves room for the backbone. If `None`, batches are only split when they run out
+        of memory.
+    retry_on_oom : `bool`, optional (default = `True`)
+        Whether to retry the batches that run out of memory in smaller sub-batches.
+    """
+
+    def __init__(
+        self, *args, max_batch_memory_mb: float = None, retry_on_oom: bool = True, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._max_batch_memory_mb = max_batch_memory_mb
+        self._retry_on_oom = retry_on_oom
+
+    @overrides
+    def batch_outputs(self, batch: TensorDict, for_training: bool) -> Dict[str, torch.Tensor]:
+        # the workers of distributed training would not agree on the number of backward passes
+        if not for_training or self._distributed or (
+            self._max_batch_memory_mb is None and not self._retry_on_oom
+        ):
+            return super().batch_outputs(batch, for_training)
+
+        batch_size = _batch_size(batch)
+        num_splits = self._estimate_num_splits(batch, batch_size)
+        # the metrics are updated in the forward passes of the sub-batches, which are all run again on a retry
+        metrics = _model_metrics(self.model) if self._retry_on_oom else []
+        metric_states = [copy.deepcopy(vars(metric)) for metric in metrics]
+        while True:
+            try:
+                output_dict = self._accumulate_sub_batches(batch, batch_size, num_splits)
+                break
+            except RuntimeError as error:
+                if not (self._retry_on_oom and _is_out_of_memory(error)) or num_splits >= batch_size:
+                    raise
+            # outside of the except clause, so that the tensors referenced by the traceback are freed
+            torch.cuda.empty_cache()
+            for metric, state in zip(metrics, metric_states):
+                vars(metric).clear()
+                vars(metric).update(copy.deepcopy(state))
+            num_splits = min(2 * num_splits, batch_size)
+            logger.warning(
+                "Out of memory on a batch of %d sentences, retrying in %d sub-batches",
+                batch_size, num_splits,
+            )
+
+        regularization_penalty = self.model.get_regularization_penalty()
+        if regularization_penalty is not None:
+            output_dict["reg_loss"] = regularization_penalty
+            output_dict["loss"] = output_dict["loss"] + regularization_penalty
+        return output_dict
+
+    def _estimate_num_splits(self, batch: TensorDict, batch_size: int) -> int:
+        if self._max_batch_memory_mb is None or not hasattr(self.model, "estimate_memory"):
+            return 1
+        lengths = _sentence_lengths(batch)
+        if not lengths:
+            return 1
+        budget = self._max_batch_memory_mb * 2 ** 20
+        # the sub-batches keep the padding of the batch
+        padded_length = max(lengths)
+        for num_splits in range(1, batch_size + 1):
+            sub_batch_size = math.ceil(batch_size / num_splits)
+            estimate = self.model.estimate_memory([padded_length] * sub_batch_size)
+            if estimate <= budget:
+                break
+        else:
+            logger.warning(
+                "A single sentence of %d words is estimated to need %.0f MB, above the budget of %.0f MB",
+                padded_length, estimate / 2 ** 20, self._max_batch_memory_mb,
+            )
+        if num_splits > 1:
+            logger.info(
+                "Splitting a batch of %d sentences of up to %d words (estimated %.0f MB) into %d sub-batches",
+                batch_size, padded_length, self.model.estimate_memory(lengths) / 2 ** 20, num_splits,
+            )
+        return num_splits
+
+    def _accumulate_sub_batches(
+        self, batch: TensorDict, batch_size: int, num_splits: int
+    ) -> Dict[str, torch.Tensor]:
+        parameters = [parameter for parameter in self.model.parameters() if parameter.requires_grad]
+        # the gradients of the previous batches of the batch group are put back afterwards, and the
+        # gradients of the sub-batches are discarded if one of them runs out of memory
+        previous_grads = [parameter.grad for parameter in parameters]
+        for parameter in parameters:
+            parameter.grad = None
+        # the heads average their losses over the words of a (sub-)batch
+        lengths = _sentence_lengths(batch) or [1] * batch_size
+        num_words = sum(lengths)
+        try:
+            sub_batch_size = math.ceil(batch_size / num_splits)
+            loss = None
+            for start in range(0, batch_size, sub_batch_size):
+                end = min(start + sub_batch_size, batch_size)
+                output_dict = self._pytorch_model(**_slice_batch(batch, start, end, batch_size))
+                if "loss" not in output_dict:
+                    raise RuntimeError(
+                        "The model you are trying to optimize does not contain a"
+                        " 'loss' key in the output of model.forward(inputs)."
+                    )
+                sub_batch_loss = output_dict["loss"] * sum(lengths[start:end]) / num_words
+                if self._scaler is not None:
+                    self._scaler.scale(sub_batch_loss).backward()
+                else:
+                    sub_batch_loss.backward()
+                sub_batch_loss = sub_batch_loss.detach()
+                loss = sub_batch_loss if loss is None else loss + sub_batch_loss
+            grads = [parameter.grad for parameter in parameters]
+        finally:
+            for parameter, grad in zip(parameters, previous_grads):
+                parameter.grad = grad
+
+        if self._scaler is not None:
+            # the trainer scales the loss again before backpropagating it
+            scale = self._scaler.get_scale()
+            for grad in grads:
+                if grad is not None:
+                    grad.div_(scale)
+        output_dict["loss"] = _AccumulatedLoss.apply(loss, grads, *parameters)
+        return output_dict
+
+    @classmethod
+    def from_partial_objects(
+        cls,
+        model: Model,
+        serialization_dir: str,
+        data_loader: DataLoader,
+        validation_data_loader: DataLoader = None,
+        local_rank: int = 0,
+        patience: int = None,
+        validation_metric: Union[str, List[str]] = "-loss",
+        num_epochs: int = 20,
+        cuda_device: Optional[Union[int, torch.device]] = None,
+        grad_norm: float = None,
+        grad_clipping: float = None,
+        distributed: bool = False,
+        world_size: int = 1,
+        num_gradient_accumulation_steps: int = 1,
+        use_amp: bool = False,
+        no_grad: List[str] = None,
+        optimizer: Lazy[Optimizer] = Lazy(Optimizer.default),
+        learning_rate_scheduler: Lazy[LearningRateScheduler] = None,
+        momentum_scheduler: Lazy[MomentumScheduler] = None,
+        moving_average: Lazy[MovingAverage] = None,
+        checkpointer: Lazy[Checkpointer] = Lazy(Checkpointer),
+        callbacks: List[Lazy[TrainerCallback]] = None,
+        enable_default_callbacks: bool = True,
+        run_sanity_checks: bool = True,
+        max_batch_memory_mb: float = None,
+        retry_on_oom: bool = True,
+    ) -> "Trainer":
+        if distributed and (max_batch_memory_mb is not None or retry_on_oom):
+            # the workers would not agree on the number of backward passes of a batch
+            raise ConfigurationError("memory_safe_gradient_descent does not support distributed training")
+        trainer = super().from_partial_objects(
+            model=model,
+            serialization_dir=serialization_dir,
+            data_loader=data_loader,
+            validation_data_loader=validation_data_loader,
+            local_rank=local_rank,
+            patience=patience,
+            validation_metric=validation_metric,
+            num_epochs=num_epochs,
+            cuda_device=cuda_device,
+            grad_norm=grad_norm,
+            grad_clipping=grad_clipping,
+            distributed=distributed,
+            world_size=world_size,
+            num_gradient_accumulation_steps=num_gradient_accumulation_steps,
+            use_amp=use_amp,
+            no_grad=no_grad,
+            optimizer=optimizer,
+            learning_rate_scheduler=learning_rate_scheduler,
+            momentum_scheduler=momentum_scheduler,
+            moving_average=moving_average,
+            checkpointer=checkpointer,
+            callbacks=callbacks,
+            enable_default_callbacks=enable_default_callbacks,
+            run_sanity_checks=run_sanity_checks,
+        )
+        trainer._max_batch_memory_mb = max_batch_memory_mb
+        trainer._retry_on_oom = retry_on_oom
+        return trainer
@@ -0,0 +1,191 @@
+"""
+Opt-in instrumentation of the stages of a training or prediction step: data collation, the backbone,
+the scoring of each head, decoding, the conversion to human-readable output and the metric updates.
+`multitask_v2` reports the wall time and the peak allocated CUDA memory of each stage as metrics
+when it is built with `instrument_stages`, and can also write them as a Chrome trace.
+"""
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import time
+from typing import Dict, Iterator, List
+
+import torch
+
+_NULL_STAGE = nullcontext()
+
+
+class StageTimer:
+    """
+    Accumulates the wall time and the peak allocated CUDA memory of named stages.
+
+    Stages can be nested. The time of a stage excludes the time spent in the stages nested in it,
+    so the times of all the stages add up to the instrumented total, whereas the peak memory of a
+    stage includes its nested stages. The peak memory counter of PyTorch is reset at the start of
+    every stage, so peaks reported by other code (e.g. the trainer's GPU memory metrics) only cover
+    the last stage when this timer is enabled.
+
+    # Parameters
+    enabled : `bool`, optional (default = `True`)
+        If False, `stage` returns a no-op context manager and no metrics are reported.
+    trace_file : `str`, optional (default = `None`)
+        If given, every stage is also written to this file as a complete event of a Chrome trace,
+        which can be opened with chrome://tracing or https://ui.perfetto.dev. The events are
+        written when the metrics are reset and every `max_buffered_events` events.
+    synchronize : `bool`, optional (default = `True`)
+        Wait for the queued CUDA kernels at the start and the end of each stage, so the time of
+        a stage is the time its kernels take rather than the time it takes to launch them.
+    max_buffered_events : `int`, optional (default = `10000`)
+        The number of trace events kept in memory before they are written to `trace_file`.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        trace_file: str = None,
+        synchronize: bool = True,
+        max_buffered_events: int = 10000,
+    ) -> None:
+        self.enabled = enabled
+        self.trace_file = trace_file
+        self.synchronize = synchronize
+        self.max_buffered_events = max_buffered_events
+        # one [name, start, peak memory, time of the nested stages] frame per open stage
+        self._open_stages: List[list] = []
+        self._seconds: Dict[str, float] = {}
+        self._calls: Dict[str, int] = {}
+        self._peak_bytes: Dict[str, int] = {}
+        self._events: List[Dict] = []
+        self._trace_started = False
+        self._origin = time.perf_counter()
+
+    def stage(self, name: str):
+        """
+        Returns a context manager that times the code it wraps as the stage `name`.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._timed_stage(name)
+
+    def scoped(self, prefix: str) -> "ScopedStageTimer":
+        """
+        Returns a view of this timer that prefixes the names of its stages with `prefix`,
+        e.g. for the stages of a head.
+        """
+        return ScopedStageTimer(self, prefix)
+
+    @contextmanager
+    def _timed_stage(self, name: str) -> Iterator[None]:
+        # never initialise CUDA just to measure it
+        cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        if cuda:
+            self._update_peaks()
+            torch.cuda.reset_peak_memory_stats()
+        frame = [name, time.perf_counter(), 0, 0.0]
+        self._open_stages.append(frame)
+        try:
+            yield
+        finally:
+            if cuda:
+                self._update_peaks()
+            end = time.perf_counter()
+            self._open_stages.pop()
+            elapsed = end - frame[1]
+            if self._open_stages:
+                self._open_stages[-1][3] += elapsed
+            self._seconds[name] = self._seconds.get(name, 0.0) + elapsed - frame[3]
+            self._calls[name] = self._calls.get(name, 0) + 1
+            if cuda:
+                self._peak_bytes[name] = max(self._peak_bytes.get(name, 0), frame[2])
+            if self.trace_file is not None:
+                self._events.append(
+                    {
+                        "name": name,
+                        "cat": "stage",
+                        "ph": "X",
+                        "ts": (frame[1] - self._origin) * 1e6,
+                        "dur": elapsed * 1e6,
+                        "pid": os.getpid(),
+                        "tid": 0,
+                    }
+                )
+                if len(self._events) >= self.max_buffered_events:
+                    self.write_trace()
+
+    def _update_peaks(self) -> None:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+        for frame in self._open_stages:
+            if peak > frame[2]:
+                frame[2] = peak
+
+    def get_metrics(self, reset: bool = False) -> Dict[str, float]:
+        """
+        Returns the mean time of each stage as `timing_<stage>_ms` and, on a GPU, the peak
+        allocated memory of each stage as `memory_<stage>_mb`, since the last reset.
+        """
+        if not self.enabled:
+            return {}
+        metrics = {}
+        for name, seconds in self._seconds.items():
+            metrics[f"timing_{name}_ms"] = 1000 * seconds / self._calls[name]
+        for name, peak in self._peak_bytes.items():
+            metrics[f"memory_{name}_mb"] = peak / 2 ** 20
+        if reset:
+            self._seconds.clear()
+            self._calls.clear()
+            self._peak_bytes.clear()
+            self.write_trace()
+        return metrics
+
+    def write_trace(self) -> None:
+        """
+        Appends the buffered events to `trace_file`, in the JSON array format of Chrome traces.
+        The closing bracket of the array is optional in that format, so the file can be opened
+        at any time, including while training is still running.
+        """
+        if self.trace_file is None or not self._events:
+            return
+        with open(self.trace_file, "a" if self._trace_started else "w") as trace:
+            if not self._trace_started:
+                trace.write("[\n")
+                self._trace_started = True
+            for event in self._events:
+                trace.write(json.dumps(event))
+                trace.write(",\n")
+        self._events.clear()
+
+
+class ScopedStageTimer:
+    """
+    A view of a `StageTimer` that prefixes the names of its stages, so that a head can time its
+    `decode` stage and have it reported as e.g. `timing_enhanced_dependencies_decode_ms`.
+    """
+
+    def __init__(self, timer: StageTimer, prefix: str) -> None:
+        self.timer = timer
+        self.prefix = prefix
+
+    def stage(self, name: str):
+        if not self.timer.enabled:
+            return _NULL_STAGE
+        return self.timer.stage(f"{self.prefix}_{name}")
+
+
+DISABLED_STAGE_TIMER = StageTimer(enabled=False)
+
+_active_stage_timer = DISABLED_STAGE_TIMER
+
+
+def set_active_stage_timer(timer: StageTimer) -> None:
+    """
+    Makes `timer` the one used by code that cannot be handed a timer directly,
+    such as the collation of batches in the `instrumented_multitask` data loader.
+    """
+    global _active_stage_timer
+    _active_stage_timer = timer
+
+
+def get_active_stage_timer() -> StageTimer:
+    return _active_stage_timer
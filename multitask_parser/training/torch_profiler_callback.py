@@ -0,0 +1,222 @@
+import logging
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.profiler
+
+from allennlp.data import TensorDict
+from allennlp.training.callbacks.callback import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+
+@TrainerCallback.register("torch_profiler")
+class TorchProfilerCallback(TrainerCallback):
+    """
+    Profiles a window of training batches with `torch.profiler`. The forward pass of the backbone
+    and of each head of a `multitask_v2` model is labelled with its name (e.g. "enhanced_dependencies"),
+    so its operators can be told apart in the traces and the flame graphs.
+
+    For every profiled window, the following files are written to `output_dir`:
+    - a trace that can be opened with TensorBoard (`tensorboard --logdir <output_dir>`, with the
+      torch-tb-profiler plugin), chrome://tracing or https://ui.perfetto.dev;
+    - `top_ops_<step>.txt`, the operators that took the most time;
+    - `flamegraph_<step>_<label>.txt`, the operators called under each labelled module, as collapsed
+      stacks for flamegraph.pl or https://www.speedscope.app, and `flamegraph_<step>_all.txt`
+      for the whole window.
+
+    Profiling can be enabled on any training run without editing the config, with e.g.
+    `--overrides '{"trainer": {"callbacks": [{"type": "torch_profiler", "wait": 100}]}}'`.
+    The override replaces the whole `callbacks` list of the config, so list the callbacks the config
+    already has too (e.g. `{"type": "treebank_sampling"}`), or add the profiler to the list in the
+    config instead: `"callbacks": [{"type": "treebank_sampling"}, {"type": "torch_profiler", "wait": 100}]`.
+    Registered as a `TrainerCallback` with name "torch_profiler".
+
+    # Parameters
+    serialization_dir : `str`, required.
+    wait : `int`, optional (default = `10`)
+        The number of training batches to skip before profiling. The first batches are usually
+        slower than the others (allocator warm-up, lazy initialisation).
+    warmup : `int`, optional (default = `2`)
+        The number of batches profiled but discarded before each window, to exclude the
+        overhead of starting the profiler.
+    active : `int`, optional (default = `5`)
+        The number of batches in each window.
+    repeat : `int`, optional (default = `1`)
+        The number of windows to profile, one after the other.
+    record_shapes : `bool`, optional (default = `False`)
+        Whether to record the input shapes of the operators.
+    profile_memory : `bool`, optional (default = `False`)
+        Whether to record the memory allocated and freed by the operators.
+    with_stack : `bool`, optional (default = `False`)
+        Whether to record the Python stack of the operators in the traces.
+    sort_by : `str`, optional (default = `None`)
+        The column to sort the top operators by. Defaults to "self_cuda_time_total" on a GPU and
+        "self_cpu_time_total" otherwise. The flame graphs are always weighted by these self times,
+        since the inclusive time of an operator is already the sum of its stack and its children.
+    row_limit : `int`, optional (default = `30`)
+        The number of operators in the top operators summary.
+    output_dir : `str`, optional (default = `<serialization_dir>/profiler`)
+    """
+
+    def __init__(
+        self,
+        serialization_dir: str,
+        wait: int = 10,
+        warmup: int = 2,
+        active: int = 5,
+        repeat: int = 1,
+        record_shapes: bool = False,
+        profile_memory: bool = False,
+        with_stack: bool = False,
+        sort_by: str = None,
+        row_limit: int = 30,
+        output_dir: str = None,
+    ) -> None:
+        super().__init__(serialization_dir)
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.repeat = repeat
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.row_limit = row_limit
+        self.output_dir = output_dir or os.path.join(serialization_dir, "profiler")
+        # the flame graphs sum the weights of the children under their parents, so they need self times
+        self._flamegraph_weight = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        self.sort_by = sort_by or self._flamegraph_weight
+        self._profiler: Optional[torch.profiler.profile] = None
+        self._hooks: List[Any] = []
+        self._labels: List[str] = []
+        self._steps = 0
+
+    def on_start(self, trainer, is_primary: bool = True, **kwargs) -> None:
+        super().on_start(trainer, is_primary=is_primary, **kwargs)
+        if not is_primary:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        model = trainer.model
+        modules = {}
+        if hasattr(model, "_backbone"):
+            modules["backbone"] = model._backbone
+        for head_name, head in getattr(model, "_heads", {}).items():
+            modules[head_name] = head
+        for label, module in modules.items():
+            self._label_forward(label, module)
+        self._labels = list(modules)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=self.wait, warmup=self.warmup, active=self.active, repeat=self.repeat
+            ),
+            on_trace_ready=self._trace_ready,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack,
+        )
+        self._profiler.__enter__()
+        logger.info(
+            "Profiling %d window(s) of %d training batches after %d batches, writing to %s",
+            self.repeat, self.active, self.wait + self.warmup, self.output_dir,
+        )
+
+    def _label_forward(self, label: str, module: torch.nn.Module) -> None:
+        # the forward hooks of a module enter and exit a `record_function` around its forward pass
+        open_records = []
+
+        def enter(module, inputs):
+            record = torch.profiler.record_function(label)
+            record.__enter__()
+            open_records.append(record)
+
+        def exit(module, inputs, outputs):
+            if open_records:
+                open_records.pop().__exit__(None, None, None)
+
+        self._hooks.append(module.register_forward_pre_hook(enter))
+        self._hooks.append(module.register_forward_hook(exit))
+
+    def on_batch(
+        self,
+        trainer,
+        batch_inputs: List[TensorDict],
+        batch_outputs: List[Dict[str, Any]],
+        batch_metrics: Dict[str, Any],
+        epoch: int,
+        batch_number: int,
+        is_training: bool,
+        is_primary: bool = True,
+        batch_grad_norm: Optional[float] = None,
+        **kwargs,
+    ) -> None:
+        if self._profiler is None or not is_training:
+            return
+        self._profiler.step()
+        self._steps += 1
+        if self._steps >= (self.wait + self.warmup + self.active) * self.repeat:
+            self._stop()
+
+    def on_end(self, trainer, metrics: Dict[str, Any] = None, epoch: int = None,
+               is_primary: bool = True, **kwargs) -> None:
+        # training ended before the last window was complete
+        self._stop()
+
+    def _stop(self) -> None:
+        if self._profiler is not None:
+            self._profiler.__exit__(None, None, None)
+            self._profiler = None
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _trace_ready(self, profiler: torch.profiler.profile) -> None:
+        torch.profiler.tensorboard_trace_handler(self.output_dir)(profiler)
+
+        step = profiler.step_num
+        summary = profiler.key_averages().table(sort_by=self.sort_by, row_limit=self.row_limit)
+        with open(os.path.join(self.output_dir, f"top_ops_{step}.txt"), "w") as summary_file:
+            summary_file.write(summary)
+        logger.info("Top operators of the profiled batches up to step %d:\n%s", step, summary)
+
+        for label, stacks in self._collapsed_stacks(profiler.events()).items():
+            path = os.path.join(self.output_dir, f"flamegraph_{step}_{label}.txt")
+            with open(path, "w") as flamegraph_file:
+                for stack, microseconds in sorted(stacks.items()):
+                    flamegraph_file.write(f"{stack} {microseconds}\n")
+
+    def _collapsed_stacks(self, events) -> Dict[str, Dict[str, int]]:
+        """
+        Returns the collapsed stacks ("outer;inner;op weight") of the events for the whole window,
+        as "all", and for each labelled module, rooted at the label of the module.
+        """
+        labels = set(self._labels)
+        stacks: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+        def visit(event, path: List[str], label_depth: Dict[str, int]) -> None:
+            name = event.name.replace(";", ":")
+            path.append(name)
+            if name in labels and name not in label_depth:
+                label_depth[name] = len(path) - 1
+            weight = int(getattr(event, self._flamegraph_weight, 0))
+            if weight > 0:
+                stacks["all"][";".join(path)] += weight
+                for label, depth in label_depth.items():
+                    stacks[label][";".join(path[depth:])] += weight
+            for child in event.cpu_children:
+                visit(child, path, label_depth)
+            if label_depth.get(name) == len(path) - 1:
+                del label_depth[name]
+            path.pop()
+
+        for event in events:
+            if event.cpu_parent is None:
+                visit(event, [], {})
+        return stacks
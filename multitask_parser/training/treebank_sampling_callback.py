@@ -0,0 +1,65 @@
+import logging
+import os
+import re
+from typing import Any, Dict, List
+
+from allennlp.data.dataset_readers.dataset_reader import DatasetReader
+from allennlp.training.callbacks.callback import TrainerCallback
+
+from multitask_parser.dataset_readers.multi_treebank_enhanced import MultiTreebankEnhancedDatasetReader
+
+logger = logging.getLogger(__name__)
+
+
+def _dataset_readers(data_loader) -> List[DatasetReader]:
+    # a multitask data loader has a reader per dataset
+    if hasattr(data_loader, "readers"):
+        return list(data_loader.readers.values())
+    return [data_loader.reader] if hasattr(data_loader, "reader") else []
+
+
+@TrainerCallback.register("treebank_sampling")
+class TreebankSamplingCallback(TrainerCallback):
+    """
+    Sets the epoch of the `multi_treebank_enhanced` dataset readers of the training data loader
+    before each epoch, so that each epoch reads a new sample of the treebanks. The epoch is set on
+    the reader of the main process, from which the data loader workers are started every epoch, so
+    it is the same in all of them; a counter kept by the readers themselves would only advance in
+    the workers and be lost. When training is recovered, the sampling continues from the epoch of
+    the last checkpoint.
+
+    Registered as a `TrainerCallback` with name "treebank_sampling", e.g.
+    `"trainer": {"callbacks": [{"type": "treebank_sampling"}]}`.
+    """
+
+    def on_start(self, trainer, is_primary: bool = True, **kwargs) -> None:
+        super().on_start(trainer, is_primary=is_primary, **kwargs)
+        self._readers = [
+            reader for reader in _dataset_readers(trainer.data_loader)
+            if isinstance(reader, MultiTreebankEnhancedDatasetReader)
+        ]
+        if not self._readers:
+            logger.warning("The treebank_sampling callback found no multi_treebank_enhanced reader to set the epoch of")
+        self._set_epoch(self._first_epoch(trainer))
+
+    def on_epoch(
+        self, trainer, metrics: Dict[str, Any], epoch: int, is_primary: bool = True, **kwargs
+    ) -> None:
+        super().on_epoch(trainer, metrics, epoch, is_primary=is_primary, **kwargs)
+        # called at the end of each epoch
+        if epoch >= 0:
+            self._set_epoch(epoch + 1)
+
+    def _set_epoch(self, epoch: int) -> None:
+        for reader in self._readers:
+            reader.set_epoch(epoch)
+
+    @staticmethod
+    def _first_epoch(trainer) -> int:
+        # when recovering, the trainer restarts after the epoch of its latest training state
+        checkpointer = getattr(trainer, "_checkpointer", None)
+        checkpoint = checkpointer.find_latest_checkpoint() if checkpointer is not None else None
+        if checkpoint is None:
+            return 0
+        match = re.match(r"training_state_epoch_(\d+)", os.path.basename(checkpoint[1]))
+        return int(match.group(1)) + 1 if match else 0
@@ -0,0 +1,20 @@
+"""
+Helpers shared by the scripts which run a trained model over a dataset.
+"""
+from typing import Iterable, Iterator, List, TypeVar
+import itertools
+
+T = TypeVar("T")
+
+
+def batches(iterable: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """
+    Groups the items of `iterable` into lists of `batch_size` items, the last one possibly shorter,
+    without reading more of `iterable` than the current batch.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,54 @@
+"""
+Builds (or refreshes) the sidecar sentence index of CoNLL-U files, see
+multitask_parser/dataset_readers/sentence_index.py, and prints the distribution of their
+sentence lengths, e.g. to choose the `max_tokens` of the batch sampler or `max_batch_memory_mb`.
+
+  python scripts/build_sentence_index.py data/train-dev/*/*-ud-train.conllu \
+      --transformer-model-name xlm-roberta-large --bin-width 20
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_files", type=str, nargs="+", help="The (compressed) CoNLL-U files to index.")
+parser.add_argument("--index-dir", type=str, default=None,
+                    help="The directory to write the indices to, if not next to the data files.")
+parser.add_argument("--transformer-model-name", type=str, default=None,
+                    help="Also count the wordpieces of each sentence with the tokenizer of this model.")
+parser.add_argument("--bin-width", type=int, default=10, help="The width of the bins of the length histograms.")
+parser.add_argument("--no-histogram", action="store_true", help="Only build the indices.")
+
+
+def print_histogram(index, bin_width, wordpieces=False, width=50):
+    histogram = index.length_histogram(bin_width, wordpieces)
+    if not histogram:
+        return
+    largest = max(histogram.values())
+    unit = "wordpieces" if wordpieces else "words"
+    print(f"{index.data_file}: {len(index)} sentences, {int(index.lengths(wordpieces).sum())} {unit}, "
+          f"median {index.percentile(50, wordpieces):.0f}, 95th percentile {index.percentile(95, wordpieces):.0f}, "
+          f"max {int(index.lengths(wordpieces).max())}")
+    for lower, count in histogram.items():
+        bar = "#" * max(1, round(width * count / largest))
+        print(f"  {lower:>5}-{lower + bin_width - 1:<5} {count:>7} {bar}")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for input_file in args.input_files:
+        index = SentenceIndex.load_or_build(input_file, args.transformer_model_name, args.index_dir)
+        if args.no_histogram:
+            continue
+        print_histogram(index, args.bin_width)
+        if index.num_wordpieces is not None:
+            print_histogram(index, args.bin_width, wordpieces=True)
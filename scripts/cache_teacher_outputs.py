@@ -0,0 +1,142 @@
+"""
+Runs a trained multitask parser (the teacher) over CoNLL-U files and caches its soft outputs,
+so a smaller student can be trained against them with the `distillation_weight` of the heads.
+For the enhanced head, the arc probabilities, the decoded edges and the tag distribution of each
+edge are stored; for the basic head, the head distribution of each word (the softmax of its arc
+scores over the candidate heads, not tree marginals), the MST heads and the tag distribution at
+those heads.
+
+The stores are read back by the `universal_dependencies_enhanced_precomputed` dataset reader,
+see configs/enhanced/eud_distillation_student.jsonnet.
+
+  python scripts/cache_teacher_outputs.py logs/<teacher>/model.tar.gz \
+      data/train-dev/UD_French-Sequoia/fr_sequoia-ud-train.conllu \
+      --output-dir teacher_outputs/fr_sequoia
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import torch
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.data import Batch
+from allennlp.data.fields import MetadataField
+from allennlp.models.archival import load_archive
+from allennlp.nn import util as nn_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.training.util import batches
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("archive_file", type=str, help="The teacher model archive.")
+parser.add_argument("input_files", type=str, nargs="+", help="The CoNLL-U files to parse.")
+parser.add_argument("--output-dir", type=str, required=True, help="The directory to write the teacher stores to.")
+parser.add_argument("--enhanced-head", type=str, default="enhanced_dependencies",
+                    help="The name of the enhanced dependency head, or '' to skip it.")
+parser.add_argument("--basic-head", type=str, default="dependencies",
+                    help="The name of the basic dependency head, or '' to skip it.")
+parser.add_argument("--batch-size", type=int, default=32, help="The number of sentences per batch.")
+parser.add_argument("--cuda-device", type=int, default=-1, help="The GPU to use, -1 for CPU.")
+parser.add_argument("--reader-name", type=str, default=None,
+                    help="The name of the dataset reader to use if the model was trained with a multitask reader.")
+parser.add_argument("--include-package", type=str, default="multitask_parser",
+                    help="The package containing the model components.")
+
+ENHANCED_STORES = ("teacher_arc_probs", "teacher_edges", "teacher_edge_tag_probs")
+BASIC_STORES = ("teacher_head_probs", "teacher_heads", "teacher_head_tag_probs")
+
+
+def decode_teacher_edges(arc_probs, threshold):
+    """
+    The (head, dependent) pairs of a sentence as decoded by the enhanced heads: all arcs above
+    the threshold, plus the most probable head of every word which has none.
+    """
+    selected = arc_probs > threshold
+    without_head = ~selected.any(dim=0)
+    without_head[0] = False
+    dependents = without_head.nonzero(as_tuple=False).squeeze(1)
+    selected[arc_probs[:, dependents].argmax(dim=0), dependents] = True
+    return selected.nonzero(as_tuple=False)
+
+
+def cache_teacher_outputs(model, reader, task, input_file, args):
+    # imported here so `--include-package` is applied first
+    from multitask_parser.dataset_readers.array_store import ArrayStoreWriter, get_store_prefix
+
+    store_names = []
+    if args.enhanced_head:
+        store_names.extend(ENHANCED_STORES)
+        threshold = model._heads[args.enhanced_head].edge_prediction_threshold
+    if args.basic_head:
+        store_names.extend(BASIC_STORES)
+        model._heads[args.basic_head].output_distillation_targets = True
+
+    writers = {
+        name: ArrayStoreWriter(
+            get_store_prefix(args.output_dir, input_file, name),
+            dtype="int32" if name in ("teacher_edges", "teacher_heads") else "float16",
+            data_file=input_file,
+        )
+        for name in store_names
+    }
+
+    num_sentences = 0
+    for instances in batches(reader.read(input_file), args.batch_size):
+        for instance in instances:
+            instance.add_field("task", MetadataField(task))
+            instance.index_fields(model.vocab)
+        tensor_dict = Batch(instances).as_tensor_dict()
+        tensor_dict = nn_util.move_to_device(tensor_dict, args.cuda_device)
+        outputs = model(**tensor_dict)
+
+        for i, instance in enumerate(instances):
+            num_words = len(instance["words"])
+            # the teacher outputs include the ROOT token at position 0
+            length = num_words + 1
+            if args.enhanced_head:
+                arc_probs = outputs[f"{args.enhanced_head}_arc_probs"][i, :length, :length]
+                arc_tag_probs = outputs[f"{args.enhanced_head}_arc_tag_probs"][i]
+                edges = decode_teacher_edges(arc_probs, threshold)
+                edge_tag_probs = arc_tag_probs[edges[:, 0], edges[:, 1]]
+                writers["teacher_arc_probs"].append(arc_probs.cpu().numpy(), num_words)
+                writers["teacher_edges"].append(edges.cpu().numpy(), num_words)
+                writers["teacher_edge_tag_probs"].append(edge_tag_probs.cpu().numpy(), num_words)
+            if args.basic_head:
+                head_probs = outputs[f"{args.basic_head}_head_probs"][i, :length, :length]
+                heads = outputs[f"{args.basic_head}_heads"][i, :length]
+                head_tag_probs = outputs[f"{args.basic_head}_head_tag_probs"][i, :length]
+                writers["teacher_head_probs"].append(head_probs.cpu().numpy(), num_words)
+                writers["teacher_heads"].append(heads.cpu().numpy(), num_words)
+                writers["teacher_head_tag_probs"].append(head_tag_probs.cpu().numpy(), num_words)
+        num_sentences += len(instances)
+
+    for writer in writers.values():
+        writer.close()
+    logger.info("Cached the teacher outputs of %d sentences from %s", num_sentences, input_file)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    import_module_and_submodules(args.include_package)
+
+    archive = load_archive(args.archive_file, cuda_device=args.cuda_device)
+    model = archive.model
+    model.eval()
+
+    reader = archive.validation_dataset_reader
+    task = args.reader_name
+    # multitask readers wrap one reader per data source
+    if hasattr(reader, "readers"):
+        task = task or next(iter(reader.readers))
+        reader = reader.readers[task]
+
+    with torch.no_grad():
+        for input_file in args.input_files:
+            cache_teacher_outputs(model, reader, task, input_file, args)
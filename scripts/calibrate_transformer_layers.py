@@ -0,0 +1,118 @@
+"""
+Measures the accuracy/latency trade-off of truncating the transformer of a trained model
+to its first k layers (see `transformer_layers` in the `pretrained_transformer_with_characters` backbone).
+For each k, the dev file is parsed with the enhanced predictor and scored with the
+shared-task evaluation script.
+
+  python scripts/calibrate_transformer_layers.py logs/<model>/model.tar.gz \
+      data/train-dev/UD_French-Sequoia/fr_sequoia-ud-dev.conllu --layers 4 6 8 10 12 \
+      --output-file calibration.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+import torch
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors.predictor import Predictor
+
+import iwpt21_xud_eval
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("archive_file", type=str, help="The trained model archive.")
+parser.add_argument("dev_file", type=str, help="The gold CoNLL-U file to parse and evaluate against.")
+parser.add_argument("--layers", type=int, nargs="+", default=None,
+                    help="The numbers of transformer layers to try; defaults to all of them.")
+parser.add_argument("--batch-size", type=int, default=32, help="The number of sentences per batch.")
+parser.add_argument("--cuda-device", type=int, default=-1, help="The GPU to use, -1 for CPU.")
+parser.add_argument("--collapse-tool", type=str, default="tools/enhanced_collapse_empty_nodes.pl",
+                    help="The UD tools script used to collapse empty nodes before evaluation.")
+parser.add_argument("--output-file", type=str, default=None, help="Write the results to this JSON file.")
+parser.add_argument("--include-package", type=str, default="multitask_parser",
+                    help="The package containing the model components.")
+
+
+def collapse_empty_nodes(collapse_tool, input_file, output_file):
+    with open(output_file, "w") as f:
+        subprocess.run(["perl", collapse_tool, input_file], stdout=f, check=True)
+
+
+def predict(predictor, instances, output_file, batch_size):
+    """Parses the instances and writes the CoNLL-U output, returning the seconds spent in the model."""
+    seconds = 0.0
+    with open(output_file, "w") as f:
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            start_time = time.perf_counter()
+            outputs = predictor.predict_batch_instance(batch)
+            seconds += time.perf_counter() - start_time
+            for output in outputs:
+                f.write(predictor.dump_line(output))
+    return seconds
+
+
+def evaluate(gold_ud, system_file):
+    system_ud = iwpt21_xud_eval.load_conllu_file(system_file, iwpt21_xud_eval.get_treebank_type("0"))
+    evaluation = iwpt21_xud_eval.evaluate(gold_ud, system_ud)
+    return {metric: evaluation[metric].f1 for metric in ("LAS", "ELAS", "EULAS")}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    import_module_and_submodules(args.include_package)
+
+    archive = load_archive(args.archive_file, cuda_device=args.cuda_device)
+    predictor = Predictor.from_archive(archive, "enhanced-predictor")
+    backbone = archive.model._backbone
+
+    total_layers = backbone.get_transformer_layers()
+    layers = sorted(args.layers or range(1, total_layers + 1), reverse=True)
+    instances = list(predictor._dataset_reader.read(args.dev_file))
+    logger.info("Read %d sentences from %s", len(instances), args.dev_file)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, torch.no_grad():
+        gold_collapsed = os.path.join(tmp_dir, "gold_collapsed.conllu")
+        collapse_empty_nodes(args.collapse_tool, args.dev_file, gold_collapsed)
+        # the gold file is loaded once and scored against the prediction of each number of layers
+        gold_ud = iwpt21_xud_eval.load_conllu_file(gold_collapsed, iwpt21_xud_eval.get_treebank_type("0"))
+
+        for num_layers in layers:
+            backbone.set_transformer_layers(num_layers)
+            prediction = os.path.join(tmp_dir, f"pred_{num_layers}.conllu")
+            prediction_collapsed = os.path.join(tmp_dir, f"pred_{num_layers}_collapsed.conllu")
+
+            seconds = predict(predictor, instances, prediction, args.batch_size)
+            collapse_empty_nodes(args.collapse_tool, prediction, prediction_collapsed)
+            scores = evaluate(gold_ud, prediction_collapsed)
+
+            result = {"layers": num_layers, "seconds": seconds,
+                      "sentences_per_second": len(instances) / seconds if seconds else 0.0}
+            result.update(scores)
+            results.append(result)
+            logger.info("%d layers: ELAS %.2f in %.1fs", num_layers, 100 * scores["ELAS"], seconds)
+
+    reference = results[0]
+    print("Layers |   ELAS |    LAS |  Seconds | Speed-up")
+    print("-------+--------+--------+----------+---------")
+    for result in results:
+        result["relative_latency"] = result["seconds"] / reference["seconds"] if reference["seconds"] else 0.0
+        print("{:6} | {:6.2f} | {:6.2f} | {:8.1f} | {:7.2f}x".format(
+            result["layers"], 100 * result["ELAS"], 100 * result["LAS"], result["seconds"],
+            reference["seconds"] / result["seconds"] if result["seconds"] else 0.0,
+        ))
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
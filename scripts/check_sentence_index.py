@@ -0,0 +1,96 @@
+"""
+Checks that `SentenceIndex.read_sentences` returns the same sentences from a plain CoNLL-U file
+and from its copies compressed with every supported extension (see multitask_parser/file_utils.py),
+for ascending ids, ids which skip forwards, ids which go backwards and repeated ids. The input
+files default to a synthetic treebank (see benchmarks/synthetic_conllu.py).
+
+  python scripts/check_sentence_index.py
+  python scripts/check_sentence_index.py data/train-dev/UD_English-EWT/en_ewt-ud-dev.conllu
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.file_utils import COMPRESSION_EXTENSIONS, open_conllu
+
+from synthetic_conllu import write_treebank
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_files", type=str, nargs="*",
+                    help="The (uncompressed) CoNLL-U files to check; defaults to a synthetic treebank.")
+parser.add_argument("--sentences", "-n", type=int, default=200,
+                    help="The number of sentences of the synthetic treebank.")
+parser.add_argument("--seed", type=int, default=1, help="The random seed of the shuffled ids.")
+
+
+def sentence_id_orders(num_sentences, rng):
+    """The orders of sentence ids read from each file, by name."""
+    shuffled = list(range(num_sentences))
+    rng.shuffle(shuffled)
+    return {
+        "ascending": list(range(num_sentences)),
+        "forward skips": list(range(0, num_sentences, 3)),
+        "descending": list(range(num_sentences - 1, -1, -1)),
+        "shuffled": shuffled,
+        "repeated": [0, 0, num_sentences - 1, num_sentences - 1, 0],
+    }
+
+
+def check_file(input_file, work_dir, rng):
+    """The descriptions of the reads from a compressed copy of `input_file` which differ from the plain file."""
+    expected_index = SentenceIndex.build(input_file)
+    expected = list(expected_index.read_sentences(range(len(expected_index))))
+    orders = sentence_id_orders(len(expected), rng)
+    failures = []
+    for extension in COMPRESSION_EXTENSIONS:
+        compressed_file = os.path.join(work_dir, os.path.basename(input_file) + extension)
+        with open(input_file, encoding="utf-8") as source, open_conllu(compressed_file, "w") as target:
+            shutil.copyfileobj(source, target)
+        index = SentenceIndex.build(compressed_file)
+        if index.offsets.tolist() != expected_index.offsets.tolist():
+            failures.append(f"{compressed_file}: the offsets differ from the plain file")
+            continue
+        for name, sentence_ids in orders.items():
+            try:
+                sentences = list(index.read_sentences(sentence_ids))
+            except Exception as error:
+                failures.append(f"{compressed_file}: reading the {name} ids raised {error!r}")
+                continue
+            if sentences != [expected[sentence_id] for sentence_id in sentence_ids]:
+                failures.append(f"{compressed_file}: the {name} ids read different sentences")
+    return failures
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_files = args.input_files
+        if not input_files:
+            input_files = [os.path.join(work_dir, "synthetic.conllu")]
+            write_treebank(input_files[0], args.sentences)
+
+        failures = []
+        for input_file in input_files:
+            file_failures = check_file(input_file, work_dir, rng)
+            for failure in file_failures:
+                logger.warning(failure)
+            if not file_failures:
+                logger.info("%s: identical with %s", input_file, ", ".join(COMPRESSION_EXTENSIONS))
+            failures.extend(file_failures)
+
+    logger.info("%d failed reads", len(failures))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,84 @@
+"""
+Checks that the empty node collapsing of `iwpt21_xud_eval.py --collapse-empty-nodes` is
+byte-identical to enhanced_collapse_empty_nodes.pl of the UD tools
+(https://github.com/UniversalDependencies/tools, cloned into tools/ by scripts/delexicalise.sh).
+Each file is collapsed by both, and the first sentences which differ are printed as diffs.
+The evaluation scripts keep running the perl tool until this passes on the shared-task dev sets.
+
+  python scripts/compare_collapse_empty_nodes.py data/train-dev/*/*-ud-dev.conllu
+"""
+
+import argparse
+import difflib
+import glob
+import logging
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import iwpt21_xud_eval
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_files", type=str, nargs="*",
+                    help="The (uncompressed) CoNLL-U files to collapse; defaults to the shared-task dev sets.")
+parser.add_argument("--dataset-dir", type=str, default="data/train-dev",
+                    help="The directory of the treebanks, used when no input files are given.")
+parser.add_argument("--collapse-tool", type=str, default="tools/enhanced_collapse_empty_nodes.pl",
+                    help="The UD tools script used to collapse empty nodes.")
+parser.add_argument("--max-diffs", type=int, default=3, help="The number of differing sentences to print per file.")
+
+
+def collapse_with_perl(collapse_tool, input_file):
+    return subprocess.run(["perl", collapse_tool, input_file], stdout=subprocess.PIPE, check=True).stdout
+
+
+def collapse_with_python(input_file):
+    with iwpt21_xud_eval._open_text(input_file) as conllu_file:
+        return "".join(iwpt21_xud_eval.collapse_empty_nodes(conllu_file)).encode("utf-8")
+
+
+def sentence_diffs(expected, actual, max_diffs):
+    """The unified diffs of the first `max_diffs` sentences which differ, or of the sentence counts."""
+    expected_sentences = expected.decode("utf-8").split("\n\n")
+    actual_sentences = actual.decode("utf-8").split("\n\n")
+    diffs = []
+    if len(expected_sentences) != len(actual_sentences):
+        diffs.append(f"{len(expected_sentences)} sentences from perl, {len(actual_sentences)} from python")
+    for number, (perl_sentence, python_sentence) in enumerate(zip(expected_sentences, actual_sentences)):
+        if perl_sentence != python_sentence:
+            diffs.append("".join(difflib.unified_diff(
+                (perl_sentence + "\n").splitlines(keepends=True), (python_sentence + "\n").splitlines(keepends=True),
+                f"perl (sentence {number})", f"python (sentence {number})",
+            )))
+            if len(diffs) >= max_diffs:
+                break
+    return diffs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    input_files = args.input_files or sorted(glob.glob(os.path.join(args.dataset_dir, "*", "*-ud-dev.conllu")))
+    if not input_files:
+        parser.error(f"no input files, and no dev files in {args.dataset_dir}")
+    if not os.path.exists(args.collapse_tool):
+        parser.error(f"{args.collapse_tool} does not exist, see https://github.com/UniversalDependencies/tools")
+
+    differing_files = []
+    for input_file in input_files:
+        perl_output = collapse_with_perl(args.collapse_tool, input_file)
+        python_output = collapse_with_python(input_file)
+        if perl_output == python_output:
+            logger.info("%s: identical (%d bytes)", input_file, len(perl_output))
+            continue
+        differing_files.append(input_file)
+        logger.warning("%s: the collapsed files differ", input_file)
+        for diff in sentence_diffs(perl_output, python_output, args.max_diffs):
+            print(diff)
+
+    logger.info("%d of %d files identical", len(input_files) - len(differing_files), len(input_files))
+    sys.exit(1 if differing_files else 0)
@@ -6,10 +6,13 @@ Concatenates treebanks together
 from typing import List, Tuple, Dict, Any
 
 import os
+import sys
 import shutil
 import logging
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.file_utils import DEFAULT_BUFFER_SIZE, open_conllu, strip_compression_extension
 
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -23,6 +26,9 @@ parser.add_argument("--dataset_dir", default="data/train-dev", type=str,
                     help="The path containing all UD treebanks")
 parser.add_argument("--treebanks", default=[], type=str, nargs="+",
                     help="Specify a list of treebanks to use; leave blank to default to all treebanks available")
+parser.add_argument("--print-paths", action="store_true",
+                    help="Only print the comma-separated train and dev files, e.g. for the TRAIN_DATA_PATH and "
+                         "DEV_DATA_PATH of the multi_treebank_enhanced dataset reader, instead of concatenating them")
 
 args = parser.parse_args()
 
@@ -39,11 +45,13 @@ def get_ud_treebank_files(dataset_dir: str, treebanks: List[str] = None) -> Dict
     
     for treebank in treebanks:
         treebank_path = os.path.join(dataset_dir, treebank)
-        conllu_files = [file for file in sorted(os.listdir(treebank_path)) if file.endswith(".conllu")]
+        # the files may be compressed, e.g. en_ewt-ud-train.conllu.xz
+        conllu_files = [file for file in sorted(os.listdir(treebank_path))
+                        if strip_compression_extension(file).endswith(".conllu")]
 
-        train_file = [file for file in conllu_files if file.endswith("train.conllu")]
-        dev_file = [file for file in conllu_files if file.endswith("dev.conllu")]
-        #test_file = [file for file in conllu_files if file.endswith("test.conllu")]
+        train_file = [file for file in conllu_files if strip_compression_extension(file).endswith("train.conllu")]
+        dev_file = [file for file in conllu_files if strip_compression_extension(file).endswith("dev.conllu")]
+        #test_file = [file for file in conllu_files if strip_compression_extension(file).endswith("test.conllu")]
 
         train_file = os.path.join(treebank_path, train_file[0]) if train_file else None
         dev_file = os.path.join(treebank_path, dev_file[0]) if dev_file else None
@@ -55,6 +63,11 @@ def get_ud_treebank_files(dataset_dir: str, treebanks: List[str] = None) -> Dict
 
 treebanks = get_ud_treebank_files(args.dataset_dir, args.treebanks)
 
+if args.print_paths:
+    for files in zip(*treebanks.values()):
+        print(",".join(file for file in files if file))
+    sys.exit(0)
+
 # main treebank is the first one;
 # where we will concatenate the other ones to that
 main_treebank = args.treebanks[0]
@@ -75,10 +88,11 @@ train, dev = list(zip(*[treebanks[k] for k in treebanks]))
 print(f"train: {train}")
 print(f"dev: {dev}")
 
+# the output files are compressed like the files of the main treebank
 for treebank, name in zip([train, dev ], basenames):
-    with open(os.path.join(output_path, name), 'w') as write:
+    with open_conllu(os.path.join(output_path, name), 'w') as write:
         for t in treebank:
             if not t:
                 continue
-            with open(t, 'r') as read:
-                shutil.copyfileobj(read, write)
\ No newline at end of file
+            with open_conllu(t, 'r') as read:
+                shutil.copyfileobj(read, write, DEFAULT_BUFFER_SIZE)
\ No newline at end of file
@@ -9,13 +9,19 @@
 # Authors: James Barry and Joachim Wagner
 
 import argparse
-from collections import defaultdict
+from collections import Counter
+import functools
+import itertools
+import multiprocessing
 import os
 from typing import Dict, List, Tuple
 import logging
-import codecs
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.file_utils import open_conllu
+from multitask_parser.graph_repair import REPAIR_MODES, repair_graph
+
 logger = logging.getLogger(__name__)
 
 FIELDS = ["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "deps", "misc"]
@@ -23,13 +29,12 @@ FIELDS = ["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "dep
 parser = argparse.ArgumentParser(description='File utils')
 parser.add_argument('--input', '-i', type=str, help='Input CoNLLU file.')
 parser.add_argument('--outdir','-o', type=str, help='Directory to write out files to.')
-parser.add_argument('--mode', '-m', type=str, default='utf-8', help='The behaviour to connect to fragments: <root_edge>, <best_guess>.')
+parser.add_argument('--mode', '-m', type=str, default='root_edge', choices=REPAIR_MODES,
+                    help='The behaviour to connect to fragments: <root_edge>, <best_guess>, <try_use_basic>.')
 parser.add_argument('--encoding', '-e', type=str, default='utf-8', help='Type of encoding.')
-args = parser.parse_args()
-
-if not os.path.exists(args.outdir):
-    logger.info(f"creating outdir in {args.outdir}, files will be written here.")
-    os.mkdir(args.outdir)
+parser.add_argument('--workers', '-w', type=int, default=1, help='Number of processes used to connect the graphs.')
+parser.add_argument('--window-size', type=int, default=2000,
+                    help='Number of sentences read and connected at a time; bounds the memory use.')
 
 def traverse_root_children(
     ids_to_heads,
@@ -72,10 +77,17 @@ def parse_sentence(sentence_blob):
     return annotated_sentence
 
 
-def lazy_parse(text: str):
-    for sentence in text.split("\n\n"):
-        if sentence:
-            yield parse_sentence(sentence)
+def stream_parse(conllu_file):
+    """Parses the sentences of an open CoNLL-U file one at a time."""
+    lines = []
+    for line in conllu_file:
+        if line.strip():
+            lines.append(line.rstrip("\r\n"))
+        elif lines:
+            yield parse_sentence("\n".join(lines))
+            lines = []
+    if lines:
+        yield parse_sentence("\n".join(lines))
 
 
 def get_lists_of_heads(deps_items):
@@ -106,21 +118,6 @@ def without_mwt_ids(inputs):
             retval.append(x)
     return retval
 
-def get_reachable(head_to_children, start_id, visited = None, restricted_to = None):
-    if visited is None:
-        visited = set()
-    if start_id in visited:
-        return visited
-    visited.add(start_id)
-    if not start_id in head_to_children:
-        return visited
-    for child in head_to_children[start_id]:
-        if restricted_to and not child in restricted_to:
-            # do no visit this child
-            continue
-        get_reachable(head_to_children, child, visited, restricted_to)
-    return visited
-
 def merge_deps(list_of_deps):
     edges = set()
     for deps in list_of_deps:
@@ -134,158 +131,81 @@ def merge_deps(list_of_deps):
     edges = sorted(list(edges))
     return '|'.join([hd for _, _, hd in edges])
 
-def _read(file_path):
-    logger.info("Reading data from: %s", file_path)
+def get_edges(deps):
+    """The (head, label) edges of a deps value such as '13:nsubj|19:nsubj:enh'."""
+    edges = []
+    if deps == '_' or not deps:
+        return edges
+    for relation in deps.split("|"):
+        head, label = relation.split(':', 1)
+        assert head[0].isdigit()
+        edges.append((head, label))
+    return edges
+
+def connect_sentence(annotated_sentence, mode):
+    """
+    Makes the enhanced graph of a sentence rooted and connected, following `mode`.
+    Returns the updated sentence and a counter of the events which occurred.
+    """
+    event_counter = Counter()
+    event_counter['sentence'] += 1
+    ids = without_mwt_ids([x["id"] for x in annotated_sentence])
+
+    # the first token with each id
+    tokens = {}
+    for token in annotated_sentence:
+        tokens.setdefault(token["id"], token)
+
+    incoming_edges = {}
+    basic_edges = {}
+    for token_id in ids:
+        token = tokens[token_id]
+        incoming_edges[token_id] = get_edges(token["deps"])
+        # empty nodes don't have a basic head
+        if token["head"] != "_":
+            basic_edges[token_id] = (token["head"], token["deprel"])
+
+    repaired_edges = repair_graph(
+        ids, incoming_edges, mode, basic_edges, root='0', sort_key=float, event_counter=event_counter
+    )
+
+    for token_id in ids:
+        if repaired_edges[token_id] != incoming_edges[token_id]:
+            tokens[token_id]["deps"] = merge_deps(
+                [':'.join(edge) for edge in repaired_edges[token_id]]
+            )
 
-    # store each annotated sentence
-    conllu_annotations = []
+    return annotated_sentence, event_counter
 
-    tree_number = 1
-    event_counter = defaultdict(lambda: 0)
-    with open(file_path) as conllu_file:
-        for annotated_sentence in lazy_parse(conllu_file.read()):
-            event_counter['sentence'] += 1
-            #print(f"tree number {tree_number}")
-            full_ids = [x["id"] for x in annotated_sentence]
-            ids = without_mwt_ids(full_ids)
 
-            enhanced_heads = get_lists_of_heads(
-                [x["deps"] for x in annotated_sentence if x['id'] in ids]
-            )
+def _read(file_path, mode, encoding='utf-8', workers=1, window_size=2000):
+    """
+    Streams the connected sentences of `file_path`, reading and connecting `window_size`
+    sentences at a time in `workers` processes. The statistics are written to stderr at the end.
+    """
+    logger.info("Reading data from: %s", file_path)
 
-            # fix; sometimes the parser may not predict a 0:root edge
-            has_seen_root = False
-            for ehead_list in enhanced_heads:
-                if '0' in ehead_list:
-                    has_seen_root = True
-                    event_counter['has at least one root'] += 1
+    connect = functools.partial(connect_sentence, mode=mode)
+    event_counter = Counter()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        with open_conllu(file_path, encoding=encoding) as conllu_file:
+            sentences = stream_parse(conllu_file)
+            while True:
+                window = list(itertools.islice(sentences, window_size))
+                if not window:
                     break
-
-            if not has_seen_root:
-                event_counter['has no root'] += 1
-                # if the enhanced parser didn't predict a root edge, take the root edge
-                # from basic and re-try
-                for i in range(len(annotated_sentence)):
-                    head = annotated_sentence[i]["head"]
-                    if head == "0":
-                        # fix the annotation
-                        annotated_sentence[i]["deps"] = "0:root"   # TODO: not always right to throw away the other edges
-                        enhanced_heads[i] = ["0"]
-                        event_counter['copied 0:root from basic tree'] += 1
-                        break
-
-            assert len(ids) == len(enhanced_heads)
-
-            # dictionary mapping ids to heads
-            ids_to_heads = {}
-            for conllu_id, head_list in zip(ids, enhanced_heads):
-                ids_to_heads[conllu_id] = head_list
-
-            # 1) find roots (UD allows multiple roots in the enhanced graph)
-            root_ids = []
-            for token_id, heads in ids_to_heads.items():
-                if '0' in heads:
-                    root_ids.append(token_id)
-            assert len(root_ids) > 0
-
-            # 2) find nodes reachable from any of the roots
-
-            # (a) build lookup table head -> children
-            head_to_children = {}
-            for token_id, heads in ids_to_heads.items():
-                for head in heads:
-                    if not head in head_to_children:
-                        head_to_children[head] = []
-                    head_to_children[head].append(token_id)
-            # note this should also cover root_ids, so we may not
-            # need step 1 after all
-            assert sorted(head_to_children['0']) == sorted(root_ids)
-
-            # (b) search for all reachable nodes
-            nodes_reachable_from_root = get_reachable(head_to_children, '0')
-
-            #print("reachable nodes", nodes_reachable_from_root)
-
-            # 3) find remaining tokens
-            unreachable_nodes = []
-            for token_id in ids:
-                if token_id not in nodes_reachable_from_root:
-                    unreachable_nodes.append(token_id)
-
-            #print("unreachable nodes", unreachable_nodes)
-
-            # for the unreachable nodes we build fragments
-
-            count_unreachable_fragments = 0
-            while unreachable_nodes:
-                count_unreachable_fragments += 1
-                # 4) find an unreachable node that maximises the number of
-                #    nodes that can be reached from it but not from root;
-                #    this ensures that we do no add a 0:root edge to a node
-                #    that has a parent that cannot be reached from the
-                #    candidate node and therefore would be a better
-                #    candidate, reducing the number of root edges needed
-                candidates = []
-                best_fragment_size = 0
-                for unreachable_node in unreachable_nodes:
-                    fragment = get_reachable(
-                        head_to_children, unreachable_node,
-                        restricted_to = unreachable_nodes
-                    )
-                    fragment_size = len(fragment)
-                    if fragment_size < best_fragment_size:
-                        # no good candidate: try next
-                        continue
-                    elif best_fragment_size < fragment_size:
-                        # found better candidate that all before
-                        candidates = []
-                        best_fragment_size = fragment_size
-                    token_seq = float(unreachable_node)
-                    candidates.append((token_seq, unreachable_node, fragment))
-                # prefer the earliest token all else being equal
-                candidates.sort()
-
-                # 5) connect a fragment root to the root-reachable graph
-                selected_fragment_root = None
-                if args.mode in ('best_guess', 'try_use_basic'):
-                    # check wether any of the edges in the basic
-                    # tree connects one of the candidate fragments
-                    # to the root-reachable fragment
-                    for _, fragment_root, fragment in candidates:
-                        token_index = full_ids.index(fragment_root)
-                        head = annotated_sentence[token_index]['head']
-                        if head not in unreachable_nodes:
-                            # found a suitable edge
-                            selected_fragment_root = fragment_root
-                            selected_fragment = fragment
-                            label = annotated_sentence[token_index]['deprel']
-                            selected_edge = ':'.join((head, label))
-                            event_counter['connecting with edge from basic tree'] += 1
-                            event_counter['adding edge from basic tree with label ' + label] += 1
-                            break
-                if selected_fragment_root is None:
-                    selected_fragment_root = candidates[0][1]
-                    selected_fragment      = candidates[0][2]
-                    selected_edge          = '0:root'    # naive solution
-                # update graph
-                token_index = full_ids.index(selected_fragment_root)
-                deps = annotated_sentence[token_index]["deps"]
-                deps = merge_deps((deps, selected_edge))
-                annotated_sentence[token_index]["deps"] = deps
-                head, _ = selected_edge.split(':', 1)
-                if not head in head_to_children:
-                    head_to_children[head] = []
-                head_to_children[head].append(selected_fragment_root)
-                # update list of unreachable nodes
-                new_unreachable_nodes = []
-                for node in unreachable_nodes:
-                    if node not in selected_fragment:
-                        new_unreachable_nodes.append(node)
-                unreachable_nodes = new_unreachable_nodes
-
-            event_counter['connected %3d unreachable fragments' %count_unreachable_fragments] += 1
-            conllu_annotations.append(annotated_sentence)
-            tree_number += 1
+                if pool is not None:
+                    results = pool.map(connect, window, chunksize=max(1, len(window) // (4 * workers)))
+                else:
+                    results = map(connect, window)
+                for annotated_sentence, sentence_events in results:
+                    event_counter.update(sentence_events)
+                    yield annotated_sentence
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     sys.stderr.write('Statistics:\n')
     total = float(event_counter['sentence'])
@@ -294,35 +214,30 @@ def _read(file_path):
         percentage = 100.0 * value / total
         sys.stderr.write('\t%s\t%d\t%.2f%%\n' %(key, value, percentage))
 
-    return conllu_annotations
-
 
 def decode_conllu_output(conllu_annotations):
-    decoded_conllu_annotations = []
     for sentence_blob in conllu_annotations:
         conllu_sentence = []
         for conllu_row in sentence_blob:
             lines = [conllu_row[k] for k in FIELDS]
             conllu_lines = "\t".join(lines)
             conllu_sentence.append(conllu_lines)
-        decoded_conllu_annotations.append(conllu_sentence)
-
-    return decoded_conllu_annotations
+        yield conllu_sentence
 
 
-def write_conllu_output(decoded_conllu_annotations):
+def write_conllu_output(decoded_conllu_annotations, input_file, outdir):
 
     # metadata
-    in_name = os.path.basename(args.input)
+    in_name = os.path.basename(input_file)
     file_string = in_name.split('.')[0]
     tbid = file_string.split('-')[0]
     file_type = file_string.split('-')[-1]
 
     #out_file_string = (f"{tbid}-ud-{file_type}.conllu")
     out_file_string = in_name
-    out_file = os.path.join(args.outdir, out_file_string)
+    out_file = os.path.join(outdir, out_file_string)
 
-    with codecs.open(out_file, 'w', encoding="utf-8") as f:
+    with open_conllu(out_file, 'w') as f:
         for sentence_blob in decoded_conllu_annotations:
             for sentence in sentence_blob:
                 f.write(sentence+'\n')
@@ -330,11 +245,17 @@ def write_conllu_output(decoded_conllu_annotations):
 
 
 if __name__ == '__main__':
-    # alter the annotation
-    conllu_annotations = _read(args.input)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.outdir):
+        logger.info(f"creating outdir in {args.outdir}, files will be written here.")
+        os.mkdir(args.outdir)
+
+    # alter the annotation, one window of sentences at a time
+    conllu_annotations = _read(args.input, args.mode, args.encoding, args.workers, args.window_size)
 
     # prepare output
     decoded_conllu_annotations = decode_conllu_output(conllu_annotations)
 
     # write output
-    conllu_output = write_conllu_output(decoded_conllu_annotations)
\ No newline at end of file
+    write_conllu_output(decoded_conllu_annotations, args.input, args.outdir)
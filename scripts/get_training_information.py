@@ -1,13 +1,25 @@
 """
-- Gets the number of training sentences
-- Splits training treebanks into groups based on sentence lengths.
-  python utils/get_training_information.py output --dataset_dir data/train-dev
+- Gets the number of training sentences and words, and the sum of the squared sentence lengths
+- Estimates the training cost of each treebank and packs the treebanks onto a number of
+  workers (e.g. GPU jobs) so that the longest job is as short as possible.
+  python scripts/get_training_information.py --output_dir output --dataset_dir data/train-dev --num_workers 5
+
+The jobs are written to `<output_dir>/training_jobs.json`, which `scripts/train_eud_wrapper.sh`
+and `scripts/train_eud_multitask_wrapper.sh` can submit, one job per worker.
 """
 
 import os
+import sys
 import json
+import heapq
 import argparse
-from typing import List, Tuple, Dict, Any, Sequence, Union
+from typing import List, Dict, Any
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.file_utils import strip_compression_extension
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--output_dir", type=str,
@@ -20,92 +32,133 @@ parser.add_argument("--treebanks", default=[], type=str, nargs="+",
                     help="Specify a list of treebanks to use; leave blank to default to all treebanks available")
 parser.add_argument("--batch_size", default=32, type=int,
                     help="The batch size used by the model; the number of training sentences is divided by this number.")
+parser.add_argument("--num_workers", default=5, type=int,
+                    help="The number of jobs to pack the treebanks onto, e.g. the number of GPUs available.")
+parser.add_argument("--word_cost", default=1.0, type=float,
+                    help="The cost of a word, for the encoder (e.g. the transformer).")
+parser.add_argument("--pair_cost", default=0.01, type=float,
+                    help="The cost of a word pair, for the graph parser heads, which score every pair of words "
+                         "of a sentence (ROOT included). Calibrate it and --word_cost with the epoch times of previous runs.")
 args = parser.parse_args()
 
 if not os.path.exists(args.output_dir):
     os.mkdir(args.output_dir)
 
 
-def get_training_information(dataset_dir: str, treebanks: List[str] = None) -> Dict[str, List[int]]:    
+def get_training_information(dataset_dir: str, treebanks: List[str] = None) -> Dict[str, Dict[str, int]]:
     """
-    Retrieves the number of sentences and warmup steps (for UDify) per training treebank.
-    The values should be the number of steps, e.g. the number of training data sentences / batch size
+    Retrieves the number of sentences, words and warmup steps (for UDify) per training treebank, and
+    the statistics of its sentence lengths. The number of warmup steps is the number of training
+    data sentences / batch size. The files are scanned once and their `SentenceIndex` is reused afterwards.
     :param dataset_dir: the directory where all treebank directories are stored
     :param treebanks: if not None or empty, retrieve just the subset of treebanks listed here
-    :return: a dictionary mapping a treebank name to the number of warmup steps.
+    :return: a dictionary mapping a training file to its statistics.
     """
     training_info_dict = {}
     treebanks = os.listdir(dataset_dir) if not treebanks else treebanks
     for treebank in treebanks:
         treebank_path = os.path.join(dataset_dir, treebank)
-        conllu_files = [file for file in sorted(os.listdir(treebank_path)) if file.endswith(".conllu")]
-        train_file = [file for file in conllu_files if file.endswith("train.conllu")]
+        # the files may be compressed, e.g. en_ewt-ud-train.conllu.xz
+        conllu_files = [file for file in sorted(os.listdir(treebank_path))
+                        if strip_compression_extension(file).endswith(".conllu")]
+        train_file = [file for file in conllu_files if strip_compression_extension(file).endswith("train.conllu")]
 
         if len(train_file) == 1:
             train_file = train_file.pop()
-            train_file_path = os.path.join(dataset_dir, treebank, train_file)            
-            
+            train_file_path = os.path.join(dataset_dir, treebank, train_file)
+
             print("Reading sentences from {}".format(train_file))
-            # calculate number of sentences
-            f = open(train_file_path, 'r', encoding="utf-8") 
-            sentence_count = 0
-            for line in f.readlines():
-                if line.isspace():
-                    sentence_count += 1
-    
+            # the sentence index is built once and then reused
+            lengths = SentenceIndex.load_or_build(train_file_path).num_words.astype(numpy.int64)
+            sentence_count = len(lengths)
+
             num_warmup_steps = round(sentence_count / args.batch_size)
-            training_info_dict[train_file] = [sentence_count, num_warmup_steps]
-    
+            training_info_dict[train_file] = {
+                "sentences": sentence_count,
+                "warmup_steps": num_warmup_steps,
+                "words": int(lengths.sum()),
+                # the graph parser heads score (n + 1) ** 2 word pairs per sentence, with the ROOT
+                "word_pairs": int(((lengths + 1) ** 2).sum()),
+                "max_sentence_length": int(lengths.max()) if sentence_count else 0,
+            }
+
     return training_info_dict
-            
 
-def create_jobs(training_info_dict: Dict[str, List[int]]) -> Dict[str, Sequence[Sequence[Union[str, int]]]]: 
 
+def estimate_cost(info: Dict[str, int], word_cost: float, pair_cost: float) -> float:
+    """
+    The estimated cost of an epoch over a treebank: linear in its words (the encoder) plus
+    quadratic in its sentence lengths (the pairwise scores of the graph parser heads).
+    """
+    return word_cost * info["words"] + pair_cost * info["word_pairs"]
+
+
+def create_jobs(
+    training_info_dict: Dict[str, Dict[str, int]], num_workers: int, word_cost: float, pair_cost: float
+) -> Dict[str, Any]:
     """
-    Splits the treebanks into different groups in a round-robin fashion based on decreasing treebank size.
-    :param training_info_dict: a dictionary mapping a training file to the number of training sents and warmup steps.
-    :return: a dictionary containing mappings between job groups and tbid, sentence length pairs.
+    Packs the treebanks onto `num_workers` jobs with the longest processing time first (LPT) rule:
+    the treebanks are assigned in order of decreasing cost, each to the job with the lowest total
+    cost so far. The longest job is at most 4/3 of the optimum.
+    :param training_info_dict: a dictionary mapping a training file to its statistics.
+    :return: a dictionary with the estimated makespan (the cost of the longest job), a lower bound of
+        the optimal makespan, and the jobs: for each, its cost, its treebanks with their number of
+        sentences and cost, and its tbids as a colon-separated list for `train_eud_parser.sh`.
     """
-    # sort treebank metadata by decreasing size
-    sorted_metadata = sorted(training_info_dict.items(), key=lambda key: key[1], reverse = True)
-
-    print(f"sorted metadata: {sorted_metadata}")
-    
-    # assign treebanks to job lists in round-robin fashion    
-    jobs_list = ["jobs_1", "jobs_2", "jobs_3", "jobs_4", "jobs_5"]
-    jobs_dict = {job: [] for job in jobs_list}
-
-    i = 1
-    num_job_buckets = len(jobs_list)
-    for treebank, (num_sents, num_warmup_steps) in sorted_metadata:
+    costs = {
+        treebank: estimate_cost(info, word_cost, pair_cost) for treebank, info in training_info_dict.items()
+    }
+    # sort treebank metadata by decreasing cost
+    sorted_treebanks = sorted(costs, key=lambda treebank: (-costs[treebank], treebank))
+
+    print(f"sorted costs: {[(treebank, round(costs[treebank])) for treebank in sorted_treebanks]}")
+
+    jobs_list = ["jobs_" + str(i) for i in range(1, num_workers + 1)]
+    jobs_dict = {job: {"cost": 0.0, "treebanks": []} for job in jobs_list}
+
+    # a heap of (total cost, job number), so that ties go to the first job
+    loads = [(0.0, i) for i in range(num_workers)]
+    for treebank in sorted_treebanks:
+        load, i = heapq.heappop(loads)
+        job = jobs_dict[jobs_list[i]]
         tbid = treebank.split("-")[0]
-        job = "jobs_" + str(i)
-        jobs_dict[job].append([tbid, num_sents])
-        i += 1
-        if i > num_job_buckets:
-            # start over
-            i = 1     
-    
-    return jobs_dict
-    
+        job["treebanks"].append([tbid, training_info_dict[treebank]["sentences"], round(costs[treebank])])
+        job["cost"] = load + costs[treebank]
+        heapq.heappush(loads, (job["cost"], i))
+
+    for job in jobs_dict.values():
+        job["cost"] = round(job["cost"])
+        job["tbids"] = ":".join(tbid for tbid, _, _ in job["treebanks"])
+
+    total_cost = sum(costs.values())
+    return {
+        "num_workers": num_workers,
+        "word_cost": word_cost,
+        "pair_cost": pair_cost,
+        "makespan": max(job["cost"] for job in jobs_dict.values()) if jobs_dict else 0,
+        "lower_bound": round(max([total_cost / num_workers] + list(costs.values()))),
+        "jobs": jobs_dict,
+    }
+
 
 if __name__ == '__main__':
-    training_info_dict = get_training_information(args.dataset_dir)
+    training_info_dict = get_training_information(args.dataset_dir, args.treebanks)
     print("")
-    print("training files with sentence lengths and numbers of warmup steps: \n")
+    print("training files with their numbers of sentences, warmup steps and words: \n")
     print(training_info_dict)
-    
-    jobs_dict = create_jobs(training_info_dict)
+
+    jobs_dict = create_jobs(training_info_dict, args.num_workers, args.word_cost, args.pair_cost)
     print("")
-    print("job groups based on training size: \n")
-    print(jobs_dict)
+    print("job groups based on the estimated training cost: \n")
+    for job, job_info in jobs_dict["jobs"].items():
+        print(f"{job}: cost {job_info['cost']} {job_info['tbids']}")
+    print(f"makespan {jobs_dict['makespan']} (lower bound {jobs_dict['lower_bound']})")
     print("")
-    
+
     meta_out = os.path.join(args.output_dir, "training_information.json")
     with open(meta_out, "w") as f:
-        json.dump(training_info_dict, f, indent=2)    
+        json.dump(training_info_dict, f, indent=2)
 
     jobs_out = os.path.join(args.output_dir, "training_jobs.json")
     with open(jobs_out, "w") as f:
         json.dump(jobs_dict, f, indent=2)
-       
\ No newline at end of file
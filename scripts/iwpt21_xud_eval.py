@@ -104,11 +104,24 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import bisect
+import csv
+import gc
+import hashlib
 import io
+import json
+import multiprocessing
+import os
+import pickle
 import sys
 import unicodedata
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # CoNLL-U column names
 ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
 
@@ -130,6 +143,9 @@ UNIVERSAL_FEATURES = {
     "Tense", "Aspect", "Voice", "Evident", "Polarity", "Person", "Polite"
 }
 
+# The multi-word spans with at least this many gold x system word pairs are aligned with numpy
+LCS_NUMPY_MIN_CELLS = 900
+
 # UD Error is used when raising exceptions in this module
 class UDError(Exception):
     pass
@@ -154,59 +170,290 @@ def process_enhanced_deps(deps) :
         edeps.append((hd,steps))   # (3,['conj:en','obj:voor'])
     return edeps
 
+# Collapse the empty nodes of the enhanced graphs like enhanced_collapse_empty_nodes.pl of the
+# UD tools: each path from a head through an empty node to a dependent becomes an edge labelled
+# "deprel1>deprel2", then the empty node is removed. Paths through several empty nodes are
+# collapsed one node at a time, in the order of the ids. Yields the lines of the collapsed
+# file, reading `lines` one sentence at a time. Experimental until scripts/compare_collapse_empty_nodes.py
+# passes on the shared-task dev sets; the pipeline scripts run the perl tool until then.
+def collapse_empty_nodes(lines):
+    sentence = []
+    for line in lines:
+        sentence.append(line)
+        if not line.strip():
+            for collapsed_line in _collapse_sentence(sentence):
+                yield collapsed_line
+            sentence = []
+    # a sentence without the final empty line is left as it is, for load_conllu to report it
+    for line in sentence:
+        yield line
+
+def _node_order(node_id):
+    major, _, minor = node_id.partition(".")
+    return int(major), int(minor or 0)
+
+def _collapse_sentence(sentence):
+    comments, multiword_tokens, nodes = [], {}, []
+    # the (head, deprel) edges into and the (dependent, deprel) edges out of each node
+    incoming, outgoing = {}, {"0": []}
+    for line in sentence:
+        if line.startswith("#"):
+            comments.append(line)
+            continue
+        columns = line.rstrip("\r\n").split("\t")
+        if not columns[0][:1].isdigit():
+            continue
+        if "-" in columns[0]:
+            multiword_tokens[columns[0].split("-")[0]] = "\t".join(columns) + "\n"
+            continue
+        nodes.append(columns)
+        incoming[columns[ID]] = []
+        outgoing[columns[ID]] = []
+
+    def add_edge(head, dependent, deprel):
+        # the ids which are not in the sentence are kept, for load_conllu to report them
+        if (head, deprel) not in incoming.setdefault(dependent, []):
+            incoming[dependent].append((head, deprel))
+        if (dependent, deprel) not in outgoing.setdefault(head, []):
+            outgoing[head].append((dependent, deprel))
+
+    for columns in nodes:
+        if columns[DEPS] != "_":
+            for edge in columns[DEPS].split("|"):
+                head, deprel = edge.split(":", 1)
+                add_edge(head, columns[ID], deprel)
+
+    nodes.sort(key=lambda columns: _node_order(columns[ID]))
+    for columns in nodes:
+        empty_node = columns[ID]
+        if "." not in empty_node:
+            continue
+        head_edges = incoming.pop(empty_node)
+        dependent_edges = outgoing.pop(empty_node)
+        for head, _ in head_edges:
+            if head != empty_node:
+                outgoing[head] = [edge for edge in outgoing[head] if edge[0] != empty_node]
+        for dependent, _ in dependent_edges:
+            if dependent != empty_node:
+                incoming[dependent] = [edge for edge in incoming[dependent] if edge[0] != empty_node]
+        for head, head_deprel in head_edges:
+            for dependent, dependent_deprel in dependent_edges:
+                if head != empty_node and dependent != empty_node:
+                    add_edge(head, dependent, head_deprel + ">" + dependent_deprel)
+
+    collapsed = list(comments)
+    for columns in nodes:
+        if "." in columns[ID]:
+            continue
+        if columns[ID] in multiword_tokens:
+            collapsed.append(multiword_tokens[columns[ID]])
+        edges = sorted(incoming[columns[ID]], key=lambda edge: (_node_order(edge[0]), edge[1]))
+        columns[DEPS] = "|".join("{}:{}".format(head, deprel) for head, deprel in edges) or "_"
+        collapsed.append("\t".join(columns) + "\n")
+    collapsed.append("\n")
+    return collapsed
+
+# Unicode characters of category Zs, which are deleted from the FORMs by `load_conllu`
+_ZS_DELETIONS = dict.fromkeys(
+    code_point for code_point in range(sys.maxunicode + 1)
+    if unicodedata.category((chr if sys.version_info[0] >= 3 else unichr)(code_point)) == "Zs"
+)
+
+# Internal representation classes
+class UDRepresentation(object):
+    __slots__ = ("characters", "tokens", "words", "sentences")
+    def __init__(self):
+        # Characters of all the tokens in the whole file, as one string.
+        # Whitespace between tokens is not included.
+        self.characters = ""
+        # List of UDSpan instances with start&end indices into `characters`.
+        self.tokens = []
+        # List of UDWord instances.
+        self.words = []
+        # List of UDSpan instances with start&end indices into `characters`.
+        self.sentences = []
+
+class UDSpan(object):
+    __slots__ = ("start", "end")
+    def __init__(self, start, end):
+        self.start = start
+        # Note that self.end marks the first position **after the end** of span,
+        # so we can use characters[start:end] or range(start, end).
+        self.end = end
+
+class UDWord(object):
+    __slots__ = ("span", "columns", "is_multiword", "parent", "functional_children",
+                 "is_content_deprel", "is_functional_deprel")
+    def __init__(self, span, columns, is_multiword, universal_feats):
+        # Span of this word (or MWT, see below) within ud_representation.characters.
+        self.span = span
+        # 10 columns of the CoNLL-U file: ID, FORM, LEMMA,...
+        self.columns = columns
+        # is_multiword==True means that this word is part of a multi-word token.
+        # In that case, self.span marks the span of the whole multi-word token.
+        self.is_multiword = is_multiword
+        # Reference to the UDWord instance representing the HEAD (or None if root).
+        self.parent = None
+        # List of references to UDWord instances representing functional-deprel children.
+        self.functional_children = []
+        # Only consider universal FEATS; `universal_feats` caches them for each FEATS value.
+        feats = universal_feats.get(columns[FEATS])
+        if feats is None:
+            feats = universal_feats[columns[FEATS]] = "|".join(sorted(
+                feat for feat in columns[FEATS].split("|") if feat.split("=", 1)[0] in UNIVERSAL_FEATURES))
+        self.columns[FEATS] = feats
+        # Let's ignore language-specific deprel subtypes.
+        self.columns[DEPREL] = columns[DEPREL].split(":")[0]
+        # Precompute which deprels are CONTENT_DEPRELS and which FUNCTIONAL_DEPRELS
+        self.is_content_deprel = self.columns[DEPREL] in CONTENT_DEPRELS
+        self.is_functional_deprel = self.columns[DEPREL] in FUNCTIONAL_DEPRELS
+        # store enhanced deps --GB
+        # split string positions and enhanced labels as well?
+        self.columns[DEPS] = process_enhanced_deps(columns[DEPS])
+
+# Add the parent UDWord link of `word` and of its ancestors, and check there are no cycles
+def _link_parents(word, words, sentence_start, sentence_length):
+    # the words whose parent is being linked, each the parent of the previous one
+    chain = []
+    while word.parent is None:
+        head = int(word.columns[HEAD])
+        if head < 0 or head > sentence_length:
+            raise UDError("HEAD '{}' points outside of the sentence".format(_encode(word.columns[HEAD])))
+        if not head:
+            break
+        word.parent = "remapping"
+        chain.append(word)
+        word = words[sentence_start + head - 1]
+    if word.parent == "remapping":
+        raise UDError("There is a cycle in a sentence")
+    for child, parent in zip(chain, chain[1:] + [word]):
+        child.parent = parent
+
+# Call function(*args) with the cyclic garbage collector paused. The loaded words only
+# reference each other, so it would repeatedly traverse all of them without freeing anything.
+def _without_gc(function, *args):
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+# The dependency relation of each step of a path without the case info (enhancement 6),
+# computed on first use
+class _CaseFreeSteps(dict):
+    def __missing__(self, dep):
+        case_free = dep
+        depparts = dep.split(':')
+        if depparts[0] in CASE_DEPRELS :
+            if (len(depparts) == 2 and not(depparts[1] in UNIVERSAL_DEPREL_EXTENSIONS )) :
+                case_free = depparts[0]
+        self[dep] = case_free
+        return case_free
+
+# Compile the enhancement filters of `treebank_type` into a single function
+# filter_sentence(words), which replaces the (parent, steps) enhanced dependencies of the words
+# of a sentence with those kept for the treebank type. Returns None if no filter applies.
+# The filters are applied in the order of the enhancement numbers, in one pass over the words;
+# those working on one edge at a time (4, 5 and 6) share a single loop over the edges, and
+# duplicates are detected with sets.
+def compile_enhancement_filter(treebank_type):
+    no_gapping = treebank_type['no_gapping']
+    no_shared_parents = treebank_type['no_shared_parents_in_coordination']
+    no_shared_dependents = treebank_type['no_shared_dependents_in_coordination']
+    no_control = treebank_type['no_control']
+    no_external_arguments = treebank_type['no_external_arguments_of_relative_clauses']
+    no_case_info = treebank_type['no_case_info']
+    if not (no_gapping or no_shared_parents or no_shared_dependents or no_control or no_external_arguments
+            or no_case_info):
+        return None
+    edge_filters = no_control or no_external_arguments or no_case_info
+
+    case_free_steps = _CaseFreeSteps()
+
+    def filter_sentence(words):
+        for position, word in enumerate(words): # position is used for loop detection in relcl
+            enhanced_deps = word.columns[DEPS]
+
+            # ignore rel>rel dependencies, and instead append the original hd/rel edge
+            # note that this also ignores other extensions (like adding lemma's)
+            # note that this sometimes introduces duplicates (if orig hd/rel was already included in DEPS)
+            if no_gapping and (len(enhanced_deps) > 1 or len(enhanced_deps[0][1]) > 1) : # enhancement 1
+                processed_deps = []
+                # the (parent, rel) of the processed deps, which only have one step
+                seen = set()
+                for (parent,steps) in enhanced_deps :
+                    if len(steps) > 1 :
+                        processed_deps.append((word.parent,[word.columns[DEPREL]]))
+                        seen.add((word.parent,word.columns[DEPREL]))
+                    elif (parent,steps[0]) not in seen :
+                        processed_deps.append((parent,steps))
+                        seen.add((parent,steps[0]))
+                enhanced_deps = processed_deps
+
+            # for a given conj node, any rel other than conj in DEPS can be ignored
+            # (the last conj relation is kept)
+            if no_shared_parents and len(enhanced_deps) > 1 :   # enhancement  2
+                for (hd,steps) in reversed(enhanced_deps) :
+                    if len(steps) == 1 and steps[0].startswith('conj') :
+                        enhanced_deps = [(hd,steps)]
+                        break
+
+            # deprels not matching ud_hd/ud_dep are spurious.
+            #  czech/pud estonian/ewt syntagrus finnish/pud
+            # TO DO: treebanks that do not mark xcomp and relcl subjects
+            if no_shared_dependents and len(enhanced_deps) > 1 : # enhancement  3
+                ud_head = word.columns[HEAD]
+                # checking only for ud_hd here, check for ud_dep as well?
+                ud_head_steps = set(tuple(steps) for (hd,steps) in enhanced_deps if hd == ud_head)
+                if ud_head_steps :
+                    enhanced_deps = [(hd,steps) for (hd,steps) in enhanced_deps
+                                     if hd == ud_head or tuple(steps) not in ud_head_steps]
+
+            if edge_filters :
+                processed_deps = []
+                for (parent,steps) in enhanced_deps :
+                    # if treebank does not have control relations: subjects of xcomp parents in system are to be skipped
+                    # note that rel is actually a path sometimes rel1>rel2 in theory rel2 could be subj?
+                    # from lassy-small: 7:conj:en>nsubj:pass|7:conj:en>nsubj:xsubj    (7,['conj:en','nsubj:xsubj'])
+                    if no_control and parent and parent.columns[DEPREL] == 'xcomp' : # enhancement 4
+                        if any(rel.startswith('nsubj') for rel in steps) :
+                            continue
+
+                    if no_external_arguments : # enhancement 5
+                        if (steps[0] == 'ref') :
+                            parent, steps = word.parent, [word.columns[DEPREL]]  # append the original relation
+                        # ignore external argument link
+                        # external args are deps of an acl:relcl where that acl also is a dependent of external arg (i.e. ext arg introduces a cycle)
+                        elif ( parent and parent.columns[DEPREL].startswith('acl')  and int(parent.columns[HEAD]) == position ) :
+                            continue
+
+                    # treebanks where no lemma info has been added
+                    if no_case_info :  # enhancement number 6
+                        steps = [case_free_steps[dep] for dep in steps]
+                    processed_deps.append((parent,steps))
+                enhanced_deps = processed_deps
+
+            word.columns[DEPS] = enhanced_deps
+
+    return filter_sentence
+
 # Load given CoNLL-U file into internal representation
 def load_conllu(file,treebank_type):
-    # Internal representation classes
-    class UDRepresentation:
-        def __init__(self):
-            # Characters of all the tokens in the whole file.
-            # Whitespace between tokens is not included.
-            self.characters = []
-            # List of UDSpan instances with start&end indices into `characters`.
-            self.tokens = []
-            # List of UDWord instances.
-            self.words = []
-            # List of UDSpan instances with start&end indices into `characters`.
-            self.sentences = []
-    class UDSpan:
-        def __init__(self, start, end):
-            self.start = start
-            # Note that self.end marks the first position **after the end** of span,
-            # so we can use characters[start:end] or range(start, end).
-            self.end = end
-    class UDWord:
-        def __init__(self, span, columns, is_multiword):
-            # Span of this word (or MWT, see below) within ud_representation.characters.
-            self.span = span
-            # 10 columns of the CoNLL-U file: ID, FORM, LEMMA,...
-            self.columns = columns
-            # is_multiword==True means that this word is part of a multi-word token.
-            # In that case, self.span marks the span of the whole multi-word token.
-            self.is_multiword = is_multiword
-            # Reference to the UDWord instance representing the HEAD (or None if root).
-            self.parent = None
-            # List of references to UDWord instances representing functional-deprel children.
-            self.functional_children = []
-            # Only consider universal FEATS.
-            self.columns[FEATS] = "|".join(sorted(feat for feat in columns[FEATS].split("|")
-                                                  if feat.split("=", 1)[0] in UNIVERSAL_FEATURES))
-            # Let's ignore language-specific deprel subtypes.
-            self.columns[DEPREL] = columns[DEPREL].split(":")[0]
-            # Precompute which deprels are CONTENT_DEPRELS and which FUNCTIONAL_DEPRELS
-            self.is_content_deprel = self.columns[DEPREL] in CONTENT_DEPRELS
-            self.is_functional_deprel = self.columns[DEPREL] in FUNCTIONAL_DEPRELS
-            # store enhanced deps --GB
-            # split string positions and enhanced labels as well?
-            self.columns[DEPS] = process_enhanced_deps(columns[DEPS])
+    return _without_gc(_load_conllu, file, treebank_type)
 
+def _load_conllu(file,treebank_type):
     ud = UDRepresentation()
+    # the FORMs of all the tokens, joined into `ud.characters` at the end
+    forms = []
+    universal_feats = {}
+    filter_sentence = compile_enhancement_filter(treebank_type)
 
     # Load the CoNLL-U file
     index, sentence_start = 0, None
-    while True:
-        line = file.readline()
-        if not line:
-            break
+    lines = iter(file)
+    for line in lines:
         line = _decode(line.rstrip("\r\n"))
 
         # Handle sentence start boundaries
@@ -218,113 +465,16 @@ def load_conllu(file,treebank_type):
             ud.sentences.append(UDSpan(index, 0))
             sentence_start = len(ud.words)
         if not line:
-            # Add parent and children UDWord links and check there are no cycles
-            def process_word(word):
-                if word.parent == "remapping":
-                    raise UDError("There is a cycle in a sentence")
-                if word.parent is None:
-                    head = int(word.columns[HEAD])
-                    if head < 0 or head > len(ud.words) - sentence_start:
-                        raise UDError("HEAD '{}' points outside of the sentence".format(_encode(word.columns[HEAD])))
-                    if head:
-                        parent = ud.words[sentence_start + head - 1]
-                        word.parent = "remapping"
-                        process_word(parent)
-                        word.parent = parent
-
-
-            position = sentence_start # need to incrementally keep track of current position for loop detection in relcl
-            for word in ud.words[sentence_start:]:
-                process_word(word)
-                enhanced_deps = word.columns[DEPS]
+            words = ud.words
+            sentence_length = len(words) - sentence_start
+            for word in words[sentence_start:]:
+                _link_parents(word, words, sentence_start, sentence_length)
                 # replace head positions of enhanced dependencies with parent word object -- GB
-                processed_deps = []
-                for (head,steps) in word.columns[DEPS] :       # (3,['conj:en','obj:voor'])
-                    hd = int(head)
-                    parent = ud.words[sentence_start + hd -1] if hd else hd  # just assign '0' to parent for root cases
-                    processed_deps.append((parent,steps))
-                enhanced_deps = processed_deps
-
-                # ignore rel>rel dependencies, and instead append the original hd/rel edge
-                # note that this also ignores other extensions (like adding lemma's)
-                # note that this sometimes introduces duplicates (if orig hd/rel was already included in DEPS)
-                if (treebank_type['no_gapping']) : # enhancement 1
-                    processed_deps = []
-                    for (parent,steps) in enhanced_deps :
-                        if len(steps) > 1 :
-                            processed_deps.append((word.parent,[word.columns[DEPREL]]))
-                        else :
-                            if (parent,steps) in processed_deps :
-                                True
-                            else :
-                                processed_deps.append((parent,steps))
-                    enhanced_deps = processed_deps
-
-                # for a given conj node, any rel other than conj in DEPS can be ignored
-                if treebank_type['no_shared_parents_in_coordination'] :   # enhancement  2
-                    for (hd,steps) in enhanced_deps :
-                        if len(steps) == 1 and steps[0].startswith('conj') :
-                            enhanced_deps = [(hd,steps)]
-
-                # deprels not matching ud_hd/ud_dep are spurious.
-                #  czech/pud estonian/ewt syntagrus finnish/pud
-                # TO DO: treebanks that do not mark xcomp and relcl subjects
-                if treebank_type['no_shared_dependents_in_coordination'] : # enhancement  3
-                    processed_deps = []
-                    for (hd,steps) in enhanced_deps :
-                        duplicate = 0
-                        for (hd2,steps2) in enhanced_deps :
-                            if steps == steps2 and hd2 == word.columns[HEAD]  and hd != hd2  : # checking only for ud_hd here, check for ud_dep as well?
-                                duplicate = 1
-                        if not(duplicate) :
-                            processed_deps.append((hd,steps))
-                    enhanced_deps = processed_deps
-
-                # if treebank does not have control relations: subjects of xcomp parents in system are to be skipped
-                # note that rel is actually a path sometimes rel1>rel2 in theory rel2 could be subj?
-                # from lassy-small: 7:conj:en>nsubj:pass|7:conj:en>nsubj:xsubj    (7,['conj:en','nsubj:xsubj'])
-                if (treebank_type['no_control']) : # enhancement 4
-                    processed_deps = []
-                    for (parent,steps) in enhanced_deps :
-                        include = 1
-                        if ( parent and parent.columns[DEPREL] == 'xcomp') :
-                            for rel in steps:
-                                if rel.startswith('nsubj') :
-                                    include = 0
-                        if include :
-                            processed_deps.append((parent,steps))
-                    enhanced_deps = processed_deps
-
-                if (treebank_type['no_external_arguments_of_relative_clauses']) : # enhancement 5
-                    processed_deps = []
-                    for (parent,steps) in enhanced_deps :
-                        if (steps[0] == 'ref') :
-                            processed_deps.append((word.parent,[word.columns[DEPREL]]))  # append the original relation
-                        # ignore external argument link
-                        # external args are deps of an acl:relcl where that acl also is a dependent of external arg (i.e. ext arg introduces a cycle)
-                        elif ( parent and parent.columns[DEPREL].startswith('acl')  and int(parent.columns[HEAD]) == position - sentence_start ) :
-                            #print('removed external argument')
-                            True
-                        else :
-                            processed_deps.append((parent,steps))
-                    enhanced_deps = processed_deps
-
-                # treebanks where no lemma info has been added
-                if treebank_type['no_case_info'] :  # enhancement number 6
-                    processed_deps = []
-                    for (hd,steps) in enhanced_deps :
-                        processed_steps = []
-                        for dep in steps :
-                            depparts = dep.split(':')
-                            if depparts[0] in  CASE_DEPRELS :
-                                if (len(depparts) == 2 and not(depparts[1] in UNIVERSAL_DEPREL_EXTENSIONS )) :
-                                    dep = depparts[0]
-                            processed_steps.append(dep)
-                        processed_deps.append((hd,processed_steps))
-                    enhanced_deps = processed_deps
-
-                position += 1
-                word.columns[DEPS] = enhanced_deps
+                # (3,['conj:en','obj:voor']); just assign '0' to parent for root cases
+                word.columns[DEPS] = [(words[sentence_start + hd - 1] if hd else hd, steps)
+                                      for hd, steps in ((int(head), steps) for head, steps in word.columns[DEPS])]
+            if filter_sentence is not None:
+                filter_sentence(words[sentence_start:])
 
             # func_children cannot be assigned within process_word
             # because it is called recursively and may result in adding one child twice.
@@ -358,12 +508,12 @@ def load_conllu(file,treebank_type):
         # Delete spaces from FORM, so gold.characters == system.characters
         # even if one of them tokenizes the space. Use any Unicode character
         # with category Zs.
-        columns[FORM] = "".join(filter(lambda c: unicodedata.category(c) != "Zs", columns[FORM]))
+        columns[FORM] = columns[FORM].translate(_ZS_DELETIONS)
         if not columns[FORM]:
             raise UDError("There is an empty FORM in the CoNLL-U file")
 
         # Save token
-        ud.characters.extend(columns[FORM])
+        forms.append(columns[FORM])
         ud.tokens.append(UDSpan(index, index + len(columns[FORM])))
         index += len(columns[FORM])
 
@@ -375,11 +525,12 @@ def load_conllu(file,treebank_type):
                 raise UDError("Cannot parse multi-word token ID '{}'".format(_encode(columns[ID])))
 
             for _ in range(start, end + 1):
-                word_line = _decode(file.readline().rstrip("\r\n"))
+                word_line = _decode(next(lines, "").rstrip("\r\n"))
                 word_columns = word_line.split("\t")
                 if len(word_columns) != 10:
                     raise UDError("The CoNLL-U line does not contain 10 tab-separated columns: '{}'".format(_encode(word_line)))
-                ud.words.append(UDWord(ud.tokens[-1], word_columns, is_multiword=True))
+                ud.words.append(UDWord(ud.tokens[-1], word_columns, is_multiword=True,
+                                       universal_feats=universal_feats))
 
         # Basic tokens/words
         else:
@@ -398,25 +549,40 @@ def load_conllu(file,treebank_type):
             if head_id < 0:
                 raise UDError("HEAD cannot be negative")
 
-            ud.words.append(UDWord(ud.tokens[-1], columns, is_multiword=False))
+            ud.words.append(UDWord(ud.tokens[-1], columns, is_multiword=False, universal_feats=universal_feats))
 
     if sentence_start is not None:
         raise UDError("The CoNLL-U file does not end with empty line")
 
+    ud.characters = "".join(forms)
     return ud
 
+class Score(object):
+    def __init__(self, gold_total, system_total, correct, aligned_total=None, sentence_counts=None):
+        self.correct = correct
+        self.gold_total = gold_total
+        self.system_total = system_total
+        self.aligned_total = aligned_total
+        self.precision = correct / system_total if system_total else 0.0
+        self.recall = correct / gold_total if gold_total else 0.0
+        self.f1 = 2 * correct / (system_total + gold_total) if system_total + gold_total else 0.0
+        self.aligned_accuracy = correct / aligned_total if aligned_total else aligned_total
+        # with evaluate(..., per_sentence=True), numpy arrays of the "correct", "gold_total"
+        # and "system_total" counts in each gold sentence
+        self.sentence_counts = sentence_counts
+
+    def as_dict(self):
+        return {"precision": self.precision, "recall": self.recall, "f1": self.f1,
+                "aligned_accuracy": self.aligned_accuracy, "correct": self.correct,
+                "gold_total": self.gold_total, "system_total": self.system_total,
+                "aligned_total": self.aligned_total}
+
 # Evaluate the gold and system treebanks (loaded using load_conllu).
-def evaluate(gold_ud, system_ud):
-    class Score:
-        def __init__(self, gold_total, system_total, correct, aligned_total=None):
-            self.correct = correct
-            self.gold_total = gold_total
-            self.system_total = system_total
-            self.aligned_total = aligned_total
-            self.precision = correct / system_total if system_total else 0.0
-            self.recall = correct / gold_total if gold_total else 0.0
-            self.f1 = 2 * correct / (system_total + gold_total) if system_total + gold_total else 0.0
-            self.aligned_accuracy = correct / aligned_total if aligned_total else aligned_total
+# With per_sentence=True, the scores also contain the counts in each gold sentence
+# (see Score.sentence_counts), for significance_test.
+def evaluate(gold_ud, system_ud, per_sentence=False):
+    if per_sentence and numpy is None:
+        raise ImportError("numpy is required for the per-sentence scores")
     class AlignmentWord:
         def __init__(self, gold_word, system_word):
             self.gold_word = gold_word
@@ -431,61 +597,98 @@ def evaluate(gold_ud, system_ud):
             self.matched_words.append(AlignmentWord(gold_word, system_word))
             self.matched_words_map[system_word] = gold_word
 
+    # The index of the gold sentence containing each character position; the per-sentence
+    # counts of the system words and spans are attributed to the gold sentences too.
+    sentence_starts = [sentence.start for sentence in gold_ud.sentences]
+    def sentence_index(position):
+        return bisect.bisect_right(sentence_starts, position) - 1
+    word_sentences = {}
+    if per_sentence:
+        for word in gold_ud.words + system_ud.words:
+            word_sentences[word] = sentence_index(word.span.start)
+
+    def sentence_counts(sentences, weights=None):
+        return numpy.bincount(numpy.array(sentences, dtype=numpy.int64), weights,
+                              minlength=len(sentence_starts)).astype(numpy.int64)
+
+    # Score from the sentence indices of the gold, system and correct items, with optional
+    # weights (the counts of each item) for the enhanced scores.
+    def make_score(gold, system, correct, aligned_total=None, gold_weights=None, system_weights=None,
+                   correct_weights=None):
+        def total(items, weights):
+            return len(items) if weights is None else sum(weights)
+        counts = None
+        if per_sentence:
+            counts = {"correct": sentence_counts(correct, correct_weights),
+                      "gold_total": sentence_counts(gold, gold_weights),
+                      "system_total": sentence_counts(system, system_weights)}
+        return Score(total(gold, gold_weights), total(system, system_weights), total(correct, correct_weights),
+                     aligned_total, counts)
+
     def spans_score(gold_spans, system_spans):
-        correct, gi, si = 0, 0, 0
+        correct, gi, si = [], 0, 0
         while gi < len(gold_spans) and si < len(system_spans):
             if system_spans[si].start < gold_spans[gi].start:
                 si += 1
             elif gold_spans[gi].start < system_spans[si].start:
                 gi += 1
             else:
-                correct += gold_spans[gi].end == system_spans[si].end
+                if gold_spans[gi].end == system_spans[si].end:
+                    correct.append(gold_spans[gi])
                 si += 1
                 gi += 1
 
-        return Score(len(gold_spans), len(system_spans), correct)
+        if not per_sentence:
+            return Score(len(gold_spans), len(system_spans), len(correct))
+        return make_score([sentence_index(span.start) for span in gold_spans],
+                          [sentence_index(span.start) for span in system_spans],
+                          [sentence_index(span.start) for span in correct])
 
     def alignment_score(alignment, key_fn=None, filter_fn=None):
         if filter_fn is not None:
-            gold = sum(1 for gold in alignment.gold_words if filter_fn(gold))
-            system = sum(1 for system in alignment.system_words if filter_fn(system))
-            aligned = sum(1 for word in alignment.matched_words if filter_fn(word.gold_word))
+            gold = [gold for gold in alignment.gold_words if filter_fn(gold)]
+            system = [system for system in alignment.system_words if filter_fn(system)]
+            aligned = [word for word in alignment.matched_words if filter_fn(word.gold_word)]
         else:
-            gold = len(alignment.gold_words)
-            system = len(alignment.system_words)
-            aligned = len(alignment.matched_words)
+            gold = alignment.gold_words
+            system = alignment.system_words
+            aligned = alignment.matched_words
+
+        def score(correct, aligned_total=None):
+            if not per_sentence:
+                return Score(len(gold), len(system), len(correct), aligned_total)
+            return make_score([word_sentences[word] for word in gold],
+                              [word_sentences[word] for word in system],
+                              [word_sentences[words.gold_word] for words in correct], aligned_total)
 
         if key_fn is None:
             # Return score for whole aligned words
-            return Score(gold, system, aligned)
+            return score(aligned)
 
         def gold_aligned_gold(word):
             return word
         def gold_aligned_system(word):
             return alignment.matched_words_map.get(word, "NotAligned") if word is not None else None
-        correct = 0
-        for words in alignment.matched_words:
-            if filter_fn is None or filter_fn(words.gold_word):
-                if key_fn(words.gold_word, gold_aligned_gold) == key_fn(words.system_word, gold_aligned_system):
-                    correct += 1
+        correct = []
+        for words in aligned:
+            if key_fn(words.gold_word, gold_aligned_gold) == key_fn(words.system_word, gold_aligned_system):
+                correct.append(words)
 
-        return Score(gold, system, correct, aligned)
+        return score(correct, len(aligned))
 
     def enhanced_alignment_score(alignment,EULAS):
         # count all matching enhanced deprels in gold, system GB
         # gold and system = sum of gold and predicted deps
         # parents are pointers to word object, make sure to compare system parent with aligned word in gold in cases where
         # tokenization introduces mismatches in number of words per sentence.
-        gold = 0
-        for gold_word in alignment.gold_words :
-            gold += len(gold_word.columns[DEPS])
-        system = 0
-        for system_word in alignment.system_words :
-            system += len(system_word.columns[DEPS])
+        gold = [len(gold_word.columns[DEPS]) for gold_word in alignment.gold_words]
+        system = [len(system_word.columns[DEPS]) for system_word in alignment.system_words]
         # NB aligned does not play a role in computing f1 score -- GB
         aligned = len(alignment.matched_words)
-        correct = 0
+        # the number of correct deps of each aligned word
+        correct_words = []
         for words in alignment.matched_words:
+                correct = 0
                 gold_deps = words.gold_word.columns[DEPS]
                 system_deps = words.system_word.columns[DEPS]
                 for (parent,dep) in gold_deps :
@@ -497,8 +700,14 @@ def evaluate(gold_ud, system_ud):
                                 correct += 1
                             elif (parent == 0 and sparent == 0) :  # cases where parent is root
                                 correct += 1
+                correct_words.append(correct)
 
-        return Score(gold, system, correct, aligned)
+        if not per_sentence:
+            return Score(sum(gold), sum(system), sum(correct_words), aligned)
+        return make_score([word_sentences[word] for word in alignment.gold_words],
+                          [word_sentences[word] for word in alignment.system_words],
+                          [word_sentences[words.gold_word] for words in alignment.matched_words], aligned,
+                          gold, system, correct_words)
 
 
     def beyond_end(words, i, multiword_span_end):
@@ -540,14 +749,25 @@ def evaluate(gold_ud, system_ud):
                 si += 1
         return gs, ss, gi, si
 
-    def compute_lcs(gold_words, system_words, gi, si, gs, ss):
-        lcs = [[0] * (si - ss) for i in range(gi - gs)]
-        for g in reversed(range(gi - gs)):
-            for s in reversed(range(si - ss)):
-                if gold_words[gs + g].columns[FORM].lower() == system_words[ss + s].columns[FORM].lower():
-                    lcs[g][s] = 1 + (lcs[g+1][s+1] if g+1 < gi-gs and s+1 < si-ss else 0)
-                lcs[g][s] = max(lcs[g][s], lcs[g+1][s] if g+1 < gi-gs else 0)
-                lcs[g][s] = max(lcs[g][s], lcs[g][s+1] if s+1 < si-ss else 0)
+    def compute_lcs(gold_forms, system_forms):
+        # lcs[g][s] is the length of the LCS of gold_forms[g:] and system_forms[s:], with
+        # a last row and column of zeros. The forms are compared as interned integer ids.
+        rows, columns = len(gold_forms), len(system_forms)
+        if numpy is not None and rows * columns >= LCS_NUMPY_MIN_CELLS:
+            matches = numpy.equal.outer(numpy.array(gold_forms), numpy.array(system_forms))
+            lcs = numpy.zeros((rows + 1, columns + 1), dtype=numpy.int64)
+            for g in reversed(range(rows)):
+                # lcs[g][s] = max(1 + lcs[g+1][s+1] on a match, lcs[g+1][s], lcs[g][s+1]),
+                # so each row is the suffix maximum of the values which don't depend on the row
+                candidates = numpy.maximum(numpy.where(matches[g], lcs[g + 1, 1:] + 1, 0), lcs[g + 1, :-1])
+                lcs[g, :-1] = numpy.maximum.accumulate(candidates[::-1])[::-1]
+            return lcs.tolist()
+
+        lcs = [[0] * (columns + 1) for i in range(rows + 1)]
+        for g in reversed(range(rows)):
+            row, next_row, gold_form = lcs[g], lcs[g + 1], gold_forms[g]
+            for s in reversed(range(columns)):
+                row[s] = max(next_row[s + 1] + 1 if gold_form == system_forms[s] else 0, next_row[s], row[s + 1])
         return lcs
 
     def align_words(gold_words, system_words):
@@ -560,16 +780,22 @@ def evaluate(gold_ud, system_ud):
                 gs, ss, gi, si = find_multiword_span(gold_words, system_words, gi, si)
 
                 if si > ss and gi > gs:
-                    lcs = compute_lcs(gold_words, system_words, gi, si, gs, ss)
+                    # lowercase the FORMs once, and intern them as integer ids
+                    form_ids = {}
+                    gold_forms = [form_ids.setdefault(word.columns[FORM].lower(), len(form_ids))
+                                  for word in gold_words[gs:gi]]
+                    system_forms = [form_ids.setdefault(word.columns[FORM].lower(), len(form_ids))
+                                    for word in system_words[ss:si]]
+                    lcs = compute_lcs(gold_forms, system_forms)
 
                     # Store aligned words
                     s, g = 0, 0
                     while g < gi - gs and s < si - ss:
-                        if gold_words[gs + g].columns[FORM].lower() == system_words[ss + s].columns[FORM].lower():
+                        if gold_forms[g] == system_forms[s]:
                             alignment.append_aligned_words(gold_words[gs+g], system_words[ss+s])
                             g += 1
                             s += 1
-                        elif lcs[g][s] == (lcs[g+1][s] if g+1 < gi-gs else 0):
+                        elif lcs[g][s] == lcs[g+1][s]:
                             g += 1
                         else:
                             s += 1
@@ -631,58 +857,273 @@ def evaluate(gold_ud, system_ud):
     }
 
 
-def load_conllu_file(path,treebank_type):
-    _file = open(path, mode="r", **({"encoding": "utf-8"} if sys.version_info >= (3, 0) else {}))
-    return load_conllu(_file,treebank_type)
+# Buffer size of the files read and written by the evaluation.
+_BUFFER_SIZE = 1 << 20
+
+class _CompressedTextFile(io.TextIOWrapper):
+    """A text file over a (de)compressing stream, which also closes the underlying file when it is closed."""
+    def __init__(self, stream, raw):
+        super(_CompressedTextFile, self).__init__(stream, encoding="utf-8")
+        self._raw = raw
+
+    def close(self):
+        try:
+            super(_CompressedTextFile, self).close()
+        finally:
+            self._raw.close()
+
+def _open_text(path, mode="r"):
+    """Opens a text file for reading ("r") or writing ("w"), (de)compressing .gz, .xz, .bz2 and .zst files on the fly."""
+    extension = os.path.splitext(path)[1]
+    if extension not in (".gz", ".xz", ".bz2", ".zst"):
+        return open(path, mode=mode, buffering=_BUFFER_SIZE,
+                    **({"encoding": "utf-8"} if sys.version_info >= (3, 0) else {}))
+    binary_mode = mode + "b"
+    raw = io.open(path, mode=binary_mode, buffering=_BUFFER_SIZE)
+    try:
+        stream = _compressed_stream(raw, extension, mode)
+    except BaseException:
+        raw.close()
+        raise
+    return _CompressedTextFile(stream, raw)
+
+def _compressed_stream(raw, extension, mode):
+    # gzip, bz2 and lzma do not close a file object they are given, so `_CompressedTextFile` closes `raw`
+    binary_mode = mode + "b"
+    if extension == ".gz":
+        import gzip
+        stream = gzip.GzipFile(fileobj=raw, mode=binary_mode)
+    elif extension == ".bz2":
+        import bz2
+        stream = bz2.BZ2File(raw, mode=binary_mode)
+    elif extension == ".xz":
+        try:
+            import lzma
+        except ImportError:
+            raise UDError("Reading .xz files requires Python 3")
+        stream = lzma.LZMAFile(raw, mode=binary_mode)
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise UDError("Reading .zst files requires the zstandard package")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(raw)
+        else:
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw), _BUFFER_SIZE)
+    return stream
+
+def load_conllu_file(path,treebank_type,collapse=False):
+    with _open_text(path) as _file:
+        return load_conllu(collapse_empty_nodes(_file) if collapse else _file,treebank_type)
+
+# Version of the cached gold representations; increase it when the representation changes.
+GOLD_CACHE_VERSION = 1
+
+# The UDWord references (parents, DEPS heads) are stored as word indices, and the other
+# values (0 for the root, None) wrapped in a tuple. Pickling the linked UDWord instances
+# directly would recurse along the HEAD chains and can exceed the recursion limit.
+def _flatten_ud(ud):
+    word_indices = dict((word, i) for i, word in enumerate(ud.words))
+    token_indices = dict((token, i) for i, token in enumerate(ud.tokens))
+    def reference(value):
+        return word_indices[value] if isinstance(value, UDWord) else (value,)
+    words = []
+    for word in ud.words:
+        columns = list(word.columns)
+        columns[DEPS] = [(reference(parent), steps) for parent, steps in word.columns[DEPS]]
+        words.append((token_indices[word.span], columns, word.is_multiword, reference(word.parent),
+                      [word_indices[child] for child in word.functional_children],
+                      word.is_content_deprel, word.is_functional_deprel))
+    return {"characters": ud.characters,
+            "tokens": [(token.start, token.end) for token in ud.tokens],
+            "sentences": [(sentence.start, sentence.end) for sentence in ud.sentences],
+            "words": words}
+
+def _unflatten_ud(flat):
+    ud = UDRepresentation()
+    ud.characters = flat["characters"]
+    ud.tokens = [UDSpan(start, end) for start, end in flat["tokens"]]
+    ud.sentences = [UDSpan(start, end) for start, end in flat["sentences"]]
+    ud.words = [UDWord.__new__(UDWord) for _ in flat["words"]]
+    def dereference(value):
+        return value[0] if isinstance(value, tuple) else ud.words[value]
+    for word, (token_index, columns, is_multiword, parent, functional_children,
+               is_content_deprel, is_functional_deprel) in zip(ud.words, flat["words"]):
+        columns[DEPS] = [(dereference(head), steps) for head, steps in columns[DEPS]]
+        word.span = ud.tokens[token_index]
+        word.columns = columns
+        word.is_multiword = is_multiword
+        word.parent = dereference(parent)
+        word.functional_children = [ud.words[child] for child in functional_children]
+        word.is_content_deprel = is_content_deprel
+        word.is_functional_deprel = is_functional_deprel
+    return ud
 
-def evaluate_wrapper(args):
+# Load the gold CoNLL-U file, reusing the representation cached in `cache_dir` for the same
+# file contents, enhancements and collapsing if there is one, and caching it otherwise.
+def load_gold_conllu_file(path, treebank_type, cache_dir=None, collapse=False):
+    if cache_dir is None:
+        return load_conllu_file(path, treebank_type, collapse)
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as _file:
+        for block in iter(lambda: _file.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr((GOLD_CACHE_VERSION, sorted(treebank_type.items()), bool(collapse))).encode("utf-8"))
+    cache_file = os.path.join(cache_dir, "{}.{}.pickle".format(os.path.basename(path), digest.hexdigest()))
+
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as _file:
+            return _without_gc(lambda: _unflatten_ud(pickle.load(_file)))
+
+    gold_ud = load_conllu_file(path, treebank_type, collapse)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first, so concurrent evaluations never read a partial cache
+    temporary_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(temporary_file, "wb") as _file:
+        pickle.dump(_flatten_ud(gold_ud), _file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_file, cache_file)
+    return gold_ud
+
+def get_treebank_type(enhancements):
     treebank_type = {}
-    enhancements = list(args.enhancements)
+    enhancements = list(enhancements)
     treebank_type['no_gapping'] = 1 if '1' in enhancements else 0
     treebank_type['no_shared_parents_in_coordination'] = 1 if '2' in enhancements else 0
     treebank_type['no_shared_dependents_in_coordination'] = 1 if '3' in enhancements else 0
     treebank_type['no_control'] = 1 if '4' in enhancements else 0
     treebank_type['no_external_arguments_of_relative_clauses'] = 1 if '5' in enhancements else 0
     treebank_type['no_case_info'] = 1 if '6' in enhancements else 0
+    return treebank_type
+
+def evaluate_wrapper(args):
+    treebank_type = get_treebank_type(args.enhancements)
 
     # Load CoNLL-U files
-    gold_ud = load_conllu_file(args.gold_file,treebank_type)
-    system_ud = load_conllu_file(args.system_file,treebank_type)
+    collapse = getattr(args, "collapse_empty_nodes", False)
+    gold_ud = load_gold_conllu_file(args.gold_file, treebank_type, getattr(args, "gold_cache_dir", None), collapse)
+    system_ud = load_conllu_file(args.system_file,treebank_type,collapse)
     return evaluate(gold_ud, system_ud)
 
-def main():
-    # Parse arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("gold_file", type=str,
-                        help="Name of the CoNLL-U file with the gold data.")
-    parser.add_argument("system_file", type=str,
-                        help="Name of the CoNLL-U file with the predicted data.")
-    parser.add_argument("--verbose", "-v", default=False, action="store_true",
-                        help="Print all metrics.")
-    parser.add_argument("--counts", "-c", default=False, action="store_true",
-                        help="Print raw counts of correct/gold/system/aligned words instead of prec/rec/F1 for all metrics.")
-    parser.add_argument("--enhancements", type=str, default='0',
-                        help="Level of enhancements in the gold data (see guidelines) 0=all (default), 1=no gapping, 2=no shared parents, 3=no shared dependents 4=no control, 5=no external arguments, 6=no lemma info, combinations: 12=both 1 and 2 apply, etc.")
-    args = parser.parse_args()
-
-    # Evaluate
-    evaluation = evaluate_wrapper(args)
-
-    # Print the evaluation
+# The gold representation and treebank type shared by the worker processes of evaluate_system_files
+_worker_gold = None
+
+def _init_worker(gold_ud, treebank_type, collapse, per_sentence):
+    global _worker_gold
+    _worker_gold = (gold_ud, treebank_type, collapse, per_sentence)
+
+def _evaluate_system_file(system_file):
+    gold_ud, treebank_type, collapse, per_sentence = _worker_gold
+    return evaluate(gold_ud, load_conllu_file(system_file, treebank_type, collapse), per_sentence)
+
+# Evaluate several system files against the same gold file, loading the gold file once;
+# returns the evaluations in the order of `system_files`.
+def evaluate_system_files(gold_file, system_files, enhancements="0", gold_cache_dir=None, workers=1,
+                          collapse=False, per_sentence=False):
+    treebank_type = get_treebank_type(enhancements)
+    gold_ud = load_gold_conllu_file(gold_file, treebank_type, gold_cache_dir, collapse)
+    if workers <= 1 or len(system_files) == 1:
+        return [evaluate(gold_ud, load_conllu_file(system_file, treebank_type, collapse), per_sentence)
+                for system_file in system_files]
+
+    # with the fork start method, the workers inherit the gold representation without pickling it
+    pool = multiprocessing.Pool(min(workers, len(system_files)), _init_worker,
+                                (gold_ud, treebank_type, collapse, per_sentence))
+    try:
+        return pool.map(_evaluate_system_file, system_files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+SIGNIFICANCE_TESTS = ["bootstrap", "randomisation"]
+
+def _f1(correct, gold_total, system_total):
+    total = gold_total + system_total
+    return numpy.where(total > 0, 2.0 * correct / numpy.maximum(total, 1), 0.0)
+
+# Significance of the F1 difference between two systems evaluated on the same gold file with
+# per_sentence=True, with sentences as the units of resampling:
+#   bootstrap: paired bootstrap resampling of the sentences; the p-value is the fraction of the
+#     resamples in which the difference does not have the sign observed on the whole test set,
+#     and the 95% confidence interval of the difference is reported too;
+#   randomisation: approximate randomisation, swapping the outputs of the two systems on random
+#     subsets of the sentences; the p-value is two-sided.
+# The resamples are drawn `chunk_size` at a time and scored with matrix operations.
+def significance_test(score_a, score_b, test="bootstrap", resamples=10000, seed=1, chunk_size=1000):
+    if score_a.sentence_counts is None or score_b.sentence_counts is None:
+        raise ValueError("significance_test needs scores evaluated with per_sentence=True")
+    if test not in SIGNIFICANCE_TESTS:
+        raise ValueError("Unknown significance test {}, expected one of {}".format(test, SIGNIFICANCE_TESTS))
+
+    # shape (sentences, 6): the correct, gold and system counts of A then B
+    fields = ["correct", "gold_total", "system_total"]
+    counts = numpy.stack([score.sentence_counts[field] for score in (score_a, score_b) for field in fields],
+                         axis=1).astype(numpy.float64)
+    sentences = counts.shape[0]
+    if score_b.sentence_counts["gold_total"].shape[0] != score_a.sentence_counts["gold_total"].shape[0]:
+        raise ValueError("The scores are not for the same gold sentences")
+
+    def delta(totals):
+        return _f1(*totals[..., :3].T) - _f1(*totals[..., 3:].T)
+    observed = float(delta(counts.sum(axis=0)))
+
+    random = numpy.random.RandomState(seed)
+    deltas = []
+    for start in range(0, resamples, chunk_size):
+        size = min(chunk_size, resamples - start)
+        if test == "bootstrap":
+            # how many times each sentence is drawn in each resample
+            draws = random.randint(0, sentences, size=(size, sentences))
+            draws += numpy.arange(size)[:, None] * sentences
+            weights = numpy.bincount(draws.ravel(), minlength=size * sentences).reshape(size, sentences)
+            deltas.append(delta(weights.dot(counts)))
+        else:
+            swaps = random.randint(0, 2, size=(size, sentences)).astype(numpy.float64)
+            shift = swaps.dot(counts[:, 3:] - counts[:, :3])
+            totals = counts.sum(axis=0)
+            deltas.append(delta(numpy.concatenate([totals[:3] + shift, totals[3:] - shift], axis=1)))
+    deltas = numpy.concatenate(deltas)
+
+    result = {"test": test, "resamples": resamples, "delta": observed}
+    if test == "bootstrap":
+        if observed >= 0:
+            result["p_value"] = float(numpy.mean(deltas <= 0))
+        else:
+            result["p_value"] = float(numpy.mean(deltas >= 0))
+        result["ci_low"], result["ci_high"] = (float(value) for value in numpy.percentile(deltas, [2.5, 97.5]))
+    else:
+        result["p_value"] = float((numpy.sum(numpy.abs(deltas) >= abs(observed) - 1e-12) + 1) / (resamples + 1.0))
+    return result
+
+# Compare each of the system files after the first with the first one.
+def compare_systems(system_files, evaluations, metrics, test="bootstrap", resamples=10000, seed=1):
+    comparisons = []
+    for system_file, evaluation in zip(system_files[1:], evaluations[1:]):
+        for metric in metrics:
+            comparison = {"baseline_file": system_files[0], "system_file": system_file, "metric": metric}
+            comparison.update(significance_test(evaluation[metric], evaluations[0][metric], test, resamples, seed))
+            comparisons.append(comparison)
+    return comparisons
+
+METRICS = ["Tokens", "Sentences", "Words", "UPOS", "XPOS", "UFeats", "AllTags", "Lemmas", "UAS", "LAS", "ELAS", "EULAS", "CLAS", "MLAS", "BLEX"]
+
+def print_evaluation(evaluation, args, output=sys.stdout):
     if not args.verbose and not args.counts:
-        print("LAS F1 Score: {:.2f}".format(100 * evaluation["LAS"].f1))
-        print("ELAS F1 Score: {:.2f}".format(100 * evaluation["ELAS"].f1))
-        print("EULAS F1 Score: {:.2f}".format(100 * evaluation["EULAS"].f1))
+        print("LAS F1 Score: {:.2f}".format(100 * evaluation["LAS"].f1), file=output)
+        print("ELAS F1 Score: {:.2f}".format(100 * evaluation["ELAS"].f1), file=output)
+        print("EULAS F1 Score: {:.2f}".format(100 * evaluation["EULAS"].f1), file=output)
 
-        print("MLAS Score: {:.2f}".format(100 * evaluation["MLAS"].f1))
-        print("BLEX Score: {:.2f}".format(100 * evaluation["BLEX"].f1))
+        print("MLAS Score: {:.2f}".format(100 * evaluation["MLAS"].f1), file=output)
+        print("BLEX Score: {:.2f}".format(100 * evaluation["BLEX"].f1), file=output)
     else:
         if args.counts:
-            print("Metric     | Correct   |      Gold | Predicted | Aligned")
+            print("Metric     | Correct   |      Gold | Predicted | Aligned", file=output)
         else:
-            print("Metric     | Precision |    Recall |  F1 Score | AligndAcc")
-        print("-----------+-----------+-----------+-----------+-----------")
-        for metric in["Tokens", "Sentences", "Words", "UPOS", "XPOS", "UFeats", "AllTags", "Lemmas", "UAS", "LAS", "ELAS", "EULAS", "CLAS", "MLAS", "BLEX"]:
+            print("Metric     | Precision |    Recall |  F1 Score | AligndAcc", file=output)
+        print("-----------+-----------+-----------+-----------+-----------", file=output)
+        for metric in METRICS:
             if args.counts:
                 print("{:11}|{:10} |{:10} |{:10} |{:10}".format(
                     metric,
@@ -690,7 +1131,7 @@ def main():
                     evaluation[metric].gold_total,
                     evaluation[metric].system_total,
                     evaluation[metric].aligned_total or (evaluation[metric].correct if metric == "Words" else "")
-                ))
+                ), file=output)
             else:
                 print("{:11}|{:10.2f} |{:10.2f} |{:10.2f} |{}".format(
                     metric,
@@ -698,7 +1139,108 @@ def main():
                     100 * evaluation[metric].recall,
                     100 * evaluation[metric].f1,
                     "{:10.2f}".format(100 * evaluation[metric].aligned_accuracy) if evaluation[metric].aligned_accuracy is not None else ""
-                ))
+                ), file=output)
+
+def print_comparisons(comparisons, output=sys.stdout):
+    print("Significance ({}, {} resamples) against {}".format(
+        comparisons[0]["test"], comparisons[0]["resamples"], comparisons[0]["baseline_file"]), file=output)
+    print("System     | Metric     |     Delta |    p-value | 95% CI", file=output)
+    print("-----------+------------+-----------+------------+----------------", file=output)
+    for comparison in comparisons:
+        print("{:11}| {:11}|{:+10.2f} |{:11.4f} |{}".format(
+            os.path.basename(comparison["system_file"]),
+            comparison["metric"],
+            100 * comparison["delta"],
+            comparison["p_value"],
+            " [{:+.2f}, {:+.2f}]".format(100 * comparison["ci_low"], 100 * comparison["ci_high"]) if "ci_low" in comparison else ""
+        ), file=output)
+
+def write_evaluations(evaluations, args, output, comparisons=None):
+    if args.format == "json":
+        results = {
+            "gold_file": args.gold_file,
+            "enhancements": args.enhancements,
+            "systems": [{"system_file": system_file,
+                         "metrics": dict((metric, evaluation[metric].as_dict()) for metric in METRICS)}
+                        for system_file, evaluation in zip(args.system_files, evaluations)],
+        }
+        if comparisons:
+            results["significance"] = comparisons
+        json.dump(results, output, indent=2)
+        output.write("\n")
+    else:
+        fields = ["precision", "recall", "f1", "aligned_accuracy", "correct", "gold_total", "system_total", "aligned_total"]
+        writer = csv.writer(output)
+        writer.writerow(["system_file", "metric"] + fields)
+        for system_file, evaluation in zip(args.system_files, evaluations):
+            for metric in METRICS:
+                score = evaluation[metric].as_dict()
+                writer.writerow([system_file, metric] + [score[field] for field in fields])
+
+def main():
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("gold_file", type=str,
+                        help="Name of the CoNLL-U file with the gold data.")
+    parser.add_argument("system_files", type=str, nargs="+", metavar="system_file",
+                        help="Name of the CoNLL-U file(s) with the predicted data.")
+    parser.add_argument("--verbose", "-v", default=False, action="store_true",
+                        help="Print all metrics.")
+    parser.add_argument("--counts", "-c", default=False, action="store_true",
+                        help="Print raw counts of correct/gold/system/aligned words instead of prec/rec/F1 for all metrics.")
+    parser.add_argument("--enhancements", type=str, default='0',
+                        help="Level of enhancements in the gold data (see guidelines) 0=all (default), 1=no gapping, 2=no shared parents, 3=no shared dependents 4=no control, 5=no external arguments, 6=no lemma info, combinations: 12=both 1 and 2 apply, etc.")
+    parser.add_argument("--collapse-empty-nodes", default=False, action="store_true",
+                        help="EXPERIMENTAL: collapse the empty nodes of the gold and system files while reading "
+                             "them, like enhanced_collapse_empty_nodes.pl of the UD tools. It has not been verified "
+                             "against the perl tool on the shared-task dev sets, so official scores still collapse "
+                             "with the perl tool; run scripts/compare_collapse_empty_nodes.py before relying on it.")
+    parser.add_argument("--gold-cache-dir", type=str, default=None,
+                        help="Directory to cache the processed gold file in, keyed by its contents and the enhancements.")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of processes evaluating the system files.")
+    parser.add_argument("--format", type=str, default="text", choices=["text", "json", "csv"],
+                        help="Output format; json and csv contain all metrics of all the system files.")
+    parser.add_argument("--output-file", "-o", type=str, default=None,
+                        help="Write the evaluation to this file instead of the standard output.")
+    parser.add_argument("--significance", type=str, default=None, choices=SIGNIFICANCE_TESTS,
+                        help="Test the significance of the differences between the first system file and each of "
+                             "the others, resampling sentences (requires numpy; not included in the csv output).")
+    parser.add_argument("--resamples", type=int, default=10000,
+                        help="Number of resamples of the significance test.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed of the significance test.")
+    parser.add_argument("--significance-metrics", type=str, nargs="+", default=["LAS", "ELAS", "EULAS"],
+                        choices=METRICS, metavar="METRIC",
+                        help="Metrics to test the significance of (default: LAS ELAS EULAS).")
+    args = parser.parse_args()
+    if args.significance and len(args.system_files) < 2:
+        parser.error("--significance needs at least two system files")
+
+    # Evaluate
+    evaluations = evaluate_system_files(args.gold_file, args.system_files, args.enhancements,
+                                        args.gold_cache_dir, args.workers, args.collapse_empty_nodes,
+                                        per_sentence=bool(args.significance))
+    comparisons = None
+    if args.significance:
+        comparisons = compare_systems(args.system_files, evaluations, args.significance_metrics,
+                                      args.significance, args.resamples, args.seed)
+
+    # Print the evaluation
+    output = sys.stdout if args.output_file is None else open(args.output_file, "w")
+    try:
+        if args.format == "text":
+            for system_file, evaluation in zip(args.system_files, evaluations):
+                if len(args.system_files) > 1:
+                    print("==> {} <==".format(system_file), file=output)
+                print_evaluation(evaluation, args, output)
+            if comparisons:
+                print_comparisons(comparisons, output)
+        else:
+            write_evaluations(evaluations, args, output, comparisons)
+    finally:
+        if output is not sys.stdout:
+            output.close()
 
 if __name__ == "__main__":
     main()
@@ -707,19 +1249,20 @@ if __name__ == "__main__":
 class TestAlignment(unittest.TestCase):
     @staticmethod
     def _load_words(words):
-        """Prepare fake CoNLL-U files with fake HEAD to prevent multiple roots errors."""
+        """Prepare fake CoNLL-U files with fake HEAD and DEPS to prevent multiple roots errors."""
         lines, num_words = [], 0
         for w in words:
             parts = w.split(" ")
             if len(parts) == 1:
                 num_words += 1
-                lines.append("{}\t{}\t_\t_\t_\t_\t{}\t_\t_\t_".format(num_words, parts[0], int(num_words>1)))
+                lines.append("{0}\t{1}\t_\t_\t_\t_\t{2}\tdep\t{2}:dep\t_".format(num_words, parts[0], int(num_words>1)))
             else:
                 lines.append("{}-{}\t{}\t_\t_\t_\t_\t_\t_\t_\t_".format(num_words + 1, num_words + len(parts) - 1, parts[0]))
                 for part in parts[1:]:
                     num_words += 1
-                    lines.append("{}\t{}\t_\t_\t_\t_\t{}\t_\t_\t_".format(num_words, part, int(num_words>1)))
-        return load_conllu((io.StringIO if sys.version_info >= (3, 0) else io.BytesIO)("\n".join(lines+["\n"])))
+                    lines.append("{0}\t{1}\t_\t_\t_\t_\t{2}\tdep\t{2}:dep\t_".format(num_words, part, int(num_words>1)))
+        return load_conllu((io.StringIO if sys.version_info >= (3, 0) else io.BytesIO)("\n".join(lines+["\n"])),
+                           get_treebank_type("0"))
 
     def _test_exception(self, gold, system):
         self.assertRaises(UDError, evaluate, self._load_words(gold), self._load_words(system))
@@ -752,3 +1295,14 @@ class TestAlignment(unittest.TestCase):
         self._test_ok(["abc a BX c", "def d EX f"], ["ab a b", "cd c d", "ef e f"], 4)
         self._test_ok(["ab a b", "cd bc d"], ["a", "bc", "d"], 2)
         self._test_ok(["a", "bc b c", "d"], ["ab AX BX", "cd CX a"], 1)
+
+    def test_alignment_of_long_multiword_span(self):
+        # overlapping multi-word tokens chain all the words into one multiword span of
+        # 40 x 40 words, which crosses LCS_NUMPY_MIN_CELLS; every 7th system word differs
+        forms = ["w{}".format(i) for i in range(40)]
+        gold = ["{0}{1} {0} {1}".format(forms[i], forms[i + 1]) for i in range(0, 40, 2)]
+        system_forms = [form + "x" if i % 7 == 3 else form for i, form in enumerate(forms)]
+        system = [forms[0]] + ["{}{} {} {}".format(forms[i], forms[i + 1], system_forms[i], system_forms[i + 1])
+                               for i in range(1, 39, 2)] + [forms[39]]
+        self.assertGreaterEqual(40 * 40, LCS_NUMPY_MIN_CELLS)
+        self._test_ok(gold, system, 40 - len(range(3, 40, 7)))
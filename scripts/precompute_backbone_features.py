@@ -0,0 +1,90 @@
+"""
+Runs the (frozen) backbone of a trained model once over CoNLL-U files and writes the
+per-word `encoded_text` of every sentence to a memory-mapped fp16 array store.
+The stores are read by the `universal_dependencies_enhanced_precomputed` dataset reader
+and fed to the heads by the `precomputed_features` backbone, see
+configs/enhanced/eud_precomputed_features_enhanced_dependencies.jsonnet.
+
+  python scripts/precompute_backbone_features.py logs/<model>/model.tar.gz \
+      data/train-dev/UD_French-Sequoia/fr_sequoia-ud-train.conllu \
+      data/train-dev/UD_French-Sequoia/fr_sequoia-ud-dev.conllu \
+      --output-dir features/fr_sequoia
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import torch
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.data import Batch
+from allennlp.models.archival import load_archive
+from allennlp.nn import util as nn_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.training.util import batches
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("archive_file", type=str, help="The model archive containing the backbone.")
+parser.add_argument("input_files", type=str, nargs="+", help="The CoNLL-U files to encode.")
+parser.add_argument("--output-dir", type=str, required=True, help="The directory to write the feature stores to.")
+parser.add_argument("--batch-size", type=int, default=32, help="The number of sentences per batch.")
+parser.add_argument("--cuda-device", type=int, default=-1, help="The GPU to use, -1 for CPU.")
+parser.add_argument("--reader-name", type=str, default=None,
+                    help="The name of the dataset reader to use if the model was trained with a multitask reader.")
+parser.add_argument("--include-package", type=str, default="multitask_parser",
+                    help="The package containing the model components.")
+
+
+def get_dataset_reader(archive, reader_name=None):
+    reader = archive.validation_dataset_reader
+    # multitask readers wrap one reader per data source
+    if hasattr(reader, "readers"):
+        reader_name = reader_name or next(iter(reader.readers))
+        reader = reader.readers[reader_name]
+    return reader
+
+
+def precompute_features(model, reader, input_file, output_dir, batch_size, cuda_device):
+    # imported here so `--include-package` is applied first
+    from multitask_parser.dataset_readers.array_store import ArrayStoreWriter, get_store_prefix
+
+    backbone = model._backbone
+    prefix = get_store_prefix(output_dir, input_file, "encoded_text")
+    num_sentences = 0
+    with ArrayStoreWriter(prefix, dtype="float16", data_file=input_file) as writer:
+        for instances in batches(reader.read(input_file), batch_size):
+            for instance in instances:
+                instance.index_fields(model.vocab)
+            tensor_dict = Batch(instances).as_tensor_dict()
+            tensor_dict = nn_util.move_to_device(tensor_dict, cuda_device)
+            backbone_arguments = model._get_arguments(tensor_dict, "backbone")
+            outputs = backbone(**backbone_arguments)
+
+            encoded_text = outputs["encoded_text"].float().cpu().numpy()
+            lengths = outputs["mask"].sum(dim=1).tolist()
+            for sentence_encoded_text, length in zip(encoded_text, lengths):
+                writer.append(sentence_encoded_text[:length])
+            num_sentences += len(instances)
+
+    logger.info("Encoded %d sentences from %s", num_sentences, input_file)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    import_module_and_submodules(args.include_package)
+
+    archive = load_archive(args.archive_file, cuda_device=args.cuda_device)
+    model = archive.model
+    model.eval()
+    reader = get_dataset_reader(archive, args.reader_name)
+
+    with torch.no_grad():
+        for input_file in args.input_files:
+            precompute_features(model, reader, input_file, args.output_dir, args.batch_size, args.cuda_device)
@@ -0,0 +1,366 @@
+"""
+Runs a matrix of experiments (treebanks x seeds x configs) on one machine: each run trains a model
+with `allennlp train`, predicts the dev file and evaluates the predictions, like
+`scripts/train_eud_parser.sh` followed by `scripts/predict.sh`, but with several runs in parallel.
+
+Each run gets `--threads-per-job` threads (OMP/MKL), and as many runs are started at a time as fit
+in the CPU (and optionally memory) budget; the runs on the largest treebanks are started first.
+The stages that are already done are skipped, so an interrupted matrix can be resumed by running
+the same command again: a training run is done when its `metrics.json` exists, and unfinished
+runs are recovered from their last checkpoint.
+
+  python scripts/run_experiments.py --treebanks fr_sequoia en_ewt --seeds 756432 1234567 \
+      --configs configs/enhanced/eud_transformer.jsonnet --model-name xlm-roberta-base \
+      --env DO_LOWER_CASE=false --threads-per-job 8 --output-dir logs/experiments
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import IO, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.file_utils import open_conllu, strip_compression_extension
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ["train", "predict", "eval"]
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--treebanks", type=str, nargs="+", required=True, help="The TBIDs to train on, e.g. fr_sequoia.")
+parser.add_argument("--seeds", type=int, nargs="+", default=[756432],
+                    help="The random seeds; the numpy and pytorch seeds are derived as in train_eud_parser.sh.")
+parser.add_argument("--configs", type=str, nargs="+", required=True, help="The training configurations.")
+parser.add_argument("--model-name", type=str, default="xlm-roberta-base", help="The MODEL_NAME of the configurations.")
+parser.add_argument("--edge-model-type", type=str, default="enhanced_kg_parser",
+                    help="The EDGE_MODEL_TYPE of the configurations.")
+parser.add_argument("--env", type=str, nargs="*", default=[],
+                    help="Other variables of the configurations, as NAME=VALUE, e.g. DO_LOWER_CASE=false.")
+parser.add_argument("--dataset-dir", type=str, default="data/train-dev",
+                    help="The directory of the treebanks, e.g. data/train-dev-delexicalised.")
+parser.add_argument("--output-dir", type=str, default="logs/experiments", help="The directory of the runs.")
+parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES, help="The stages to run.")
+parser.add_argument("--predictor", type=str, default="enhanced-predictor", help="The predictor of the predict stage.")
+parser.add_argument("--ud-tools-dir", type=str, default="tools",
+                    help="The clone of https://github.com/UniversalDependencies/tools whose "
+                         "enhanced_collapse_empty_nodes.pl collapses the empty nodes before evaluation.")
+parser.add_argument("--threads-per-job", type=int, default=4, help="The number of threads of each run.")
+parser.add_argument("--cpus", type=int, default=os.cpu_count(), help="The number of CPU threads to use in total.")
+parser.add_argument("--memory-gb", type=float, default=None, help="The memory to use in total, with --memory-per-job-gb.")
+parser.add_argument("--memory-per-job-gb", type=float, default=None, help="The peak memory of a run.")
+parser.add_argument("--max-jobs", type=int, default=None, help="The maximum number of runs at a time.")
+parser.add_argument("--on-incomplete", type=str, default="recover", choices=["recover", "restart"],
+                    help="Whether to recover unfinished training runs from their last checkpoint or to start them again.")
+parser.add_argument("--progress-interval", type=float, default=60.0, help="Seconds between progress reports.")
+parser.add_argument("--allennlp", type=str, default="allennlp", help="The allennlp executable.")
+parser.add_argument("--include-package", type=str, default="multitask_parser")
+parser.add_argument("--dry-run", action="store_true", help="Only print the commands of the stages to run.")
+
+
+def find_treebank_file(dataset_dir: str, tbid: str, split: str) -> Optional[str]:
+    # the files may be compressed, e.g. en_ewt-ud-train.conllu.xz
+    for path in sorted(glob.glob(os.path.join(dataset_dir, "*", f"{tbid}-ud-{split}.conllu*"))):
+        if os.path.basename(strip_compression_extension(path)) == f"{tbid}-ud-{split}.conllu":
+            return path
+    return None
+
+
+class Run:
+    """
+    One cell of the experiment matrix, with the commands of its stages.
+    """
+
+    def __init__(self, tbid: str, seed: int, config: str, args: argparse.Namespace) -> None:
+        self.tbid = tbid
+        self.seed = seed
+        self.config = config
+        self.args = args
+        self.name = f"{tbid}-{os.path.splitext(os.path.basename(config))[0]}-{seed}"
+        self.run_dir = os.path.join(args.output_dir, self.name)
+        self.log_prefix = os.path.join(args.output_dir, "logs", self.name)
+        self.train_file = find_treebank_file(args.dataset_dir, tbid, "train")
+        self.dev_file = find_treebank_file(args.dataset_dir, tbid, "dev")
+        self.prediction_file = os.path.join(self.run_dir, "dev_pred.conllu")
+        # the perl tool only reads plain text, so a compressed dev file is collapsed from a decompressed copy
+        self.gold_file = self.dev_file
+        if self.dev_file is not None and strip_compression_extension(self.dev_file) != self.dev_file:
+            self.gold_file = os.path.join(self.run_dir, "dev_gold.conllu")
+        self.collapsed_gold_file = os.path.join(self.run_dir, "dev_gold_collapsed.conllu")
+        self.collapsed_prediction_file = os.path.join(self.run_dir, "dev_pred_collapsed.conllu")
+        self.result_file = os.path.join(self.run_dir, "dev_pred.result")
+        self.status = "pending"
+        self.stage: Optional[str] = None
+        self.durations: Dict[str, float] = {}
+        self.error: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.train_file) if self.train_file else 0
+
+    def environment(self) -> Dict[str, str]:
+        environment = dict(os.environ)
+        for variable in THREAD_VARIABLES:
+            environment[variable] = str(self.args.threads_per_job)
+        environment["TOKENIZERS_PARALLELISM"] = "false"
+        seed = str(self.seed)
+        environment.update({
+            "TBID": self.tbid,
+            "TREEBANK": os.path.basename(os.path.dirname(self.train_file)),
+            "TRAIN_DATA_PATH": self.train_file,
+            "DEV_DATA_PATH": self.dev_file or "",
+            "RANDOM_SEED": seed,
+            "NUMPY_SEED": seed[:4],
+            "PYTORCH_SEED": seed[:3],
+            "MODEL_NAME": self.args.model_name,
+            "EDGE_MODEL_TYPE": self.args.edge_model_type,
+        })
+        for assignment in self.args.env:
+            name, _, value = assignment.partition("=")
+            environment[name] = value
+        return environment
+
+    def is_done(self, stage: str) -> bool:
+        if stage == "train":
+            return os.path.exists(os.path.join(self.run_dir, "metrics.json"))
+        if stage == "predict":
+            return os.path.exists(self.prediction_file)
+        return os.path.exists(self.result_file)
+
+    def commands(self, stage: str) -> List[Tuple[List[str], Optional[str]]]:
+        """
+        The commands of a stage, each with the file its output is written to (or `None` for the log).
+        """
+        if stage == "train":
+            command = [self.args.allennlp, "train", self.config, "-s", self.run_dir,
+                       "--include-package", self.args.include_package]
+            if os.path.exists(os.path.join(self.run_dir, "config.json")):
+                command.append("--recover" if self.args.on_incomplete == "recover" else "--force")
+            return [(command, None)]
+        if stage == "predict":
+            return [([self.args.allennlp, "predict", os.path.join(self.run_dir, "model.tar.gz"), self.dev_file,
+                      "--output-file", self.prediction_file + ".tmp", "--predictor", self.args.predictor,
+                      "--include-package", self.args.include_package, "--use-dataset-reader", "--silent"], None)]
+        # the empty nodes are collapsed with the perl tool as in predict.sh, until
+        # scripts/compare_collapse_empty_nodes.py shows that --collapse-empty-nodes gives the same output
+        collapse_tool = os.path.join(self.args.ud_tools_dir, "enhanced_collapse_empty_nodes.pl")
+        return [
+            (["perl", collapse_tool, self.gold_file], self.collapsed_gold_file),
+            (["perl", collapse_tool, self.prediction_file], self.collapsed_prediction_file),
+            ([sys.executable, os.path.join(SCRIPTS_DIR, "iwpt21_xud_eval.py"), "--verbose",
+              self.collapsed_gold_file, self.collapsed_prediction_file], self.result_file + ".tmp"),
+        ]
+
+    def decompress_gold_file(self) -> None:
+        if self.gold_file == self.dev_file or os.path.exists(self.gold_file):
+            return
+        with open_conllu(self.dev_file) as source, open(self.gold_file + ".tmp", "w", encoding="utf-8") as target:
+            shutil.copyfileobj(source, target)
+        os.replace(self.gold_file + ".tmp", self.gold_file)
+
+    def scores(self) -> Dict[str, float]:
+        if not os.path.exists(self.result_file):
+            return {}
+        scores = {}
+        with open(self.result_file) as result_file:
+            for line in result_file:
+                # "ELAS F1 Score: 89.01", or the F1 column of the --verbose table
+                match = (re.match(r"(\w+) F1 Score: ([\d.]+)", line)
+                         or re.match(r"(\w+)\s*\|\s*[\d.]+\s*\|\s*[\d.]+\s*\|\s*([\d.]+)", line))
+                if match:
+                    scores[match.group(1)] = float(match.group(2))
+        return scores
+
+
+class Runner:
+    """
+    Runs the stages of the runs in a pool of `max_jobs` threads, each waiting on one subprocess.
+    """
+
+    def __init__(self, runs: List[Run], stages: List[str], max_jobs: int, dry_run: bool = False) -> None:
+        self.runs = runs
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.dry_run = dry_run
+        self.start_time = time.time()
+        self._processes: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def run_stages(self, run: Run) -> None:
+        for stage in self.stages:
+            if run.is_done(stage):
+                continue
+            if self._stopping:
+                run.status = "pending"
+                return
+            run.status, run.stage = "running", stage
+            commands = run.commands(stage)
+            if self.dry_run:
+                for command, output_file in commands:
+                    print(" ".join(command) + (f" > {output_file}" if output_file else ""))
+                continue
+            started = time.time()
+            if stage == "eval":
+                run.decompress_gold_file()
+            returncode = 0
+            # the logs are kept outside of the run directory, which allennlp wants to create itself
+            with open(f"{run.log_prefix}.{stage}.log", "w") as log_file:
+                for command, output_file in commands:
+                    returncode = self._execute(run, command, log_file, output_file)
+                    if returncode != 0:
+                        break
+            run.durations[stage] = time.time() - started
+            if returncode != 0:
+                run.status = "failed" if not self._stopping else "pending"
+                run.error = f"{stage} exited with {returncode}, see {run.log_prefix}.{stage}.log"
+                logger.error("%s: %s", run.name, run.error)
+                return
+            if stage == "predict":
+                os.replace(run.prediction_file + ".tmp", run.prediction_file)
+            if stage == "eval":
+                os.replace(run.result_file + ".tmp", run.result_file)
+        run.status, run.stage = "done", None
+
+    def _execute(self, run: Run, command: List[str], log_file: IO[str], output_file: Optional[str] = None) -> int:
+        stdout = open(output_file, "w") if output_file is not None else log_file
+        try:
+            with self._lock:
+                if self._stopping:
+                    return -signal.SIGTERM
+                process = subprocess.Popen(command, stdout=stdout, stderr=log_file, env=run.environment())
+                self._processes[run.name] = process
+            return process.wait()
+        finally:
+            with self._lock:
+                self._processes.pop(run.name, None)
+            if stdout is not log_file:
+                stdout.close()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopping = True
+            for process in self._processes.values():
+                process.terminate()
+
+    def progress(self) -> str:
+        counts = {status: 0 for status in ["done", "running", "failed", "pending"]}
+        for run in self.runs:
+            counts[run.status] += 1
+        elapsed = time.time() - self.start_time
+        report = (f"{counts['done']}/{len(self.runs)} runs done, {counts['running']} running, "
+                  f"{counts['failed']} failed, elapsed {datetime.timedelta(seconds=round(elapsed))}")
+        # only the runs that did some work this time count for the throughput
+        finished = [run for run in self.runs if run.status == "done" and run.durations]
+        if finished:
+            throughput = len(finished) / elapsed * 3600
+            remaining = counts["pending"] + counts["running"]
+            eta = remaining / len(finished) * elapsed
+            report += f", {throughput:.2f} runs/hour, ETA {datetime.timedelta(seconds=round(eta))}"
+        running = [f"{run.name} ({run.stage})" for run in self.runs if run.status == "running"]
+        if running:
+            report += "\n  running: " + ", ".join(running)
+        return report
+
+    def run(self, progress_interval: float) -> None:
+        finished = threading.Event()
+
+        def report_progress():
+            while not finished.wait(progress_interval):
+                logger.info(self.progress())
+
+        if not self.dry_run:
+            threading.Thread(target=report_progress, daemon=True).start()
+        executor = concurrent.futures.ThreadPoolExecutor(self.max_jobs)
+        try:
+            futures = [executor.submit(self.run_stages, run) for run in self.runs if run.status != "done"]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, stopping the running stages; run the same command to resume")
+            self.stop()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            finished.set()
+
+    def summary(self) -> Dict[str, Dict]:
+        return {
+            run.name: {"status": run.status, "durations": run.durations, "error": run.error, "scores": run.scores()}
+            for run in self.runs
+        }
+
+
+def max_parallel_jobs(args: argparse.Namespace) -> int:
+    max_jobs = max(1, args.cpus // args.threads_per_job)
+    if args.memory_gb is not None and args.memory_per_job_gb:
+        max_jobs = min(max_jobs, max(1, int(args.memory_gb // args.memory_per_job_gb)))
+    if args.max_jobs is not None:
+        max_jobs = min(max_jobs, args.max_jobs)
+    return max_jobs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if shutil.which(args.allennlp) is None and not args.dry_run and set(args.stages) & {"train", "predict"}:
+        parser.error(f"{args.allennlp} was not found")
+    collapse_tool = os.path.join(args.ud_tools_dir, "enhanced_collapse_empty_nodes.pl")
+    if not os.path.exists(collapse_tool) and not args.dry_run and "eval" in args.stages:
+        parser.error(f"{collapse_tool} does not exist, clone https://github.com/UniversalDependencies/tools "
+                     "into --ud-tools-dir")
+
+    runs = []
+    for tbid in args.treebanks:
+        for config in args.configs:
+            for seed in args.seeds:
+                run = Run(tbid, seed, config, args)
+                if run.train_file is None or run.dev_file is None:
+                    logger.warning("Skipping %s: no train or dev file in %s", run.name, args.dataset_dir)
+                    continue
+                runs.append(run)
+    # the longest runs first, so that they do not end up running alone at the end
+    runs.sort(key=lambda run: run.size, reverse=True)
+
+    os.makedirs(os.path.join(args.output_dir, "logs"), exist_ok=True)
+    for run in runs:
+        if all(run.is_done(stage) for stage in args.stages):
+            run.status = "done"
+    max_jobs = max_parallel_jobs(args)
+    logger.info("%d runs, %d already done, %d at a time with %d threads each",
+                len(runs), sum(run.status == "done" for run in runs), max_jobs, args.threads_per_job)
+
+    runner = Runner(runs, args.stages, max_jobs, args.dry_run)
+    runner.run(args.progress_interval)
+    if args.dry_run:
+        sys.exit(0)
+
+    logger.info(runner.progress())
+    summary_path = os.path.join(args.output_dir, "summary.json")
+    summary = runner.summary()
+    if os.path.exists(summary_path):
+        # keep the durations of the stages run by the previous invocations
+        with open(summary_path) as summary_file:
+            previous_summary = json.load(summary_file)
+        for name, run_summary in summary.items():
+            previous_durations = previous_summary.get(name, {}).get("durations", {})
+            run_summary["durations"] = {**previous_durations, **run_summary["durations"]}
+    with open(summary_path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    for name, run_summary in summary.items():
+        if "ELAS" in run_summary["scores"]:
+            print(f"{name}\tELAS {run_summary['scores']['ELAS']:.2f}")
+    sys.exit(1 if any(run.status == "failed" for run in runs) else 0)
@@ -0,0 +1,74 @@
+"""
+Splits a CoNLL-U file into contiguous shards of about the same cost, e.g. to run prediction on
+several GPUs or machines. The shards are cut with the sentence index of the file
+(see multitask_parser/dataset_readers/sentence_index.py), so each shard is copied by seeking to
+its first sentence rather than by parsing the file. The predictions of the shards can be
+concatenated in shard order to restore the order of the input file.
+
+  python scripts/shard_conllu.py data/test/fr_sequoia.conllu --num-shards 4 --output-dir shards
+  # -> shards/fr_sequoia.shard0.conllu ... shards/fr_sequoia.shard3.conllu
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from multitask_parser.dataset_readers.sentence_index import SentenceIndex
+from multitask_parser.file_utils import open_conllu, strip_compression_extension
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BALANCE_MODES = ["sentences", "words", "pairs"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_file", type=str, help="The (compressed) CoNLL-U file to split.")
+parser.add_argument("--num-shards", "-n", type=int, required=True, help="The number of shards.")
+parser.add_argument("--output-dir", "-o", type=str, required=True, help="The directory to write the shards to.")
+parser.add_argument("--balance", type=str, default="words", choices=BALANCE_MODES,
+                    help="Balance the number of sentences, of words, or of word pairs of the shards; "
+                         "the graph parser heads take time quadratic in the sentence length.")
+parser.add_argument("--index-dir", type=str, default=None,
+                    help="The directory of the sentence index, if not next to the input file.")
+
+
+def shard_boundaries(costs, num_shards):
+    """
+    The first sentence of each shard and the end of the last one, cutting the cumulative cost of
+    the sentences into `num_shards` contiguous ranges of about the same cost.
+    """
+    cumulative = numpy.cumsum(costs, dtype=numpy.float64)
+    targets = cumulative[-1] * numpy.arange(1, num_shards) / num_shards if len(costs) else []
+    cuts = numpy.searchsorted(cumulative, targets, side="left") + 1
+    return [0] + [int(cut) for cut in numpy.minimum(cuts, len(costs))] + [len(costs)]
+
+
+def sentence_costs(index, balance):
+    if balance == "sentences":
+        return numpy.ones(len(index))
+    lengths = index.num_words.astype(numpy.float64)
+    return lengths if balance == "words" else (lengths + 1) ** 2
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    index = SentenceIndex.load_or_build(args.input_file, index_dir=args.index_dir)
+    boundaries = shard_boundaries(sentence_costs(index, args.balance), args.num_shards)
+
+    basename = os.path.basename(args.input_file)
+    root, extension = os.path.splitext(strip_compression_extension(basename))
+    compression = basename[len(strip_compression_extension(basename)):]
+    for shard, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+        shard_file = os.path.join(args.output_dir, f"{root}.shard{shard}{extension}{compression}")
+        with open_conllu(shard_file, "w") as output:
+            for sentence in index.read_sentences(range(start, end)):
+                output.write(sentence)
+        logger.info("Wrote sentences %d to %d (%d words) to %s",
+                    start, end, int(index.num_words[start:end].sum()), shard_file)
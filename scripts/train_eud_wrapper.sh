@@ -13,6 +13,10 @@ test -z $1 && echo "Missing data type: 'no_delex', 'delex'"
 test -z $1 && exit 1
 DELEX_TYPE=$1
 
+# optional: the training_jobs.json written by scripts/get_training_information.py,
+# to submit one job per planned group of treebanks instead of the groups below
+JOBS_FILE=$2
+
 
 # some high memory tbids
 HIGH_MEMORY_TBIDS=(
@@ -52,6 +56,17 @@ SHORT_TBIDS=(
 # just use XLM-R for the moment.
 MODEL="xlm-roberta-base"
 
+if [ -n "$JOBS_FILE" ]; then
+    echo "running the jobs planned in ${JOBS_FILE}"
+    for TBIDS in $(python -c "import json, sys; print(' '.join(job['tbids'] for job in json.load(open(sys.argv[1]))['jobs'].values() if job['tbids']))" ${JOBS_FILE}); do
+        echo
+        echo "== running ${TBIDS} with ${MODEL} =="
+
+        sbatch -J eud_planned --gres=gpu:rtx6000:1 ./scripts/train_eud_parser.sh ${TBIDS} enhanced transformer ${MODEL} enhanced_kg_parser transformer ${DELEX_TYPE}
+    done
+    exit 0
+fi
+
 # run high memory jobs first
 echo "running high memory tbids"
 for ((i=0;i<${#HIGH_MEMORY_TBIDS[@]};++i)); do